@@ -0,0 +1,82 @@
+"""
+Measures how much traffic a `BridgeServer` puts on a slow link as clients are added, each polling the time status and
+looking up the now playing song's title and artist.
+
+    python benchmarks/bridge.py [--clients 1,2,4,8,16] [--duration 3] [--baud 19200]
+"""
+import argparse
+import os
+import random
+import tempfile
+import threading
+import time
+
+from ipodproto.bridge import BridgeClient, BridgeServer
+from ipodproto.catalog import CatalogBuilder
+from ipodproto.events import EventBus
+from ipodproto.handlers.air import AdvancedRemote
+from ipodproto.handlers.ipod import IpodEmulator
+from ipodproto.sim import LinkModel, SimulatedLink
+
+
+def build_catalog(songs=500, seed=0):
+    rng = random.Random(seed)
+    builder = CatalogBuilder("Bridge")
+    for i in range(songs):
+        builder.add_song("Song {:04d}".format(i), "Artist {}".format(rng.randrange(50)),
+                         "Album {}".format(rng.randrange(100)), "Genre {}".format(rng.randrange(10)), None, 200000)
+    return builder.build()
+
+
+def client_loop(path, deadline, calls):
+    with BridgeClient(path) as client:
+        while time.monotonic() < deadline:
+            client.get_time_status_info()
+            position = client.get_playlist_position()
+            client.get_song_title(position)
+            client.get_song_artist(position)
+            calls[0] += 4
+
+
+def run(clients, duration, baud, catalog):
+    link = SimulatedLink(LinkModel(baud, latency=0.002))
+    bus = EventBus()
+    emulator = IpodEmulator(link.ipod, catalog=catalog)
+    remote = AdvancedRemote(link.accessory, events=bus, timeout=2)
+    link.start(emulator, remote)
+
+    path = os.path.join(tempfile.mkdtemp(), 'bridge.sock')
+    with link, BridgeServer(remote, path) as server:
+        server.start()
+        calls = [0]
+        deadline = time.monotonic() + duration
+        threads = [threading.Thread(target=client_loop, args=(path, deadline, calls)) for _ in range(clients)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        stats = server.stats()
+        wire = link.stats()['to_ipod']['sent']
+    bus.close()
+    os.rmdir(os.path.dirname(path))
+    return calls[0], stats, wire
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--clients', default='1,2,4,8,16')
+    parser.add_argument('--duration', type=float, default=3.0)
+    parser.add_argument('--baud', type=int, default=19200)
+    args = parser.parse_args()
+
+    catalog = build_catalog()
+    print("{:>7} {:>10} {:>10} {:>10} {:>12}".format('clients', 'calls/s', 'sent/s', 'coalesced', 'link B/s'))
+    for clients in (int(n) for n in args.clients.split(',')):
+        calls, stats, wire = run(clients, args.duration, args.baud, catalog)
+        print("{:>7} {:>10.0f} {:>10.0f} {:>9.0%} {:>12.0f}".format(
+            clients, calls / args.duration, stats['sent'] / args.duration,
+            stats['coalesced'] / stats['requests'] if stats['requests'] else 0, wire / args.duration))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+"""
+Times browse counts and listings at every depth of a synthetic library, both in the whole library and within a
+playlist of every song, as an accessory browsing genre -> artist -> album -> song would see them.
+
+    python benchmarks/browse.py [--songs 100000] [--budget 1.0] [--check]
+
+Each measurement starts from a fresh selection, so views are built rather than cached. With `--check` it exits with
+an error if any count or listing takes longer than the budget.
+"""
+import argparse
+import random
+import sys
+from time import perf_counter
+
+from ipodproto.browse import BrowseState
+from ipodproto.catalog import CatalogBuilder
+from ipodproto.protocol import AirMode
+
+# Each step selects the first item of a type, and the types below it are timed
+PATHS = {
+    'library': (AirMode.Types.GENRE, AirMode.Types.ARTIST, AirMode.Types.ALBUM),
+    'playlist': (AirMode.Types.PLAYLIST, AirMode.Types.GENRE, AirMode.Types.ARTIST, AirMode.Types.ALBUM),
+}
+
+LISTED = (AirMode.Types.ARTIST, AirMode.Types.ALBUM, AirMode.Types.GENRE, AirMode.Types.COMPOSER,
+          AirMode.Types.SONG)
+
+
+def build_catalog(songs, seed=0):
+    rng = random.Random(seed)
+    builder = CatalogBuilder("Browse")
+    handles = [builder.add_song("Song {:06d}".format(i), "Artist {}".format(rng.randrange(songs // 20 + 1)),
+                                "Album {}".format(rng.randrange(songs // 10 + 1)), "Genre {}".format(rng.randrange(15)),
+                                "Composer {}".format(rng.randrange(songs // 50 + 1)), 200000)
+               for i in range(songs)]
+    rng.shuffle(handles)
+    builder.add_playlist("Everything", handles)
+    return builder.build()
+
+
+def timed(catalog, selection, func, repeat):
+    """
+    :return: The best time in milliseconds of calling `func` with a fresh `BrowseState` which has made the given
+    selections.
+    """
+    best = None
+    for _ in range(repeat):
+        browse = BrowseState(catalog)
+        for type, number in selection:
+            browse.select(type, number)
+
+        start = perf_counter()
+        func(browse)
+        elapsed = (perf_counter() - start) * 1000
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--songs', type=int, default=100000)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--budget', type=float, default=1.0, help="milliseconds per count or listing")
+    parser.add_argument('--check', action='store_true', help="exit with an error if over budget")
+    args = parser.parse_args()
+
+    catalog = build_catalog(args.songs)
+    print("{} songs".format(args.songs))
+
+    failures = []
+    for name, path in PATHS.items():
+        selection = []
+        for depth in range(len(path) + 1):
+            where = '{} depth {}'.format(name, depth)
+            for type in LISTED:
+                count = timed(catalog, selection, lambda browse: browse.count(type), args.repeat)
+                listing = timed(catalog, selection, lambda browse: browse.names(type, 0, 20), args.repeat)
+                flag = ''
+                if max(count, listing) > args.budget:
+                    flag = '  OVER BUDGET'
+                    failures.append((where, type))
+                print("  {:<18} type {}  count {:7.3f}ms  20 names {:7.3f}ms{}".format(where, type, count, listing,
+                                                                                       flag))
+            if depth < len(path):
+                selection.append((path[depth], 1 if path[depth] == AirMode.Types.PLAYLIST else 0))
+
+    if args.check and failures:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,252 @@
+"""
+Codec microbenchmarks: pack and unpack of every mode and every AiR command id, streaming decode of mixed frames,
+frame sizes up to a maximum length string, and memory allocated per decoded frame.
+
+    python benchmarks/codec.py [--quick] [--save results/codec-<version>.json] [--compare baseline.json]
+
+Saved results can be compared against later runs, and the comparison exits with an error if anything got slower than
+the threshold allows.
+"""
+import argparse
+import json
+import platform
+import sys
+import tracemalloc
+from datetime import datetime, timezone
+from time import perf_counter
+
+from ipodproto.protocol import *
+
+MAX_STRING = 255 - 1 - 2 - 1
+
+
+def _string(text):
+    field = StringField()
+    field.text = text
+    return field
+
+
+def _structure(cls, **values):
+    value = cls()
+    for name, v in values.items():
+        setattr(value, name, v)
+    return value
+
+
+def _name_result():
+    result = ItemNameResult()
+    result.offset = 1234
+    result.name = _string("An Item Name")
+    return result
+
+
+# Sample parameters for each parameter type in the AiR dispatch mapping
+STRUCTURE_SAMPLES = {
+    EmptyParam: lambda: None,
+    CommandResultParam: lambda: _structure(CommandResultParam, result=RESULT_SUCCESS, command=0x0018),
+    StringField: lambda: _string("A Song Title"),
+    ItemParam: lambda: _structure(ItemParam, type=AirMode.Types.ALBUM, number=42),
+    ItemRangeParam: lambda: _structure(ItemRangeParam, type=AirMode.Types.SONG, start=100, length=20),
+    ItemNameResult: _name_result,
+    TimeStatusResult: lambda: _structure(TimeStatusResult, length=200000, elapsed=1234, status=STATUS_PLAYING),
+    PictureControlBlock: lambda: _structure(PictureControlBlock, block=1, bytes=bytes(range(64))),
+    ScreenSizeResult: lambda: _structure(ScreenSizeResult, width=160, height=128),
+    ColorScreenSizeResult: lambda: _structure(ColorScreenSizeResult, data=bytes(10)),
+}
+
+
+def sample_parameters(target):
+    if isinstance(target, type) and issubclass(target, Structure):
+        return STRUCTURE_SAMPLES[target]()
+    if isinstance(target, FieldPlaceholder):
+        # A fixed length sequence
+        return bytes(target.create_instance(None).bytes_required)
+    return {UBInt8: 0x05, UBInt16: 0x0109, UBInt32: 123456}[target]
+
+
+def air_packet(command_id, parameters):
+    packet = IpodPacket()
+    packet.mode = MODE_ADVANCED_REMOTE
+    packet.command = AirCommand()
+    packet.command.id = command_id
+    if parameters is not None:
+        packet.command.parameters = parameters
+    return packet
+
+
+def mode_packets():
+    switch = IpodPacket()
+    switch.mode = MODE_SWITCH
+    switch.command = SwitchModeCommand()
+    switch.command.id = SwitchMode.Commands.SET_ADVANCED_REMOTE
+
+    voice = IpodPacket()
+    voice.mode = MODE_VOICE_RECORDER
+    voice.command = VoiceRecorderCommand()
+    voice.command.id = VoiceRecorderMode.Commands.RECORDING_STARTED
+
+    simple = IpodPacket()
+    simple.mode = MODE_SIMPLE_REMOTE
+    simple.command = SimpleRemoteCommand()
+    simple.command.id = button_payload(SimpleRemoteMode.Buttons.PLAY_PAUSE | SimpleRemoteMode.Buttons.VOLUME_UP)
+
+    status = IpodPacket()
+    status.mode = MODE_REQUEST_MODE_STATUS
+    status.command = RequestModeStatusCommand()
+
+    return {
+        'mode/switch': switch,
+        'mode/voice_recorder': voice,
+        'mode/simple_remote': simple,
+        'mode/request_mode_status': status,
+        'mode/advanced_remote': air_packet(AirMode.Commands.GET_TYPE_COUNT, AirMode.Types.SONG),
+    }
+
+
+def air_packets():
+    names = {}
+    for name, value in vars(AirMode.Commands).items():
+        if name.isupper():
+            names.setdefault(value, name)
+
+    mapping = AirCommand().lookup_field_by_name('parameters').dispatch_mapping
+    return {'air/' + names[command_id]: air_packet(command_id, sample_parameters(target))
+            for command_id, target in sorted(mapping.items())}
+
+
+def size_packets():
+    packets = {}
+    for length in (0, 1, 16, 64, 128, MAX_STRING):
+        packets['size/string_{:03d}'.format(length)] = air_packet(AirMode.Commands.RES_SONG_TITLE,
+                                                                  _string('x' * length))
+    return packets
+
+
+def measure(func, min_time):
+    """
+    :return: The mean time of one call in nanoseconds, over batches which take at least `min_time` in total.
+    """
+    number = 1
+    while True:
+        start = perf_counter()
+        for _ in range(number):
+            func()
+        elapsed = perf_counter() - start
+        if elapsed >= min_time:
+            return elapsed / number * 1e9
+        number *= 2 if elapsed < min_time / 10 else max(2, int(min_time / elapsed) + 1)
+
+
+def allocations(data, frames=500):
+    """
+    :return: The memory blocks and bytes still allocated per decoded frame.
+    """
+    IpodPacket.from_data(data)
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    kept = [IpodPacket.from_data(data) for _ in range(frames)]
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+
+    stats = after.compare_to(before, 'filename')
+    blocks = sum(s.count_diff for s in stats)
+    size = sum(s.size_diff for s in stats)
+    del kept
+    return blocks / frames, size / frames
+
+
+def run(min_time, verbose=True):
+    results = {}
+
+    def record(name, value, unit):
+        results[name] = {'value': value, 'unit': unit}
+        if verbose:
+            print("{:<40} {:>12.1f} {}".format(name, value, unit))
+
+    packets = {}
+    for group in (mode_packets(), air_packets(), size_packets()):
+        packets.update(group)
+
+    for name, packet in packets.items():
+        data = packet.pack()
+        record(name + '/pack', measure(packet.pack, min_time), 'ns')
+        record(name + '/unpack', measure(lambda: IpodPacket.from_data(data), min_time), 'ns')
+
+    # Streaming decode of every frame above, mixed, in read-sized chunks
+    stream = b''.join(packet.pack() for packet in packets.values()) * 20
+    frame_count = len(packets) * 20
+    chunks = [stream[i:i + 4096] for i in range(0, len(stream), 4096)]
+
+    def decode_stream():
+        framer = PacketFramer(lambda packet: None)
+        for chunk in chunks:
+            framer.feed(chunk)
+
+    per_stream = measure(decode_stream, min_time)
+    record('stream/mixed/per_frame', per_stream / frame_count, 'ns')
+    record('stream/mixed/throughput', len(stream) / (per_stream / 1e9) / 1e6, 'MB/s')
+
+    for name in ('mode/advanced_remote', 'air/RES_ITEM_NAME', 'size/string_{:03d}'.format(MAX_STRING)):
+        blocks, size = allocations(packets[name].pack())
+        record(name + '/alloc_blocks', blocks, 'blocks/frame')
+        record(name + '/alloc_bytes', size, 'bytes/frame')
+
+    return results
+
+
+def compare(results, baseline, threshold):
+    """
+    Prints the change in each timing against a baseline.
+    :return: The names of the timings which got slower by more than the threshold.
+    """
+    regressions = []
+    for name, result in sorted(results.items()):
+        before = baseline.get(name)
+        if before is None or result['unit'] != before['unit'] or not before['value']:
+            continue
+
+        change = result['value'] / before['value'] - 1
+        # Throughput is better when higher, everything else when lower
+        if result['unit'] == 'MB/s':
+            change = -change
+
+        flag = ''
+        if change > threshold:
+            flag = '  REGRESSION'
+            regressions.append(name)
+        print("{:<40} {:>12.1f} -> {:>12.1f} {:<12} {:+6.1%}{}".format(name, before['value'], result['value'],
+                                                                      result['unit'], change, flag))
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--quick', action='store_true', help="shorter timings, for smoke testing")
+    parser.add_argument('--save', help="write the results to this JSON file")
+    parser.add_argument('--compare', help="compare against results saved earlier")
+    parser.add_argument('--threshold', type=float, default=0.15, help="slowdown reported as a regression")
+    args = parser.parse_args()
+
+    results = run(0.02 if args.quick else 0.2, verbose=not args.compare)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({
+                'date': datetime.now(timezone.utc).isoformat(),
+                'python': sys.version.split()[0],
+                'platform': platform.platform(),
+                'results': results,
+            }, f, indent=1, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print("{} regressions".format(len(regressions)))
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
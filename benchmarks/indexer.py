@@ -0,0 +1,181 @@
+"""
+Generates a synthetic music library and times indexing it with one process and with a pool.
+
+    python benchmarks/indexer.py [--files 5000] [--art 0] [--dir /path/to/keep/the/library]
+
+The library mixes ID3v2.2, ID3v2.3 (UTF-16), ID3v2.4 (UTF-8) and ID3v1-only MP3s, with and without Xing headers,
+and M4A files with `moov` before and after `mdat`. `--art` adds a cover image of that many bytes to each ID3v2.3 tag,
+which the reader should skip over rather than read.
+"""
+import argparse
+import os
+import random
+import shutil
+import struct
+import tempfile
+import time
+
+from ipodproto.catalog import Catalog
+from ipodproto.indexer import index
+from ipodproto.protocol import AirMode
+
+# MPEG-1 layer III, 128kbit/s, 44.1kHz, stereo
+FRAME_HEADER = b'\xff\xfb\x90\x00'
+FRAME_SIZE = 417
+
+
+def _syncsafe(size):
+    return bytes(((size >> 21) & 0x7F, (size >> 14) & 0x7F, (size >> 7) & 0x7F, size & 0x7F))
+
+
+def id3v2(major, frames, art=0):
+    body = b''
+    for frame_id, text in frames:
+        if major == 2:
+            data = b'\x00' + text.encode('latin-1', 'replace')
+            body += frame_id[:3] + len(data).to_bytes(3, 'big') + data
+        elif major == 3:
+            data = b'\x01' + text.encode('utf-16')
+            body += frame_id + len(data).to_bytes(4, 'big') + b'\x00\x00' + data
+        else:
+            data = b'\x03' + text.encode('utf-8')
+            body += frame_id + _syncsafe(len(data)) + b'\x00\x00' + data
+    if art and major == 3:
+        data = b'\x00image/jpeg\x00\x03\x00' + bytes(art)
+        body = b'APIC' + len(data).to_bytes(4, 'big') + b'\x00\x00' + data + body
+    body += bytes(64)
+    return b'ID3' + bytes((major, 0, 0)) + _syncsafe(len(body)) + body
+
+
+def id3v1(title, artist, album, genre):
+    def field(text):
+        return text.encode('latin-1', 'replace')[:30].ljust(30, b'\x00')
+    return b'TAG' + field(title) + field(artist) + field(album) + b'2004' + bytes(30) + bytes((genre,))
+
+
+def mpeg_audio(seconds, xing):
+    frames = int(seconds * 44100 / 1152)
+    first = bytearray(FRAME_HEADER + bytes(FRAME_SIZE - 4))
+    if xing:
+        first[4 + 32:4 + 32 + 12] = b'Xing' + b'\x00\x00\x00\x01' + frames.to_bytes(4, 'big')
+    # Only the first few frames are real; the rest is padding of the right size
+    return bytes(first) + bytes(FRAME_SIZE * (frames - 1))
+
+
+def atom(kind, data):
+    return struct.pack('>I4s', len(data) + 8, kind) + data
+
+
+def mp4(title, artist, album, genre, composer, seconds, moov_first):
+    def item(kind, text):
+        return atom(kind, atom(b'data', b'\x00\x00\x00\x01' + bytes(4) + text.encode('utf-8')))
+
+    ilst = atom(b'ilst', item(b'\xa9nam', title) + item(b'\xa9ART', artist) + item(b'\xa9alb', album) +
+                item(b'\xa9gen', genre) + item(b'\xa9wrt', composer))
+    meta = atom(b'meta', bytes(4) + atom(b'hdlr', bytes(25)) + ilst)
+    mvhd = atom(b'mvhd', bytes(12) + struct.pack('>II', 600, int(seconds * 600)) + bytes(80))
+    moov = atom(b'moov', mvhd + atom(b'udta', meta))
+    mdat = atom(b'mdat', bytes(4096))
+    ftyp = atom(b'ftyp', b'M4A \x00\x00\x00\x00M4A mp42isom')
+    return ftyp + (moov + mdat if moov_first else mdat + moov)
+
+
+def generate(root, files, art=0, seed=0):
+    rng = random.Random(seed)
+    artists = ["Artist {}".format(i) for i in range(max(1, files // 40))] + ["Björk", "Sigur Rós", "坂本龍一"]
+    paths = []
+    for i in range(files):
+        artist = rng.choice(artists)
+        album = "Album {}".format(rng.randrange(max(1, files // 10)))
+        title = "Track {:05d}".format(i)
+        genre = rng.choice(("Rock", "Jazz", "(17)", "Electronic", "Classical"))
+        composer = "Composer {}".format(rng.randrange(50))
+        seconds = rng.randrange(90, 400)
+
+        directory = os.path.join(root, artist.replace('/', '_'), album)
+        os.makedirs(directory, exist_ok=True)
+        kind = i % 6
+        if kind < 4:
+            frames = [(b'TIT2', title), (b'TPE1', artist), (b'TALB', album), (b'TCON', genre), (b'TCOM', composer)]
+            if kind == 0:
+                data = id3v2(2, [(b'TT2 ', title), (b'TP1 ', artist), (b'TAL ', album), (b'TCO ', genre)])
+            elif kind == 3:
+                data = b''
+            else:
+                data = id3v2(kind + 2, frames, art)
+            data += mpeg_audio(seconds, xing=i % 2 == 0)
+            if kind == 3:
+                data += id3v1(title, artist, album, 17)
+            path = os.path.join(directory, "{:05d}.mp3".format(i))
+        else:
+            data = mp4(title, artist, album, genre, composer, seconds, moov_first=kind == 4)
+            path = os.path.join(directory, "{:05d}.m4a".format(i))
+
+        with open(path, 'wb') as f:
+            f.write(data)
+        paths.append(path)
+
+    with open(os.path.join(root, 'Favourites.m3u8'), 'w', encoding='utf-8') as f:
+        for path in paths[::7]:
+            f.write(os.path.relpath(path, root) + '\n')
+
+    return paths
+
+
+def corrupt(root):
+    """
+    Adds files which are cut short or otherwise broken, which should be counted as unreadable or indexed without a
+    length, rather than stopping the index.
+    :return: The number of files added.
+    """
+    directory = os.path.join(root, 'Corrupt')
+    os.makedirs(directory, exist_ok=True)
+    full = mp4("Whole", "Corrupt", "Corrupt", "Rock", "Nobody", 100, moov_first=True)
+    files = {
+        # An atom with a 64-bit size which is cut off in the middle of it
+        'large_size.m4a': atom(b'ftyp', b'M4A ') + struct.pack('>I4s', 1, b'moov') + b'\x00\x00\x00',
+        # A version 1 mvhd too short for its fields
+        'short_mvhd.m4a': atom(b'ftyp', b'M4A ') + atom(b'moov', atom(b'mvhd', b'\x01' + bytes(15))),
+        'truncated_moov.m4a': full[:len(full) // 2],
+        'truncated_id3.mp3': id3v2(3, [(b'TIT2', "Cut short")])[:15],
+        'empty.mp3': b'',
+    }
+    for name, data in files.items():
+        with open(os.path.join(directory, name), 'wb') as f:
+            f.write(data)
+    return len(files)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--files', type=int, default=5000)
+    parser.add_argument('--art', type=int, default=0, help="bytes of cover art in each ID3v2.3 tag")
+    parser.add_argument('--workers', type=int, default=None, help="pool size; one per core by default")
+    parser.add_argument('--dir', help="generate the library here and keep it")
+    args = parser.parse_args()
+
+    root = args.dir or tempfile.mkdtemp(prefix='ipodproto-library-')
+    try:
+        started = time.monotonic()
+        generate(root, args.files, args.art)
+        broken = corrupt(root)
+        print("generated {} files and {} broken ones in {:.1f}s".format(args.files, broken,
+                                                                        time.monotonic() - started))
+
+        for workers in (1, args.workers or os.cpu_count() or 1):
+            builder, stats = index(root, "Benchmark", workers)
+            catalog = Catalog.from_bytes(builder.to_bytes())
+            print("{:>2} workers: {} songs, {} unreadable, {} playlists in {:.2f}s, {:.0f} files/s".format(
+                workers, stats.songs, stats.unreadable, stats.playlists, stats.elapsed,
+                stats.files / stats.elapsed))
+
+        print("  {} artists, {} albums, {} genres, {} composers".format(
+            *(catalog.count(t) for t in (AirMode.Types.ARTIST, AirMode.Types.ALBUM, AirMode.Types.GENRE,
+                                         AirMode.Types.COMPOSER))))
+    finally:
+        if args.dir is None:
+            shutil.rmtree(root)
+
+
+if __name__ == '__main__':
+    main()
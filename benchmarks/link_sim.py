@@ -0,0 +1,88 @@
+"""
+Measures pipelining, bulk listings and timeouts between an AdvancedRemote and an IpodEmulator over a simulated serial
+link, in link time rather than host time.
+
+    python benchmarks/link_sim.py [--baud 19200] [--latency 0.005] [--drop 0.001] [--real]
+"""
+import argparse
+import random
+
+from ipodproto.catalog import CatalogBuilder
+from ipodproto.handlers.air import AdvancedRemote
+from ipodproto.handlers.ipod import IpodEmulator
+from ipodproto.protocol import AirMode
+from ipodproto.sim import LinkModel, RealClock, SimulatedLink, VirtualClock
+
+
+def build_catalog(songs=5000, seed=0):
+    rng = random.Random(seed)
+    builder = CatalogBuilder("Link Simulator")
+    for i in range(songs):
+        builder.add_song("Song {:05d}".format(i), "Artist {}".format(rng.randrange(200)),
+                         "Album {}".format(rng.randrange(500)), "Genre {}".format(rng.randrange(15)), None, 200000)
+    return builder.build()
+
+
+def connect(catalog, model, virtual, seed, timeout):
+    link = SimulatedLink(model, VirtualClock() if virtual else RealClock(), seed=seed)
+    emulator = IpodEmulator(link.ipod, catalog=catalog)
+    remote = AdvancedRemote(link.accessory, timeout=timeout)
+    link.start(emulator, remote)
+    return link, remote
+
+
+def timed(link, func):
+    start = link.clock.now()
+    result = func()
+    return link.clock.now() - start, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--baud', type=int, default=19200)
+    parser.add_argument('--latency', type=float, default=0.005)
+    parser.add_argument('--jitter', type=float, default=0.002)
+    parser.add_argument('--drop', type=float, default=0.0005, help="byte drop rate for the timeout run")
+    parser.add_argument('--real', action='store_true', help="use the real clock instead of a virtual one")
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    catalog = build_catalog()
+    virtual = not args.real
+    model = LinkModel(args.baud, args.latency, args.jitter)
+    print("{} baud, {:.1f}ms latency, {:.1f}ms jitter, {} clock".format(
+        args.baud, args.latency * 1000, args.jitter * 1000, 'virtual' if virtual else 'real'))
+
+    link, remote = connect(catalog, model, virtual, args.seed, timeout=2)
+    with link:
+        for pipeline in (False, True):
+            elapsed, _ = timed(link, lambda: remote.handshake(pipeline))
+            print("  handshake {:<10} {:8.1f}ms".format('pipelined' if pipeline else 'sequential', elapsed * 1000))
+
+        for count in (1, 10, 100):
+            elapsed, names = timed(link, lambda: remote.get_item_names(AirMode.Types.SONG, 0, count))
+            assert len(names) == count
+            print("  {:>3} item names     {:8.1f}ms, {:6.2f}ms per name".format(count, elapsed * 1000,
+                                                                             elapsed * 1000 / count))
+
+        elapsed, _ = timed(link, lambda: [remote.get_song_title(i) for i in range(100)])
+        print("  100 song titles    {:8.1f}ms".format(elapsed * 1000))
+
+    # A lossy line: how many requests are lost, and what they cost
+    lossy = LinkModel(args.baud, args.latency, args.jitter, drop_rate=args.drop)
+    link, remote = connect(catalog, lossy, virtual, args.seed, timeout=0.2)
+    with link:
+        ok = timeouts = 0
+        for i in range(300):
+            try:
+                remote.get_song_title(i)
+                ok += 1
+            except TimeoutError:
+                timeouts += 1
+        stats = link.stats()
+    print("  lossy line ({:.2%} bytes dropped): {} ok, {} timed out, {} bytes dropped".format(
+        args.drop, ok, timeouts, stats['to_ipod']['dropped'] + stats['to_accessory']['dropped']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,119 @@
+"""
+Replays a wire capture into an emulator and a remote, to benchmark the decoder and handlers with a real session.
+
+    python benchmarks/replay_capture.py [--capture session.cap] [--speed N]
+
+The capture should be taken on the emulator side, with its stream wrapped in a `RecordingStream`. Without one, a
+session of browsing and track queries is recorded first. By default the capture is replayed as fast as possible.
+"""
+import argparse
+import os
+import random
+import socket
+import tempfile
+import threading
+
+from ipodproto.capture import Capture, CaptureWriter, RecordingStream, ReplayStream, READ, WRITE
+from ipodproto.catalog import CatalogBuilder
+from ipodproto.handlers.air import AdvancedRemote
+from ipodproto.handlers.ipod import IpodEmulator
+from ipodproto.metrics import Metrics
+from ipodproto.protocol import AirMode
+
+
+class SocketStream:
+    def __init__(self, sock):
+        self.sock = sock
+
+    def read(self, size=4096):
+        return self.sock.recv(size)
+
+    def write(self, data):
+        self.sock.sendall(data)
+
+
+def build_catalog(songs=2000, seed=0):
+    rng = random.Random(seed)
+    builder = CatalogBuilder("Replay")
+    for i in range(songs):
+        builder.add_song("Song {:05d}".format(i), "Artist {}".format(rng.randrange(100)),
+                         "Album {}".format(rng.randrange(200)), "Genre {}".format(rng.randrange(10)), None, 200000)
+    return builder.build()
+
+
+def record_session(path, catalog, requests=2000, seed=0):
+    rng = random.Random(seed)
+    ipod_sock, remote_sock = socket.socketpair()
+
+    with CaptureWriter(path) as writer:
+        emulator = IpodEmulator(RecordingStream(SocketStream(ipod_sock), writer), catalog=catalog)
+        remote = AdvancedRemote(SocketStream(remote_sock))
+        for handler in (emulator, remote):
+            threading.Thread(target=handler.run, daemon=True).start()
+
+        remote.handshake()
+        for _ in range(requests):
+            choice = rng.random()
+            if choice < 0.6:
+                remote.get_song_title(rng.randrange(catalog.count(AirMode.Types.SONG)))
+            elif choice < 0.9:
+                remote.get_item_count(rng.choice((AirMode.Types.ARTIST, AirMode.Types.ALBUM, AirMode.Types.SONG)))
+            else:
+                remote.get_item_names(AirMode.Types.SONG, rng.randrange(1000), 10)
+
+        emulator.stop()
+        remote.stop()
+        ipod_sock.shutdown(socket.SHUT_RDWR)
+        ipod_sock.close()
+        remote_sock.close()
+
+
+def report(name, stats, metrics):
+    frames = metrics.frames_in
+    print("{}: {} chunks, {} frames, {} bytes in {:.3f}s ({:.0f} frames/s, captured over {:.3f}s, "
+          "max lateness {:.1f}ms)".format(name, stats.chunks, frames, stats.bytes_in, stats.elapsed,
+                                          frames / stats.elapsed if stats.elapsed else 0, stats.captured_duration,
+                                          stats.max_lateness * 1000))
+    latency = metrics.snapshot()['latency']
+    for command, histogram in sorted(latency.items()):
+        print("  {}: {} x, p50 {:.1f}us, p99 {:.1f}us".format(command, histogram['count'], histogram['p50'] * 1e6,
+                                                             histogram['p99'] * 1e6))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--capture', help="a capture taken on the emulator side")
+    parser.add_argument('--speed', type=float, default=None, help="replay speed; as fast as possible if not given")
+    args = parser.parse_args()
+
+    catalog = build_catalog()
+    path = args.capture
+    if path is None:
+        fd, path = tempfile.mkstemp(suffix='.cap')
+        os.close(fd)
+        record_session(path, catalog)
+
+    try:
+        capture = Capture.load(path)
+        print("capture: {} records ({} read, {} written) over {:.3f}s".format(
+            len(capture.records), len(capture.direction(READ)), len(capture.direction(WRITE)), capture.duration))
+
+        # What the emulator received, back into an emulator
+        stream = ReplayStream(capture, READ, args.speed)
+        metrics = Metrics()
+        emulator = IpodEmulator(stream, catalog=catalog, metrics=metrics)
+        report("emulator", stream.replay(emulator), metrics)
+        emulator.stop()
+
+        # What the emulator sent, into a remote
+        stream = ReplayStream(capture, WRITE, args.speed)
+        metrics = Metrics()
+        remote = AdvancedRemote(stream, metrics=metrics)
+        report("remote", stream.replay(remote), metrics)
+    finally:
+        if args.capture is None:
+            os.remove(path)
+
+
+if __name__ == '__main__':
+    main()
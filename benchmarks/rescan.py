@@ -0,0 +1,96 @@
+"""
+Times an incremental rescan of a synthetic library against a full scan, then swaps the result into a live emulator in
+the middle of a listing.
+
+    python benchmarks/rescan.py [--files 5000] [--changes 0.01] [--baud 19200]
+
+The listing should finish with the names of the catalog it started on, and the next one should see the new catalog.
+"""
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+from indexer import generate
+from ipodproto.catalog import Catalog
+from ipodproto.handlers.air import AdvancedRemote
+from ipodproto.handlers.ipod import IpodEmulator
+from ipodproto.indexer import LibraryScanner
+from ipodproto.protocol import AirMode
+from ipodproto.sim import LinkModel, SimulatedLink
+
+
+def change_library(root, paths, fraction):
+    """
+    Removes, touches and adds about `fraction` of the files each.
+    """
+    step = max(1, int(1 / fraction))
+    for path in paths[::step]:
+        os.remove(path)
+    for path in paths[step // 2::step]:
+        with open(path, 'ab') as f:
+            f.write(b'\x00')
+    generate(os.path.join(root, 'New'), len(paths[::step]), seed=1)
+
+
+def swap_during_listing(old, new, baud, count):
+    link = SimulatedLink(LinkModel(baud))
+    emulator = IpodEmulator(link.ipod, catalog=old)
+    remote = AdvancedRemote(link.accessory, timeout=5)
+    link.start(emulator, remote)
+
+    with link:
+        listing = remote.get_item_names_async(AirMode.Types.SONG, 0, count)
+        # Swap once the listing has started, or the swap would happen before it, and it would list the new catalog
+        while not listing.received():
+            time.sleep(0.001)
+        emulator.swap_catalog(new)
+        # The swap happens before the next packet is handled
+        remote.get_ipod_type()
+        during = listing.result(timeout=30)
+        after = remote.get_item_names(AirMode.Types.SONG, 0, count)
+        version = emulator.catalog_version
+
+    return (during == old.names(AirMode.Types.SONG, 0, count), after == new.names(AirMode.Types.SONG, 0, count),
+            version)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--files', type=int, default=5000)
+    parser.add_argument('--changes', type=float, default=0.01, help="fraction of files removed, touched and added")
+    parser.add_argument('--baud', type=int, default=19200)
+    parser.add_argument('--listing', type=int, default=200, help="names in the listing the swap interrupts")
+    args = parser.parse_args()
+
+    root = tempfile.mkdtemp(prefix='ipodproto-library-')
+    try:
+        paths = generate(root, args.files)
+
+        scanner = LibraryScanner(root, "Benchmark")
+        builder, stats = scanner.scan()
+        old = Catalog.from_bytes(builder.to_bytes())
+        print("full scan:   {} songs, {} read in {:.2f}s".format(stats.songs, stats.read, stats.elapsed))
+
+        state = os.path.join(root, 'library.scan')
+        scanner.save(state)
+        scanner = LibraryScanner(root, "Benchmark")
+        scanner.load(state)
+        os.remove(state)
+
+        change_library(root, paths, args.changes)
+        builder, stats = scanner.scan()
+        new = Catalog.from_bytes(builder.to_bytes())
+        print("rescan:      {} songs, {} read, {} removed in {:.2f}s".format(stats.songs, stats.read, stats.removed,
+                                                                          stats.elapsed))
+
+        during, after, version = swap_during_listing(old, new, args.baud, args.listing)
+        print("hot swap:    listing in progress {} the old catalog, next listing {} the new one (version {})".format(
+            "kept" if during else "DID NOT KEEP", "saw" if after else "DID NOT SEE", version))
+    finally:
+        shutil.rmtree(root)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+"""
+Replays a high-rate Simple Remote button stream through an emulator, and reports how fast frames are decoded and
+turned into button presses and releases.
+
+    python benchmarks/simple_remote.py [--frames 200000] [--input capture.bin]
+
+The input is a raw byte stream as read from the serial port. Without one, a stream of single presses, chords and
+releases is generated.
+"""
+import argparse
+import random
+from time import perf_counter
+
+from ipodproto.handlers.ipod import IpodEmulator
+from ipodproto.protocol import IpodPacket, SimpleRemoteCommand, SimpleRemoteMode, MODE_SIMPLE_REMOTE, button_payload
+
+BUTTONS = [value for name, value in vars(SimpleRemoteMode.Buttons).items() if name.isupper()]
+
+
+def generate_stream(frames, seed=0):
+    """
+    Builds the bytes of a button stream: mostly single presses, some two and three button chords, each followed by
+    a release, with occasional repeated frames while a button is held.
+    """
+    rng = random.Random(seed)
+    packets = {}
+    data = bytearray()
+
+    def frame(mask):
+        packet = packets.get(mask)
+        if packet is None:
+            p = IpodPacket()
+            p.mode = MODE_SIMPLE_REMOTE
+            p.command = SimpleRemoteCommand()
+            p.command.id = button_payload(mask)
+            packet = packets[mask] = p.pack()
+        data.extend(packet)
+
+    written = 0
+    while written < frames:
+        mask = 0
+        for button in rng.sample(BUTTONS, rng.choice((1, 1, 1, 2, 3))):
+            mask |= button
+            frame(mask)
+            written += 1
+        for _ in range(rng.randrange(3)):
+            frame(mask)
+            written += 1
+        frame(0)
+        written += 1
+
+    return bytes(data), written
+
+
+class CountingEmulator(IpodEmulator):
+    def __init__(self):
+        super().__init__(None)
+        self.presses = 0
+        self.releases = 0
+
+    def on_button_down(self, button):
+        self.presses += 1
+        super().on_button_down(button)
+
+    def on_button_up(self, button):
+        self.releases += 1
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--frames', type=int, default=200000)
+    parser.add_argument('--input', help="a raw captured byte stream to replay")
+    parser.add_argument('--chunk', type=int, default=4096, help="bytes fed to the decoder at a time")
+    args = parser.parse_args()
+
+    if args.input:
+        with open(args.input, 'rb') as f:
+            data = f.read()
+        frames = None
+    else:
+        data, frames = generate_stream(args.frames)
+
+    emulator = CountingEmulator()
+    start = perf_counter()
+    for i in range(0, len(data), args.chunk):
+        emulator.handler.feed(data[i:i + args.chunk])
+    elapsed = perf_counter() - start
+
+    frames = frames or emulator.presses + emulator.releases
+    print("{} bytes, {} frames in {:.3f}s: {:.0f} frames/s, {:.2f} us/frame".format(
+        len(data), frames, elapsed, frames / elapsed, elapsed / frames * 1e6))
+    print("  {} presses, {} releases".format(emulator.presses, emulator.releases))
+
+    # The state change itself, without the framing
+    masks = [0] * 1000
+    rng = random.Random(1)
+    for i in range(0, len(masks), 2):
+        masks[i] = rng.choice(BUTTONS) | rng.choice(BUTTONS)
+    start = perf_counter()
+    for _ in range(100):
+        for mask in masks:
+            emulator.handle_button_state(mask)
+    elapsed = perf_counter() - start
+    print("  handle_button_state alone: {:.2f} us/frame".format(elapsed / (100 * len(masks)) * 1e6))
+
+
+if __name__ == '__main__':
+    main()
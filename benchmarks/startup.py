@@ -0,0 +1,135 @@
+"""
+Measures cold start: import time of the package and its modules, from `-X importtime`, and the time from interpreter
+start to the first packet sent and the first response decoded by an `AdvancedRemote`.
+
+    python benchmarks/startup.py [--repeat 5] [--scale 1.0] [--check]
+
+Each measurement is the best of `--repeat` fresh interpreters. With `--check` it exits with an error if anything is
+over its budget, or if a module which should only be imported on demand was imported anyway.
+"""
+import argparse
+import os
+import subprocess
+import sys
+
+# Milliseconds, on a desktop class machine. Use --scale for slower hosts.
+BUDGETS = {
+    'import ipodproto': 5.0,
+    'import ipodproto.protocol': 30.0,
+    'import ipodproto.handlers.air': 40.0,
+    'import ipodproto.handlers.ipod': 40.0,
+    'first packet': 50.0,
+}
+
+# Modules which are slow to import and only needed by optional features
+LAZY_MODULES = ('asyncio', 'concurrent.futures', 'logging', 'ipodproto.handlers.ipod', 'ipodproto.tracing',
+                'ipodproto.metrics')
+
+FIRST_PACKET = """
+import sys
+from time import perf_counter
+start = perf_counter()
+
+from ipodproto.handlers.air import AdvancedRemote
+
+
+class Stream:
+    def read(self, size=4096):
+        return b''
+
+    def write(self, data):
+        pass
+
+
+remote = AdvancedRemote(Stream())
+remote.switch_mode()
+remote.handler.feed(bytes.fromhex(sys.argv[1]))
+print((perf_counter() - start) * 1000)
+print(','.join(sorted(sys.modules)))
+"""
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _environment():
+    env = dict(os.environ)
+    env['PYTHONPATH'] = ROOT + os.pathsep + env.get('PYTHONPATH', '') if env.get('PYTHONPATH') else ROOT
+    # Compile once up front, so bytecode compilation isn't counted
+    env.pop('PYTHONDONTWRITEBYTECODE', None)
+    return env
+
+
+def import_time(module, env):
+    """
+    :return: The cumulative import time of a module in milliseconds, as reported by `-X importtime`.
+    """
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import ' + module], env=env,
+                            stderr=subprocess.PIPE, universal_newlines=True, check=True)
+    for line in result.stderr.splitlines():
+        fields = [f.strip() for f in line.split('|')]
+        if len(fields) == 3 and fields[2] == module:
+            return int(fields[1]) / 1000
+    raise RuntimeError("No import time reported for " + module)
+
+
+def _response_frame():
+    from ipodproto.protocol import AirCommand, AirMode, IpodPacket, MODE_ADVANCED_REMOTE
+
+    packet = IpodPacket()
+    packet.mode = MODE_ADVANCED_REMOTE
+    packet.command = AirCommand()
+    packet.command.id = AirMode.Commands.RES_IPOD_TYPE
+    packet.command.parameters = 0x0014
+    return packet.pack().hex()
+
+
+def first_packet(env, frame):
+    """
+    :return: The milliseconds from the start of a script to its first response decoded, and the modules it imported.
+    """
+    result = subprocess.run([sys.executable, '-c', FIRST_PACKET, frame], env=env, stdout=subprocess.PIPE,
+                            universal_newlines=True, check=True)
+    elapsed, modules = result.stdout.splitlines()
+    return float(elapsed), set(modules.split(','))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--repeat', type=int, default=5, help="fresh interpreters per measurement")
+    parser.add_argument('--scale', type=float, default=1.0, help="multiplies every budget")
+    parser.add_argument('--check', action='store_true', help="exit with an error if over budget")
+    args = parser.parse_args()
+
+    env = _environment()
+    sys.path.insert(0, ROOT)
+    subprocess.run([sys.executable, '-m', 'compileall', '-q', os.path.join(ROOT, 'ipodproto')], check=True)
+
+    times = {}
+    for name in BUDGETS:
+        if name.startswith('import '):
+            times[name] = min(import_time(name[len('import '):], env) for _ in range(args.repeat))
+
+    frame = _response_frame()
+    runs = [first_packet(env, frame) for _ in range(args.repeat)]
+    times['first packet'] = min(elapsed for elapsed, _ in runs)
+    eager = sorted(module for module in LAZY_MODULES if module in runs[0][1])
+
+    failures = []
+    for name, elapsed in times.items():
+        budget = BUDGETS[name] * args.scale
+        flag = ''
+        if elapsed > budget:
+            flag = '  OVER BUDGET'
+            failures.append(name)
+        print("{:<32} {:8.1f}ms  (budget {:.1f}ms){}".format(name, elapsed, budget, flag))
+
+    if eager:
+        print("imported before first packet: " + ', '.join(eager))
+        failures.extend(eager)
+
+    if args.check and failures:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
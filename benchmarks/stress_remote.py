@@ -0,0 +1,177 @@
+"""
+Stress test for concurrent use of one AdvancedRemote: many threads make requests against an emulated iPod at once,
+every response is checked against the emulator's own answer, and the aggregate request rate is reported.
+
+    python benchmarks/stress_remote.py [--threads 16] [--requests 500] [--songs 5000] [--stalls 5]
+
+A last run stalls the emulator now and then for a little longer than the timeout, while other threads keep sending,
+so that requests time out with others still in flight. Each request which times out may only take one other
+request down with it.
+"""
+import argparse
+import random
+import socket
+import sys
+import threading
+import time
+from time import monotonic
+
+from ipodproto.catalog import CatalogBuilder
+from ipodproto.handlers.air import AdvancedRemote
+from ipodproto.handlers.ipod import IpodEmulator
+from ipodproto.protocol import AirMode
+
+
+def build_catalog(songs, seed=0):
+    rng = random.Random(seed)
+    builder = CatalogBuilder("Stress Test")
+    for i in range(songs):
+        builder.add_song("Song {:06d}".format(i), "Artist {}".format(rng.randrange(songs // 20 + 1)),
+                         "Album {}".format(rng.randrange(songs // 10 + 1)), "Genre {}".format(rng.randrange(20)),
+                         None, rng.randrange(60000, 400000))
+    return builder.build()
+
+
+class SocketStream:
+    def __init__(self, sock):
+        self.sock = sock
+
+    def read(self, size=4096):
+        return self.sock.recv(size)
+
+    def write(self, data):
+        self.sock.sendall(data)
+
+
+class StallingEmulator(IpodEmulator):
+    """
+    Answers a few song title requests late, holding up everything behind them as a slow iPod would.
+    """
+
+    def __init__(self, *args, stall, stalls, interval, **kwargs):
+        """
+        :param stall: How long each stall lasts, in seconds.
+        :param stalls: How many times to stall.
+        :param interval: The least time between stalls, so that late responses aren't taken as lost.
+        """
+        super().__init__(*args, **kwargs)
+        self.stall = stall
+        self.stalls = stalls
+        self.interval = interval
+        self._next_stall = monotonic() + interval
+
+    def handle_get_song_title_command(self, number):
+        if self.stalls and monotonic() >= self._next_stall:
+            self.stalls -= 1
+            time.sleep(self.stall)
+            self._next_stall = monotonic() + self.interval
+
+        super().handle_get_song_title_command(number)
+
+
+def connect(catalog, timeout, stall=None, stalls=0):
+    ipod_sock, remote_sock = socket.socketpair()
+    if stall is None:
+        emulator = IpodEmulator(SocketStream(ipod_sock), catalog=catalog)
+    else:
+        emulator = StallingEmulator(SocketStream(ipod_sock), catalog=catalog, stall=stall, stalls=stalls,
+                                    interval=2 * timeout)
+    remote = AdvancedRemote(SocketStream(remote_sock), timeout=timeout)
+
+    for handler in (emulator, remote):
+        threading.Thread(target=handler.run, daemon=True).start()
+
+    return emulator, remote, (ipod_sock, remote_sock)
+
+
+def worker(remote, emulator, requests, seed, results, timeout, pause=0):
+    rng = random.Random(seed)
+    song_count = emulator.catalog.count(AirMode.Types.SONG)
+    types = [AirMode.Types.PLAYLIST, AirMode.Types.ARTIST, AirMode.Types.ALBUM, AirMode.Types.GENRE,
+             AirMode.Types.SONG]
+    # Requests which failed before their own timeout was up, because a late response may have been theirs
+    ok = wrong = failed = early = 0
+
+    for _ in range(requests):
+        if pause:
+            time.sleep(rng.uniform(0, pause))
+        sent = monotonic()
+        try:
+            if rng.random() < 0.75:
+                index = rng.randrange(song_count)
+                good = remote.get_song_title(index) == emulator.get_song_title(index)
+            else:
+                type = rng.choice(types)
+                good = remote.get_item_count(type) == emulator.get_item_count(type)
+        except Exception:
+            failed += 1
+            if monotonic() - sent < timeout:
+                early += 1
+            continue
+
+        if good:
+            ok += 1
+        else:
+            wrong += 1
+
+    results.append((ok, wrong, failed, early))
+
+
+def run(threads, requests, songs, timeout, stall=None, stalls=0):
+    emulator, remote, sockets = connect(build_catalog(songs), timeout, stall, stalls)
+    results = []
+    # With stalls, requests are spread out so that some are sent while others are held up
+    pause = timeout / 2 if stall is not None else 0
+    workers = [threading.Thread(target=worker, args=(remote, emulator, requests, seed, results, timeout, pause))
+               for seed in range(threads)]
+
+    start = monotonic()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    elapsed = monotonic() - start
+
+    ok, wrong, failed, early = (sum(r[i] for r in results) for i in range(4))
+    total = ok + wrong + failed
+
+    print("{} threads x {} requests{}: {:.2f}s, {:.0f} requests/s".format(
+        threads, requests, ", {} stalls of {:.0f}ms".format(stalls, stall * 1000) if stall is not None else '',
+        elapsed, total / elapsed))
+    print("  correct {}, wrong {}, failed {} ({} early), timeouts {}, late responses {}".format(
+        ok, wrong, failed, early, remote.waiter_timeouts, remote.late_responses))
+
+    emulator.stop()
+    remote.stop()
+    for sock in sockets:
+        sock.shutdown(socket.SHUT_RDWR)
+        sock.close()
+
+    if stall is not None:
+        return wrong == 0 and early <= failed - early
+    return wrong == 0 and failed == 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--threads', type=int, default=16)
+    parser.add_argument('--requests', type=int, default=500, help="requests per thread")
+    parser.add_argument('--songs', type=int, default=5000)
+    parser.add_argument('--timeout', type=float, default=2)
+    parser.add_argument('--stalls', type=int, default=5, help="stalls in the last run")
+    parser.add_argument('--stall-timeout', type=float, default=0.2, help="timeout for the last run")
+    args = parser.parse_args()
+
+    # A single thread first, for a baseline
+    passed = run(1, args.requests, args.songs, args.timeout)
+    passed = run(args.threads, args.requests, args.songs, args.timeout) and passed
+    # Each stall is a little longer than the timeout, so the request it holds up times out just before its response
+    # arrives, while requests sent during the stall are still waiting for theirs
+    passed = run(args.threads, args.requests // 10, args.songs, args.stall_timeout, args.stall_timeout * 1.1,
+                 args.stalls) and passed
+
+    sys.exit(0 if passed else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,2 +1,10 @@
-from ipodproto import protocol, handlers
+import importlib
+
 __all__ = ['protocol', 'handlers']
+
+
+def __getattr__(name):
+    # Submodules are imported on first use, so importing the package alone is cheap
+    if name in __all__:
+        return importlib.import_module('.' + name, __name__)
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
@@ -0,0 +1,376 @@
+"""
+A bridge which lets several local processes share one `AdvancedRemote`, and so one serial port, over a Unix socket.
+
+Clients send one JSON object per line, `{"id": 1, "method": "get_song_title", "args": [12]}`, and get back
+`{"id": 1, "result": "..."}` or `{"id": 1, "error": "CommandFailed", "message": "..."}`. Identical queries which are
+in flight at the same time are sent to the iPod once, and every caller gets the same answer. A client which calls
+`subscribe` is also sent `{"event": "poll", "elapsed": ms}` for each poll update, coalesced if it falls behind.
+"""
+import json
+import os
+import socket
+import stat
+import threading
+from itertools import count
+
+from .events import COALESCE, PollUpdate
+from .handlers.air import AdvancedRemote, CommandFailed, CommandNotUnderstood, IpodException, RequestCancelled
+
+# Method -> whether identical concurrent calls can share one request. Queries can; commands each have an effect.
+METHODS = {
+    'get_ipod_type': True,
+    'get_ipod_name': True,
+    'get_item_count': True,
+    'get_item_names': True,
+    'get_time_status_info': True,
+    'get_playlist_position': True,
+    'get_playlist_size': True,
+    'get_song_title': True,
+    'get_song_artist': True,
+    'get_song_album': True,
+    'get_shuffle_mode': True,
+    'get_repeat_mode': True,
+    'get_screen_size': True,
+    'play_pause': False,
+    'stop_playing': False,
+    'skip_forward': False,
+    'skip_backward': False,
+    'start_fastforward': False,
+    'start_rewind': False,
+    'stop_ff_rw': False,
+    'jump_to_song': False,
+}
+
+# Methods which hold the burst lock while they run: listings, and every command, since each one changes the iPod's
+# state and so makes it abandon the listing in progress
+BURST_METHODS = frozenset(['get_item_names'] + [method for method, shared in METHODS.items() if not shared])
+
+# Results which are tuples, but arrive as JSON lists
+TUPLE_RESULTS = {'get_time_status_info', 'get_screen_size'}
+
+ERRORS = {cls.__name__: cls for cls in (IpodException, CommandNotUnderstood, CommandFailed, RequestCancelled,
+                                        TimeoutError)}
+
+
+class BridgeError(Exception):
+    pass
+
+
+class _Call:
+    """
+    A request in flight, which later identical requests wait on instead of sending their own.
+    """
+
+    def __init__(self):
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class Coalescer:
+    """
+    Runs calls so that identical ones which overlap in time only run once.
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+        self.calls = 0
+        self.coalesced = 0
+
+    def call(self, key, func, *args):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+                self.calls += 1
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            call.done.wait()
+        else:
+            try:
+                call.result = func(*args)
+            except Exception as e:
+                call.error = e
+            finally:
+                # Anyone arriving from now on asks again, since the answer may have changed
+                with self._lock:
+                    del self._calls[key]
+                call.done.set()
+
+        if call.error is not None:
+            raise call.error
+        return call.result
+
+
+class _Client:
+    def __init__(self, server, sock):
+        self.server = server
+        self.sock = sock
+        self.subscription = None
+        self._write_lock = threading.Lock()
+
+    def send(self, message) -> None:
+        data = (json.dumps(message) + '\n').encode('utf-8')
+        with self._write_lock:
+            self.sock.sendall(data)
+
+    def on_poll_update(self, event) -> None:
+        try:
+            self.send({'event': 'poll', 'elapsed': event.elapsed})
+        except OSError:
+            pass
+
+    def serve(self) -> None:
+        try:
+            with self.sock.makefile('rb') as lines:
+                for line in lines:
+                    if line.strip():
+                        self.send(self.server.handle(self, line))
+        except (OSError, ValueError):
+            pass
+        finally:
+            self.close()
+
+    def close(self) -> None:
+        if self.subscription is not None:
+            self.server.remote.events.unsubscribe(self.subscription)
+            self.subscription = None
+        self.server._disconnected(self)
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+
+
+class BridgeServer:
+    """
+    Serves an `AdvancedRemote` to local clients on a Unix socket, one thread per client.
+    """
+
+    def __init__(self, remote: AdvancedRemote, path: str, backlog: int = 16):
+        """
+        :param remote: The remote to share. It should already be running. It needs an event bus to fan out poll
+        updates.
+        :param path: The socket path. A stale socket left at the path is replaced.
+        """
+        self.remote = remote
+        self.path = path
+        self.coalescer = Coalescer()
+        self.requests = 0
+
+        # The iPod only lists one range at a time, and abandons it for any command which changes its state, so
+        # listings from different clients take turns with each other and with every command
+        self._burst_lock = threading.Lock()
+        self._clients = set()
+        self._clients_lock = threading.Lock()
+        self._closed = False
+
+        if os.path.exists(path) and stat.S_ISSOCK(os.stat(path).st_mode):
+            os.unlink(path)
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.bind(path)
+        self._sock.listen(backlog)
+        self._thread = None
+
+    def start(self) -> None:
+        """
+        Accepts clients on a background thread until `close()`.
+        """
+        self._thread = threading.Thread(target=self.serve_forever, name='ipodproto-bridge', daemon=True)
+        self._thread.start()
+
+    def serve_forever(self) -> None:
+        while not self._closed:
+            try:
+                sock, _ = self._sock.accept()
+            except OSError:
+                break
+            client = _Client(self, sock)
+            with self._clients_lock:
+                self._clients.add(client)
+            threading.Thread(target=client.serve, name='ipodproto-bridge-client', daemon=True).start()
+
+    def _disconnected(self, client):
+        with self._clients_lock:
+            self._clients.discard(client)
+
+    def _call(self, method, args):
+        func = getattr(self.remote, method)
+        if method in BURST_METHODS:
+            with self._burst_lock:
+                return func(*args)
+        return func(*args)
+
+    def call(self, method: str, *args):
+        """
+        Calls a method of the remote, sharing the request with identical calls already in flight.
+        """
+        if method not in METHODS:
+            raise BridgeError("Unknown method: {}".format(method))
+        self.requests += 1
+        if METHODS[method]:
+            return self.coalescer.call((method,) + args, self._call, method, args)
+        return self._call(method, args)
+
+    def handle(self, client: _Client, line: bytes) -> dict:
+        """
+        :return: The response to one request line.
+        """
+        request_id = None
+        try:
+            request = json.loads(line.decode('utf-8'))
+            request_id = request.get('id')
+            method = request['method']
+            args = tuple(request.get('args', ()))
+
+            if method == 'subscribe':
+                if self.remote.events is None:
+                    raise BridgeError("The remote has no event bus to take poll updates from")
+                if client.subscription is None:
+                    client.subscription = self.remote.subscribe(PollUpdate, client.on_poll_update, maxsize=1,
+                                                                policy=COALESCE, name='bridge client')
+                return {'id': request_id, 'result': None}
+
+            return {'id': request_id, 'result': self.call(method, *args)}
+        except Exception as e:
+            return {'id': request_id, 'error': type(e).__name__, 'message': str(e)}
+
+    def stats(self) -> dict:
+        return {
+            'clients': len(self._clients),
+            'requests': self.requests,
+            'sent': self.coalescer.calls,
+            'coalesced': self.coalescer.coalesced,
+        }
+
+    def close(self) -> None:
+        self._closed = True
+        try:
+            self._sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self._sock.close()
+        with self._clients_lock:
+            clients = list(self._clients)
+        for client in clients:
+            try:
+                client.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        if self._thread is not None:
+            self._thread.join()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class BridgeClient:
+    """
+    Calls an `AdvancedRemote` through a `BridgeServer`. Safe to use from several threads; remote methods in
+    `METHODS` can be called directly on the client.
+    """
+
+    def __init__(self, path: str, timeout: float = 5.0, on_poll_update=None):
+        """
+        :param timeout: How long to wait for each response, in seconds.
+        :param on_poll_update: Called with the elapsed time of each poll update, on the client's reader thread. Poll
+        updates are only sent once `subscribe()` has been called.
+        """
+        self.timeout = timeout
+        self.on_poll_update = on_poll_update
+
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.connect(path)
+        self._ids = count(1)
+        # Request id -> [done, response]
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+
+        self._reader = threading.Thread(target=self._read, name='ipodproto-bridge-reader', daemon=True)
+        self._reader.start()
+
+    def _read(self):
+        try:
+            with self._sock.makefile('rb') as lines:
+                for line in lines:
+                    message = json.loads(line.decode('utf-8'))
+                    if 'event' in message:
+                        if message['event'] == 'poll' and self.on_poll_update is not None:
+                            self.on_poll_update(message['elapsed'])
+                        continue
+
+                    with self._lock:
+                        pending = self._pending.pop(message.get('id'), None)
+                    if pending is not None:
+                        pending[1] = message
+                        pending[0].set()
+        except (OSError, ValueError):
+            pass
+        finally:
+            # Wake everybody still waiting
+            with self._lock:
+                pending, self._pending = self._pending, {}
+            for done, _ in pending.values():
+                done.set()
+
+    def call(self, method: str, *args):
+        request_id = next(self._ids)
+        pending = [threading.Event(), None]
+        with self._lock:
+            self._pending[request_id] = pending
+
+        data = (json.dumps({'id': request_id, 'method': method, 'args': args}) + '\n').encode('utf-8')
+        with self._write_lock:
+            self._sock.sendall(data)
+
+        if not pending[0].wait(self.timeout):
+            with self._lock:
+                self._pending.pop(request_id, None)
+            raise TimeoutError("No response from the bridge to {}".format(method))
+
+        response = pending[1]
+        if response is None:
+            raise BridgeError("Connection to the bridge closed")
+        if 'error' in response:
+            raise ERRORS.get(response['error'], BridgeError)(response['message'])
+
+        result = response['result']
+        if method in TUPLE_RESULTS:
+            result = tuple(result)
+        return result
+
+    def subscribe(self) -> None:
+        """
+        Starts poll updates being sent to `on_poll_update`.
+        """
+        self.call('subscribe')
+
+    def __getattr__(self, name):
+        if name not in METHODS:
+            raise AttributeError(name)
+        return lambda *args: self.call(name, *args)
+
+    def close(self) -> None:
+        try:
+            self._sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self._sock.close()
+        self._reader.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,171 @@
+"""
+Hierarchical browsing of a `Catalog`, as driven by the SWITCH_ITEM and SWITCH_MAIN_PLAYLIST commands.
+"""
+from array import array
+from bisect import bisect_left
+
+from .catalog import MAIN_PLAYLIST, SONG_KEY_TYPES
+from .protocol import AirMode
+
+# Selecting an item narrows every type below it, and clears any selection at its own level or below
+BROWSE_LEVELS = {
+    AirMode.Types.PLAYLIST: 0,
+    AirMode.Types.GENRE: 1,
+    AirMode.Types.ARTIST: 2,
+    AirMode.Types.COMPOSER: 2,
+    AirMode.Types.ALBUM: 3,
+    AirMode.Types.SONG: 4,
+}
+
+
+def _contains(sorted_items, item):
+    i = bisect_left(sorted_items, item)
+    return i < len(sorted_items) and sorted_items[i] == item
+
+
+def intersect(lists):
+    """
+    Intersects sorted sequences of indices by probing the larger ones for each item of the smallest.
+    :param lists: Sorted sequences of unique indices.
+    :return: A sorted `array` of the indices present in every list.
+    """
+    lists = sorted(lists, key=len)
+    smallest, others = lists[0], lists[1:]
+
+    return array('I', (item for item in smallest if all(_contains(other, item) for other in others)))
+
+
+class PlaylistSongs:
+    """
+    The songs at some positions of a playlist, in playlist order, looked up as they are needed.
+    """
+
+    def __init__(self, members, positions):
+        """
+        :param members: The songs of the playlist, in order.
+        :param positions: Sorted positions in the playlist.
+        """
+        self.members = members
+        self.positions = positions
+
+    def __len__(self):
+        return len(self.positions)
+
+    def __getitem__(self, index):
+        return self.members[self.positions[index]]
+
+    def __iter__(self):
+        return map(self.members.__getitem__, self.positions)
+
+
+class BrowseState:
+    """
+    The current browse selection. Each type's view is the list of catalog indices which are visible to the
+    accessory for that type, given the selections made above it; wire indices are positions in that view.
+    """
+
+    def __init__(self, catalog):
+        self.catalog = catalog
+
+        # Type -> catalog index of the selected item
+        self.selection = {}
+        self._views = {}
+
+    def reset(self):
+        """
+        Clears the selection, so every type shows the whole library.
+        """
+        self.selection = {}
+        self._views = {}
+
+    def select(self, type, number):
+        """
+        Selects an item, narrowing the views of every type below it.
+        :param type: The type of the item.
+        :param number: The index of the item in the current view of that type.
+        :return: False, leaving the selection as it was, if there is no such item.
+        """
+        view = self.view(type)
+        if not 0 <= number < len(view):
+            return False
+
+        index = view[number]
+        level = BROWSE_LEVELS[type]
+
+        self.selection = {t: i for t, i in self.selection.items() if BROWSE_LEVELS[t] < level}
+        if not (type == AirMode.Types.PLAYLIST and index == MAIN_PLAYLIST):
+            self.selection[type] = index
+        self._views = {}
+        return True
+
+    def selected(self, type):
+        """
+        :return: The catalog index of the selected item of the given type, or None.
+        """
+        return self.selection.get(type)
+
+    def view(self, type):
+        """
+        :return: A sequence of the catalog indices visible for the given type, in wire order. Unknown types have
+        nothing in them.
+        """
+        if type not in BROWSE_LEVELS:
+            return range(0)
+
+        view = self._views.get(type)
+        if view is None:
+            view = self._views[type] = self._build_view(type)
+
+        return view
+
+    def count(self, type):
+        return len(self.view(type))
+
+    def item(self, type, number):
+        """
+        :return: The catalog index of the item at the given position in the current view.
+        """
+        return self.view(type)[number]
+
+    def name(self, type, number):
+        return self.catalog.name(type, self.view(type)[number])
+
+    def names(self, type, start, length):
+        view = self.view(type)
+        return [self.catalog.name(type, view[i]) for i in range(start, min(start + length, len(view)))]
+
+    def _build_view(self, type):
+        level = BROWSE_LEVELS[type]
+        filters = [(t, i) for t, i in self.selection.items() if BROWSE_LEVELS[t] < level]
+        playlist = self.selection.get(AirMode.Types.PLAYLIST) if level > 0 else None
+        keys = [(t, i) for t, i in filters if t in SONG_KEY_TYPES]
+
+        if not filters:
+            return range(self.catalog.count(type))
+
+        if type != AirMode.Types.SONG and len(keys) <= 1:
+            # A playlist, a single selection, or a selection within a playlist is a precomputed relation
+            if not keys:
+                return self.catalog.related(AirMode.Types.PLAYLIST, playlist, type)
+            (key_type, index), = keys
+            return self.catalog.related(key_type, index, type, playlist=playlist)
+
+        songs = self._songs(playlist, keys)
+        if type == AirMode.Types.SONG:
+            return songs
+
+        song_keys = self.catalog.song_keys[type]
+        return array('I', sorted({song_keys[song] for song in songs}))
+
+    def _songs(self, playlist, keys):
+        if playlist is None:
+            postings = [self.catalog.songs_with(t, i) for t, i in keys]
+            return postings[0] if len(postings) == 1 else intersect(postings)
+
+        # Playlists keep their own order, so selections within one are intersected as positions in it
+        members = self.catalog.playlist_songs(playlist)
+        if not keys:
+            return members
+
+        postings = [self.catalog.playlist_positions(playlist, t, i) for t, i in keys]
+        return PlaylistSongs(members, postings[0] if len(postings) == 1 else intersect(postings))
@@ -0,0 +1,53 @@
+"""
+A bounded cache of fully-framed responses, so that repeated queries can be answered without repacking anything.
+"""
+from collections import OrderedDict
+from threading import Lock
+
+
+class ResponseCache:
+    """
+    A least-recently-used mapping of request keys to the packed bytes that were sent in response. Keys should
+    include a state version, so that entries become unreachable as soon as the state they were built from changes.
+    """
+
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """
+        :param key: The request key.
+        :return: The cached response bytes, or None.
+        """
+        with self._lock:
+            data = self._entries.get(key)
+            if data is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._entries.move_to_end(key)
+            return data
+
+    def put(self, key, data):
+        """
+        Stores a response, evicting the least recently used one if the cache is full.
+        :param key: The request key.
+        :param data: The packed response bytes.
+        """
+        with self._lock:
+            self._entries[key] = data
+            self._entries.move_to_end(key)
+            if len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
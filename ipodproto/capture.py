@@ -0,0 +1,237 @@
+"""
+Timestamped wire captures, and replaying them into a handler, for reproducing field issues offline and benchmarking
+the decoder and handlers with real sessions.
+
+A capture file is a header followed by one record per read or write:
+
+- header: `<8sHxxd` magic, version, and the wall clock time the capture started
+- record: `<BQI` direction, nanoseconds since the capture started, and length, followed by the raw bytes
+"""
+import struct
+from collections import namedtuple
+from threading import Lock, Event
+from time import sleep, time
+
+try:
+    from time import monotonic
+except ImportError:
+    from time import time as monotonic
+
+CAPTURE_MAGIC = b'IPODCAP\x00'
+CAPTURE_VERSION = 1
+
+HEADER = struct.Struct('<8sHxxd')
+RECORD = struct.Struct('<BQI')
+
+# Bytes the captured handler read, and bytes it wrote
+READ = 0
+WRITE = 1
+
+CaptureRecord = namedtuple('CaptureRecord', ['direction', 'timestamp', 'data'])
+
+
+class CaptureError(Exception):
+    pass
+
+
+class CaptureWriter:
+    """
+    Appends records to a capture file. Safe to use from the reading and writing threads at once.
+    """
+
+    def __init__(self, file, clock=monotonic):
+        """
+        :param file: A binary file object, or a path to create.
+        :param clock: A function returning the current time in seconds.
+        """
+        self._owns_file = isinstance(file, str)
+        self.file = open(file, 'wb') if self._owns_file else file
+        self.clock = clock
+        self.records = 0
+
+        self._start = clock()
+        self._lock = Lock()
+        self.file.write(HEADER.pack(CAPTURE_MAGIC, CAPTURE_VERSION, time()))
+
+    def write(self, direction: int, data: bytes) -> None:
+        elapsed = int((self.clock() - self._start) * 1e9)
+        with self._lock:
+            self.file.write(RECORD.pack(direction, elapsed, len(data)))
+            self.file.write(data)
+            self.records += 1
+
+    def flush(self) -> None:
+        with self._lock:
+            self.file.flush()
+
+    def close(self) -> None:
+        with self._lock:
+            if self._owns_file:
+                self.file.close()
+            else:
+                self.file.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class RecordingStream:
+    """
+    Wraps a stream passed to an `IpodProtocolHandler`, recording everything read from and written to it.
+    """
+
+    def __init__(self, stream, writer: CaptureWriter):
+        self.stream = stream
+        self.writer = writer
+
+    def read(self, *args, **kwargs):
+        data = self.stream.read(*args, **kwargs)
+        if data:
+            self.writer.write(READ, data)
+        return data
+
+    def write(self, data, *args, **kwargs):
+        self.writer.write(WRITE, bytes(data))
+        return self.stream.write(data, *args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+def read_records(file):
+    """
+    Reads the records of a capture one at a time.
+    :param file: A binary file object positioned at the start of the capture.
+    :return: A generator of `CaptureRecord`s, with timestamps in seconds.
+    """
+    header = file.read(HEADER.size)
+    if len(header) < HEADER.size:
+        raise CaptureError("Not a capture file: too short")
+    magic, version, _ = HEADER.unpack(header)
+    if magic != CAPTURE_MAGIC:
+        raise CaptureError("Not a capture file: bad magic {!r}".format(magic))
+    if version != CAPTURE_VERSION:
+        raise CaptureError("Unsupported capture version {}".format(version))
+
+    while True:
+        head = file.read(RECORD.size)
+        if not head:
+            return
+        if len(head) < RECORD.size:
+            raise CaptureError("Truncated record header")
+
+        direction, timestamp, length = RECORD.unpack(head)
+        data = file.read(length)
+        if len(data) < length:
+            raise CaptureError("Truncated record")
+
+        yield CaptureRecord(direction, timestamp / 1e9, data)
+
+
+class Capture:
+    """
+    A capture loaded into memory.
+    """
+
+    def __init__(self, records, started=None):
+        self.records = records
+        self.started = started
+
+    @classmethod
+    def load(cls, path: str) -> 'Capture':
+        with open(path, 'rb') as f:
+            started = HEADER.unpack(f.read(HEADER.size))[2]
+            f.seek(0)
+            return cls(list(read_records(f)), started)
+
+    @property
+    def duration(self) -> float:
+        return self.records[-1].timestamp - self.records[0].timestamp if self.records else 0.0
+
+    def direction(self, direction: int):
+        """
+        :return: The records in one direction.
+        """
+        return [record for record in self.records if record.direction == direction]
+
+
+ReplayStats = namedtuple('ReplayStats', ['chunks', 'bytes_in', 'bytes_out', 'elapsed', 'captured_duration',
+                                         'max_lateness'])
+
+
+class ReplayStream:
+    """
+    A stream which plays back one direction of a capture to the handler reading from it, at the captured pace, a
+    multiple of it, or as fast as possible. Anything the handler writes is counted and discarded.
+    """
+
+    def __init__(self, capture: Capture, direction: int = READ, speed: float = 1.0, clock=monotonic,
+                 sleep=sleep):
+        """
+        :param capture: The capture to play back.
+        :param direction: Which records to play back. READ replays what the captured handler received, so the
+        replaying handler should be the same kind; WRITE replays what it sent, to a handler of the opposite kind.
+        :param speed: How many times faster than captured to play back, or None for as fast as possible.
+        :param clock: A function returning the current time in seconds.
+        :param sleep: A function which sleeps for a number of seconds.
+        """
+        self.records = capture.direction(direction)
+        self.speed = speed
+        self.clock = clock
+        self.sleep = sleep
+
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.max_lateness = 0.0
+        self.finished = Event()
+
+        self._next = 0
+        self._started = None
+        self._handler = None
+
+    def read(self, *args, **kwargs) -> bytes:
+        if self._started is None:
+            self._started = self.clock()
+
+        if self._next >= len(self.records):
+            self.finished.set()
+            if self._handler is not None:
+                self._handler.stop()
+            return b''
+
+        record = self.records[self._next]
+        self._next += 1
+
+        if self.speed:
+            due = self._started + (record.timestamp - self.records[0].timestamp) / self.speed
+            wait = due - self.clock()
+            if wait > 0:
+                self.sleep(wait)
+            else:
+                self.max_lateness = max(self.max_lateness, -wait)
+
+        self.bytes_in += len(record.data)
+        return record.data
+
+    def write(self, data, *args, **kwargs) -> None:
+        self.bytes_out += len(data)
+
+    def replay(self, handler) -> ReplayStats:
+        """
+        Runs a handler which reads from this stream until the capture is exhausted.
+        :param handler: An `IpodProtocolHandler` constructed with this stream.
+        :return: The replay statistics.
+        """
+        if handler.stream is not self:
+            raise ValueError("The handler must read from this stream")
+
+        self._handler = handler
+        started = self.clock()
+        handler.run()
+
+        return ReplayStats(self._next, self.bytes_in, self.bytes_out, self.clock() - started,
+                           self.records[-1].timestamp - self.records[0].timestamp if self.records else 0.0,
+                           self.max_lateness)
@@ -0,0 +1,600 @@
+"""
+A columnar music catalog which can be served directly by `IpodEmulator`.
+
+Every item type is stored as a string table (an array of offsets into a single UTF-8 blob), and every song has an
+integer foreign key into the artist, album, genre and composer tables. The on-disk format is a small header followed
+by a table of aligned sections, so a catalog can be `mmap`ed and used without parsing or copying anything.
+"""
+import mmap
+import os
+import struct
+import sys
+from array import array
+from bisect import bisect_left
+from itertools import accumulate
+
+from .protocol import AirMode
+
+CATALOG_MAGIC = b'IPODCAT\x00'
+CATALOG_VERSION = 2
+
+# magic, format version, byte order (0 = little, 1 = big), section count
+_HEADER = struct.Struct('<8sHHI')
+# tag, offset, size
+_SECTION = struct.Struct('<4sQQ')
+_ALIGN = 8
+
+# Playlist 0 is always the main library playlist, containing every song
+MAIN_PLAYLIST = 0
+
+# The item types which songs reference through foreign keys
+SONG_KEY_TYPES = (AirMode.Types.ARTIST, AirMode.Types.ALBUM, AirMode.Types.GENRE, AirMode.Types.COMPOSER)
+
+ALL_TYPES = (AirMode.Types.PLAYLIST, AirMode.Types.ARTIST, AirMode.Types.ALBUM,
+             AirMode.Types.GENRE, AirMode.Types.SONG, AirMode.Types.COMPOSER)
+
+UNKNOWN_NAMES = {
+    AirMode.Types.ARTIST: "Unknown Artist",
+    AirMode.Types.ALBUM: "Unknown Album",
+    AirMode.Types.GENRE: "Unknown Genre",
+    AirMode.Types.COMPOSER: "Unknown Composer",
+}
+
+
+def _offsets_tag(type):
+    return 'of{:02d}'.format(type).encode('ascii')
+
+
+def _strings_tag(type):
+    return 'st{:02d}'.format(type).encode('ascii')
+
+
+def _song_key_tag(type):
+    return 'sk{:02d}'.format(type).encode('ascii')
+
+
+def _postings_offsets_tag(type):
+    return 'po{:02d}'.format(type).encode('ascii')
+
+
+def _postings_songs_tag(type):
+    return 'ps{:02d}'.format(type).encode('ascii')
+
+
+def _relation_offsets_tag(from_type, to_type):
+    return 'r{}{}o'.format(from_type, to_type).encode('ascii')
+
+
+def _relation_items_tag(from_type, to_type):
+    return 'r{}{}i'.format(from_type, to_type).encode('ascii')
+
+
+def _playlist_postings_offsets_tag(type):
+    return 'qo{:02d}'.format(type).encode('ascii')
+
+
+def _playlist_postings_positions_tag(type):
+    return 'qp{:02d}'.format(type).encode('ascii')
+
+
+def _playlist_relation_offsets_tag(from_type, to_type):
+    return 'p{}{}o'.format(from_type, to_type).encode('ascii')
+
+
+def _playlist_relation_items_tag(from_type, to_type):
+    return 'p{}{}i'.format(from_type, to_type).encode('ascii')
+
+
+SONG_LENGTH_TAG = b'slen'
+PLAYLIST_OFFSETS_TAG = b'plof'
+PLAYLIST_SONGS_TAG = b'plsg'
+
+
+class CatalogError(Exception):
+    pass
+
+
+class StringTable:
+    """
+    A read-only sequence of strings, stored as `len + 1` offsets into one UTF-8 blob.
+    """
+
+    def __init__(self, offsets, blob):
+        self.offsets = offsets
+        self.blob = blob
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index):
+        if not 0 <= index < len(self):
+            raise IndexError("String index out of range: {}".format(index))
+
+        return bytes(self.blob[self.offsets[index]:self.offsets[index + 1]]).decode('utf-8')
+
+    @classmethod
+    def build(cls, strings):
+        """
+        Builds a string table from an iterable of strings.
+        :param strings: The strings to store, in order.
+        :return: A new `StringTable` backed by an array and a bytes object.
+        """
+        encoded = [s.encode('utf-8') for s in strings]
+        offsets = array('I', [0])
+        offsets.extend(accumulate(len(s) for s in encoded))
+        return cls(offsets, b''.join(encoded))
+
+
+class Catalog:
+    """
+    A read-only music library. Item indices are the ones used on the wire: the playlist, artist, album, genre and
+    composer tables are sorted by name, and playlist 0 is the main library playlist.
+    """
+
+    def __init__(self, sections, buffer=None):
+        """
+        :param sections: A mapping of section tag to array-like section contents.
+        :param buffer: The `mmap` backing the sections, if any. It is closed by `close()`.
+        """
+        self._sections = sections
+        self._buffer = buffer
+
+        self.tables = {type: StringTable(sections[_offsets_tag(type)], sections[_strings_tag(type)])
+                       for type in ALL_TYPES}
+        self.song_keys = {type: sections[_song_key_tag(type)] for type in SONG_KEY_TYPES}
+        self.song_lengths = sections[SONG_LENGTH_TAG]
+        self.playlist_offsets = sections[PLAYLIST_OFFSETS_TAG]
+        self.playlist_members = sections[PLAYLIST_SONGS_TAG]
+
+        # Sorted song indices for each artist, album, genre and composer
+        self.postings = {type: (sections[_postings_offsets_tag(type)], sections[_postings_songs_tag(type)])
+                         for type in SONG_KEY_TYPES}
+        # Sorted indices of the items of one type that share a song with each item of another type, or that have a
+        # song in each playlist
+        self.relations = {(a, b): (sections[_relation_offsets_tag(a, b)], sections[_relation_items_tag(a, b)])
+                          for a in (AirMode.Types.PLAYLIST,) + SONG_KEY_TYPES for b in SONG_KEY_TYPES if a != b}
+        # The same again within each playlist, for every item in the playlist's relation: sorted positions in the
+        # playlist of the item's songs, and sorted indices of the items of another type sharing one of them
+        self.playlist_postings = {type: (sections[_playlist_postings_offsets_tag(type)],
+                                         sections[_playlist_postings_positions_tag(type)])
+                                  for type in SONG_KEY_TYPES}
+        self.playlist_relations = {(a, b): (sections[_playlist_relation_offsets_tag(a, b)],
+                                            sections[_playlist_relation_items_tag(a, b)])
+                                   for a in SONG_KEY_TYPES for b in SONG_KEY_TYPES if a != b}
+
+    @classmethod
+    def open(cls, path):
+        """
+        Memory-maps a catalog file. Nothing is read until it is used, so opening is effectively free.
+        :param path: The path of the catalog file.
+        :return: The mapped `Catalog`.
+        """
+        with open(path, 'rb') as f:
+            buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        try:
+            return cls(_read_sections(memoryview(buffer)), buffer)
+        except Exception:
+            buffer.close()
+            raise
+
+    @classmethod
+    def from_bytes(cls, data):
+        """
+        Loads a catalog from an in-memory copy of a catalog file.
+        :param data: The contents of a catalog file.
+        :return: The loaded `Catalog`.
+        """
+        return cls(_read_sections(memoryview(data)))
+
+    def close(self):
+        """
+        Releases the memory map backing this catalog, if any. The catalog must not be used afterwards.
+        """
+        if self._buffer is not None:
+            for section in self._sections.values():
+                if isinstance(section, memoryview):
+                    section.release()
+            self._buffer.close()
+            self._buffer = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def count(self, type):
+        return len(self.tables[type])
+
+    def name(self, type, index):
+        return self.tables[type][index]
+
+    def names(self, type, start, length):
+        table = self.tables[type]
+        return [table[i] for i in range(start, min(start + length, len(table)))]
+
+    def find(self, type, name):
+        """
+        Looks an item up by name, with a binary search of its table.
+        :return: The index of the first item of the type with exactly that name, or None.
+        """
+        table = self.tables[type]
+        low, high = 0, len(table)
+        if type == AirMode.Types.PLAYLIST:
+            # The main playlist comes first, and the rest are sorted after it
+            if high and table[MAIN_PLAYLIST] == name:
+                return MAIN_PLAYLIST
+            low = 1
+
+        key = name.casefold()
+        while low < high:
+            middle = (low + high) // 2
+            if table[middle].casefold() < key:
+                low = middle + 1
+            else:
+                high = middle
+
+        # Names which differ only in case sort together, in no particular order
+        while low < len(table):
+            candidate = table[low]
+            if candidate == name:
+                return low
+            if candidate.casefold() != key:
+                break
+            low += 1
+
+        return None
+
+    def song_key(self, type, song):
+        """
+        :param type: The referenced type; one of `SONG_KEY_TYPES`.
+        :param song: The song index.
+        :return: The index of the song's artist, album, genre or composer.
+        """
+        return self.song_keys[type][song]
+
+    def song_artist(self, song):
+        return self.song_keys[AirMode.Types.ARTIST][song]
+
+    def song_album(self, song):
+        return self.song_keys[AirMode.Types.ALBUM][song]
+
+    def song_genre(self, song):
+        return self.song_keys[AirMode.Types.GENRE][song]
+
+    def song_composer(self, song):
+        return self.song_keys[AirMode.Types.COMPOSER][song]
+
+    def song_length(self, song):
+        """
+        :return: The length of the song in milliseconds, or 0 if it is unknown.
+        """
+        return self.song_lengths[song]
+
+    def songs_with(self, type, index):
+        """
+        :param type: One of `SONG_KEY_TYPES`.
+        :param index: The artist, album, genre or composer index.
+        :return: A sorted sequence of the indices of every song with that artist, album, genre or composer.
+        """
+        offsets, songs = self.postings[type]
+        return songs[offsets[index]:offsets[index + 1]]
+
+    def related(self, type, index, to_type, playlist=None):
+        """
+        :param type: One of `SONG_KEY_TYPES`, or PLAYLIST.
+        :param index: The playlist, artist, album, genre or composer index.
+        :param to_type: Another one of `SONG_KEY_TYPES`.
+        :param playlist: Only count the songs in this playlist.
+        :return: A sorted sequence of the indices of every item of `to_type` which has a song in common with the
+        given item.
+        """
+        if type == AirMode.Types.PLAYLIST and index == MAIN_PLAYLIST:
+            # The main playlist has every song, so every item
+            return range(self.count(to_type))
+
+        if playlist is None or playlist == MAIN_PLAYLIST:
+            offsets, items = self.relations[type, to_type]
+        else:
+            index = self._playlist_entry(playlist, type, index)
+            if index is None:
+                return range(0)
+            offsets, items = self.playlist_relations[type, to_type]
+
+        return items[offsets[index]:offsets[index + 1]]
+
+    def playlist_positions(self, playlist, type, index):
+        """
+        :param playlist: The playlist index.
+        :param type: One of `SONG_KEY_TYPES`.
+        :param index: The artist, album, genre or composer index.
+        :return: A sorted sequence of the positions in the playlist of every song with that artist, album, genre or
+        composer.
+        """
+        if playlist == MAIN_PLAYLIST:
+            return self.songs_with(type, index)
+
+        entry = self._playlist_entry(playlist, type, index)
+        if entry is None:
+            return range(0)
+
+        offsets, positions = self.playlist_postings[type]
+        return positions[offsets[entry]:offsets[entry + 1]]
+
+    def _playlist_entry(self, playlist, type, index):
+        # Where the item is in the playlist's relation to its type, which is where its playlist postings and
+        # relations are too
+        offsets, items = self.relations[AirMode.Types.PLAYLIST, type]
+        start, end = offsets[playlist], offsets[playlist + 1]
+        entry = bisect_left(items, index, start, end)
+        return entry if entry < end and items[entry] == index else None
+
+    def playlist_songs(self, playlist):
+        """
+        :param playlist: The playlist index.
+        :return: A sequence of the song indices in the playlist, in order.
+        """
+        if playlist == MAIN_PLAYLIST:
+            return range(self.count(AirMode.Types.SONG))
+
+        return self.playlist_members[self.playlist_offsets[playlist]:self.playlist_offsets[playlist + 1]]
+
+
+class CatalogBuilder:
+    """
+    Accumulates songs and playlists and produces a `Catalog`. Artists, albums, genres and composers are
+    deduplicated by name.
+    """
+
+    def __init__(self, library_name="Library"):
+        self.library_name = library_name
+
+        self._titles = []
+        self._lengths = array('I')
+        self._keys = {type: array('I') for type in SONG_KEY_TYPES}
+        self._key_ids = {type: {} for type in SONG_KEY_TYPES}
+        self._playlists = []
+
+    def _key_id(self, type, name):
+        if not name:
+            name = UNKNOWN_NAMES[type]
+
+        ids = self._key_ids[type]
+        id = ids.get(name)
+        if id is None:
+            id = ids[name] = len(ids)
+
+        return id
+
+    def add_song(self, title, artist=None, album=None, genre=None, composer=None, length=0):
+        """
+        Adds a song to the library. Songs are sorted by title when the catalog is built, so the returned handle is
+        only meaningful to `add_playlist`.
+        :param length: The length of the song in milliseconds.
+        :return: A handle which identifies the song to `add_playlist`.
+        """
+        handle = len(self._titles)
+        self._titles.append(title)
+        self._lengths.append(length)
+        for type, name in zip(SONG_KEY_TYPES, (artist, album, genre, composer)):
+            self._keys[type].append(self._key_id(type, name))
+
+        return handle
+
+    def add_playlist(self, name, songs):
+        """
+        Adds a playlist to the library.
+        :param name: The playlist name.
+        :param songs: Song handles returned by `add_song`, in playlist order.
+        """
+        self._playlists.append((name, array('I', songs)))
+
+    def build_sections(self):
+        """
+        :return: A mapping of section tag to array-like section contents.
+        """
+        sections = {}
+
+        # Sort songs by title, and remember where each one went so the playlists can be remapped
+        song_order = sorted(range(len(self._titles)), key=lambda i: self._titles[i].casefold())
+        song_position = array('I', bytes(4 * len(song_order)))
+        for position, handle in enumerate(song_order):
+            song_position[handle] = position
+
+        table = StringTable.build(self._titles[i] for i in song_order)
+        sections[_offsets_tag(AirMode.Types.SONG)] = table.offsets
+        sections[_strings_tag(AirMode.Types.SONG)] = table.blob
+        sections[SONG_LENGTH_TAG] = array('I', (self._lengths[i] for i in song_order))
+
+        for type in SONG_KEY_TYPES:
+            names = sorted(self._key_ids[type], key=str.casefold)
+            table = StringTable.build(names)
+            sections[_offsets_tag(type)] = table.offsets
+            sections[_strings_tag(type)] = table.blob
+
+            remap = array('I', bytes(4 * len(names)))
+            for position, name in enumerate(names):
+                remap[self._key_ids[type][name]] = position
+            keys = self._keys[type]
+            sections[_song_key_tag(type)] = array('I', (remap[keys[i]] for i in song_order))
+
+        for type in SONG_KEY_TYPES:
+            keys = sections[_song_key_tag(type)]
+            count = len(self._key_ids[type])
+            sections[_postings_offsets_tag(type)], sections[_postings_songs_tag(type)] = _build_postings(keys, count)
+
+            for to_type in SONG_KEY_TYPES:
+                if to_type != type:
+                    pairs = sorted(set(zip(keys, sections[_song_key_tag(to_type)])))
+                    offsets, items = _build_postings(array('I', (a for a, _ in pairs)), count)
+                    sections[_relation_offsets_tag(type, to_type)] = offsets
+                    sections[_relation_items_tag(type, to_type)] = array('I', (b for _, b in pairs))
+
+        playlists = sorted(self._playlists, key=lambda p: p[0].casefold())
+        table = StringTable.build([self.library_name] + [name for name, _ in playlists])
+        sections[_offsets_tag(AirMode.Types.PLAYLIST)] = table.offsets
+        sections[_strings_tag(AirMode.Types.PLAYLIST)] = table.blob
+
+        # The main playlist is implicit, so it gets an empty range
+        offsets = array('I', [0, 0])
+        members = array('I')
+        for _, songs in playlists:
+            members.extend(song_position[handle] for handle in songs)
+            offsets.append(len(members))
+        sections[PLAYLIST_OFFSETS_TAG] = offsets
+        sections[PLAYLIST_SONGS_TAG] = members
+        sections.update(_build_playlist_sections(offsets, members,
+                                                 {type: sections[_song_key_tag(type)] for type in SONG_KEY_TYPES}))
+
+        return sections
+
+    def build(self):
+        """
+        :return: An in-memory `Catalog` of everything added so far.
+        """
+        return Catalog(self.build_sections())
+
+    def to_bytes(self):
+        return pack_sections(self.build_sections())
+
+    def write(self, path):
+        """
+        Writes the catalog to a file which can later be loaded with `Catalog.open`. The file is replaced rather than
+        overwritten, so catalogs already mapped from it stay intact.
+        :param path: The path to write to.
+        """
+        temporary = path + '.tmp'
+        with open(temporary, 'wb') as f:
+            f.write(self.to_bytes())
+        os.replace(temporary, path)
+
+
+def _build_postings(keys, count):
+    """
+    Inverts a key array with a counting sort.
+    :param keys: The key of each position; every key must be less than `count`.
+    :param count: The number of distinct keys.
+    :return: `count + 1` offsets and the positions grouped by key, in ascending order within each key.
+    """
+    offsets = array('I', bytes(4 * (count + 1)))
+    for key in keys:
+        offsets[key + 1] += 1
+    offsets = array('I', accumulate(offsets))
+
+    positions = array('I', bytes(4 * len(keys)))
+    next_free = array('I', offsets[:-1])
+    for position, key in enumerate(keys):
+        positions[next_free[key]] = position
+        next_free[key] += 1
+
+    return offsets, positions
+
+
+def _build_playlist_sections(playlist_offsets, members, song_keys):
+    """
+    Groups the songs of each playlist by their artist, album, genre and composer, so that browsing within a playlist
+    can use precomputed relations and intersections just like browsing the whole library.
+    :param playlist_offsets: The start of each playlist in `members`, and the end of the last one.
+    :param members: The songs of every playlist, in order.
+    :param song_keys: The key array of each of `SONG_KEY_TYPES`.
+    :return: A mapping of section tag to contents.
+    """
+    sections = {}
+
+    for type in SONG_KEY_TYPES:
+        keys = song_keys[type]
+        relation_offsets, items = array('I', [0]), array('I')
+        postings_offsets, positions = array('I', [0]), array('I')
+        related = {to_type: (array('I', [0]), array('I')) for to_type in SONG_KEY_TYPES if to_type != type}
+
+        for playlist in range(len(playlist_offsets) - 1):
+            songs = members[playlist_offsets[playlist]:playlist_offsets[playlist + 1]]
+            groups = {}
+            for position, song in enumerate(songs):
+                groups.setdefault(keys[song], []).append(position)
+
+            for key in sorted(groups):
+                group = groups[key]
+                items.append(key)
+                positions.extend(group)
+                postings_offsets.append(len(positions))
+                for to_type, (to_offsets, to_items) in related.items():
+                    to_keys = song_keys[to_type]
+                    to_items.extend(sorted({to_keys[songs[position]] for position in group}))
+                    to_offsets.append(len(to_items))
+            relation_offsets.append(len(items))
+
+        sections[_relation_offsets_tag(AirMode.Types.PLAYLIST, type)] = relation_offsets
+        sections[_relation_items_tag(AirMode.Types.PLAYLIST, type)] = items
+        sections[_playlist_postings_offsets_tag(type)] = postings_offsets
+        sections[_playlist_postings_positions_tag(type)] = positions
+        for to_type, (to_offsets, to_items) in related.items():
+            sections[_playlist_relation_offsets_tag(type, to_type)] = to_offsets
+            sections[_playlist_relation_items_tag(type, to_type)] = to_items
+
+    return sections
+
+
+def _padding(length):
+    return -length % _ALIGN
+
+
+def pack_sections(sections):
+    """
+    Serializes catalog sections into the on-disk format.
+    :param sections: A mapping of 4-byte section tag to a bytes-like object or `array`.
+    :return: The catalog file contents.
+    """
+    header_size = _HEADER.size + _SECTION.size * len(sections)
+    offset = header_size + _padding(header_size)
+
+    table = []
+    for tag, data in sections.items():
+        size = len(data) * getattr(data, 'itemsize', 1)
+        table.append(_SECTION.pack(tag, offset, size))
+        offset += size + _padding(size)
+
+    byteorder = 0 if sys.byteorder == 'little' else 1
+    out = [_HEADER.pack(CATALOG_MAGIC, CATALOG_VERSION, byteorder, len(sections))]
+    out.extend(table)
+    out.append(b'\x00' * _padding(header_size))
+    for data in sections.values():
+        data = bytes(data)
+        out.append(data)
+        out.append(b'\x00' * _padding(len(data)))
+
+    return b''.join(out)
+
+
+def _read_sections(view):
+    if len(view) < _HEADER.size:
+        raise CatalogError("Catalog is truncated")
+
+    magic, version, byteorder, count = _HEADER.unpack_from(view)
+    if magic != CATALOG_MAGIC:
+        raise CatalogError("Not a catalog file")
+    if version != CATALOG_VERSION:
+        raise CatalogError("Unsupported catalog version: {}".format(version))
+
+    swap = byteorder != (0 if sys.byteorder == 'little' else 1)
+
+    sections = {}
+    for i in range(count):
+        tag, offset, size = _SECTION.unpack_from(view, _HEADER.size + i * _SECTION.size)
+        if offset + size > len(view):
+            raise CatalogError("Section {!r} extends past the end of the catalog".format(tag))
+
+        data = view[offset:offset + size]
+        if tag.startswith(b'st'):
+            # String blobs are raw bytes
+            sections[tag] = data
+        elif swap:
+            # Catalogs written on a host with a different byte order can't be used in place
+            values = array('I', bytes(data))
+            values.byteswap()
+            sections[tag] = values
+        else:
+            sections[tag] = data.cast('I')
+
+    return sections
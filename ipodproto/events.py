@@ -0,0 +1,279 @@
+"""
+A typed event bus between the packet decoder and user callbacks, so that a slow callback can never hold up reading
+from the stream. Publishing only ever enqueues; each subscriber has its own bounded queue which is drained in order by
+a thread pool or an asyncio event loop.
+"""
+from collections import OrderedDict, deque, namedtuple
+from threading import Condition, Lock
+
+try:
+    from time import monotonic
+except ImportError:
+    from time import time as monotonic
+
+# Event types. `source` is the handler which published the event, so that several handlers can share a bus.
+PacketReceived = namedtuple('PacketReceived', ['source', 'packet'])
+PollUpdate = namedtuple('PollUpdate', ['source', 'elapsed'])
+# A Simple Remote button, one of `SimpleRemoteMode.Buttons`, was pressed or released
+ButtonChanged = namedtuple('ButtonChanged', ['source', 'button', 'pressed'])
+
+# What to do with an event when a subscriber's queue is full
+BLOCK = 0
+DROP_NEWEST = 1
+DROP_OLDEST = 2
+# Keep only the latest event for each key, e.g. only the latest elapsed time. Full queues drop their oldest key.
+COALESCE = 3
+
+
+def _log_callback_error(subscription, event):
+    # logging is slow to import, and only needed once something has gone wrong
+    import logging
+
+    logging.getLogger(__name__).exception("Subscriber %s failed to handle %s", subscription.name,
+                                          type(event).__name__)
+
+
+def _default_key(event):
+    return type(event), getattr(event, 'source', None)
+
+
+class Subscription:
+    """
+    One subscriber's queue. Its callback is only ever running once at a time, and sees events in publish order.
+    """
+
+    def __init__(self, bus, types, callback, maxsize, policy, source, key, name):
+        self.bus = bus
+        self.name = name or getattr(callback, '__qualname__', repr(callback))
+        self.types = types
+        self.callback = callback
+        self.maxsize = maxsize
+        self.policy = policy
+        self.source = source
+        self.key = key or _default_key
+
+        self.delivered = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.errors = 0
+        # The time between publishing and delivering the latest event, the most that has been, and a smoothed average
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+        self.lag = 0.0
+
+        # (event, published time), or key -> that when coalescing
+        self._queue = OrderedDict() if policy == COALESCE else deque()
+        self._scheduled = False
+        self._active = True
+        self._condition = Condition(Lock())
+
+    def __len__(self):
+        return len(self._queue)
+
+    def matches(self, event) -> bool:
+        return isinstance(event, self.types) and (self.source is None or getattr(event, 'source', None) is self.source)
+
+    def offer(self, event, published: float) -> bool:
+        """
+        Adds an event to the queue, applying the overflow policy.
+        :return: True if the queue needs draining, and isn't already scheduled to be.
+        """
+        with self._condition:
+            if not self._active:
+                return False
+
+            if self.policy == COALESCE:
+                key = self.key(event)
+                if key in self._queue:
+                    self.coalesced += 1
+                elif len(self._queue) >= self.maxsize:
+                    self._queue.popitem(last=False)
+                    self.dropped += 1
+                self._queue[key] = (event, published)
+            else:
+                if len(self._queue) >= self.maxsize:
+                    if self.policy == DROP_NEWEST:
+                        self.dropped += 1
+                        return False
+                    elif self.policy == DROP_OLDEST:
+                        self._queue.popleft()
+                        self.dropped += 1
+                    else:
+                        self._condition.wait_for(lambda: len(self._queue) < self.maxsize or not self._active)
+                        if not self._active:
+                            return False
+                self._queue.append((event, published))
+
+            if self._scheduled:
+                return False
+            self._scheduled = True
+            return True
+
+    def _take(self):
+        with self._condition:
+            if not self._queue or not self._active:
+                self._scheduled = False
+                return None
+
+            if self.policy == COALESCE:
+                _, entry = self._queue.popitem(last=False)
+            else:
+                entry = self._queue.popleft()
+            self._condition.notify_all()
+            return entry
+
+    def _delivered(self, published):
+        lag = monotonic() - published
+        self.delivered += 1
+        self.last_lag = lag
+        self.max_lag = max(self.max_lag, lag)
+        self.lag += 0.1 * (lag - self.lag)
+
+    def drain(self) -> None:
+        """
+        Delivers events until the queue is empty. Run on the bus's executor.
+        """
+        while True:
+            entry = self._take()
+            if entry is None:
+                return
+
+            event, published = entry
+            self._delivered(published)
+            try:
+                self.callback(event)
+            except Exception:
+                self.errors += 1
+                _log_callback_error(self, event)
+
+    async def drain_async(self) -> None:
+        """
+        Delivers events until the queue is empty, awaiting callbacks which are coroutines. Run on the bus's loop.
+        """
+        from inspect import isawaitable
+
+        while True:
+            entry = self._take()
+            if entry is None:
+                return
+
+            event, published = entry
+            self._delivered(published)
+            try:
+                result = self.callback(event)
+                if isawaitable(result):
+                    await result
+            except Exception:
+                self.errors += 1
+                _log_callback_error(self, event)
+
+    def cancel(self) -> None:
+        """
+        Stops delivery. Queued events are discarded, and blocked publishers are released.
+        """
+        with self._condition:
+            self._active = False
+            self._queue.clear()
+            self._condition.notify_all()
+
+    def stats(self) -> dict:
+        return {
+            'name': self.name,
+            'depth': len(self._queue),
+            'delivered': self.delivered,
+            'dropped': self.dropped,
+            'coalesced': self.coalesced,
+            'errors': self.errors,
+            'lag': self.lag,
+            'max_lag': self.max_lag,
+        }
+
+
+class EventBus:
+    """
+    Fans events out to subscribers without ever running a callback on the publishing thread.
+    """
+
+    def __init__(self, executor=None, loop: 'asyncio.AbstractEventLoop' = None, max_workers: int = 4):
+        """
+        :param executor: A `concurrent.futures.Executor` to run callbacks on. A thread pool is created if neither
+        this nor `loop` is given.
+        :param loop: An asyncio event loop to run callbacks on instead. Callbacks may then be coroutine functions.
+        :param max_workers: The size of the thread pool, if one is created.
+        """
+        self.loop = loop
+        self._owns_executor = executor is None and loop is None
+        if self._owns_executor:
+            # Imported here since concurrent.futures and asyncio are slow to import, and most users need neither
+            from concurrent.futures import ThreadPoolExecutor
+            executor = ThreadPoolExecutor(max_workers, thread_name_prefix='ipodproto-events')
+        self.executor = executor
+
+        self.published = 0
+        self.unhandled = 0
+
+        self._subscriptions = ()
+        self._lock = Lock()
+
+    def subscribe(self, types, callback, maxsize: int = 1024, policy: int = BLOCK, source=None,
+                  key=None, name: str = None) -> Subscription:
+        """
+        :param types: The event type, or a tuple of them, to deliver.
+        :param callback: Called with each event.
+        :param maxsize: The most events to queue before applying the policy.
+        :param policy: One of BLOCK, DROP_NEWEST, DROP_OLDEST or COALESCE. BLOCK makes the publisher wait for room,
+        so only use it where losing events is worse than slowing down the stream.
+        :param source: Only deliver events published by this source.
+        :param key: For COALESCE, returns the key which events are coalesced by. Defaults to the event type and
+        source.
+        :param name: A name for the subscription in `stats()`. Defaults to the callback's name.
+        :return: The subscription, which can be passed to `unsubscribe`.
+        """
+        subscription = Subscription(self, types, callback, maxsize, policy, source, key, name)
+        with self._lock:
+            self._subscriptions += (subscription,)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription) -> None:
+        with self._lock:
+            self._subscriptions = tuple(s for s in self._subscriptions if s is not subscription)
+        subscription.cancel()
+
+    def publish(self, event) -> None:
+        published = monotonic()
+        self.published += 1
+        handled = False
+
+        for subscription in self._subscriptions:
+            if subscription.matches(event):
+                handled = True
+                if subscription.offer(event, published):
+                    self._schedule(subscription)
+
+        if not handled:
+            self.unhandled += 1
+
+    def _schedule(self, subscription):
+        if self.loop is not None:
+            from asyncio import run_coroutine_threadsafe
+            run_coroutine_threadsafe(subscription.drain_async(), self.loop)
+        else:
+            self.executor.submit(subscription.drain)
+
+    def stats(self) -> list:
+        """
+        :return: The name, queue depth, delivery counts and lag of each subscription.
+        """
+        return [subscription.stats() for subscription in self._subscriptions]
+
+    def close(self, wait: bool = True) -> None:
+        """
+        Cancels every subscription, and shuts down the thread pool if the bus created it.
+        """
+        with self._lock:
+            subscriptions, self._subscriptions = self._subscriptions, ()
+        for subscription in subscriptions:
+            subscription.cancel()
+
+        if self._owns_executor:
+            self.executor.shutdown(wait)
@@ -0,0 +1,299 @@
+"""
+A soak test harness which shards many emulator/remote pairs across worker processes, so load isn't limited by one
+interpreter's GIL.
+
+    python -m ipodproto.fleet [--pairs 64] [--workers 4] [--duration 3600] [--transport socket|pty|inprocess]
+
+Every worker process runs its share of the pairs with the `loadgen` workload and sends its cumulative results back
+every `--interval` seconds. Workers which die are restarted, and the results they had reported are kept. The summary
+merges every worker's results.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import signal
+import sys
+import threading
+import time
+from multiprocessing.connection import wait
+
+from . import loadgen
+
+
+class FleetOptions:
+    """
+    How each worker process should run its pairs.
+    """
+
+    def __init__(self, transport='socket', threads=1, workload=loadgen.DEFAULT_WORKLOAD, songs=10000,
+                 listing_size=100, timeout=1.0, baud=1000000, interval=5.0, seed=0):
+        self.transport = transport
+        self.threads = threads
+        self.workload = workload
+        self.songs = songs
+        self.listing_size = listing_size
+        self.timeout = timeout
+        self.baud = baud
+        self.interval = interval
+        self.seed = seed
+
+
+def _snapshot(results, docks, cpu_started):
+    snapshot = loadgen.Results()
+    snapshot.merge(results)
+    for pair in docks:
+        snapshot.add_commands(pair.remote.metrics)
+    snapshot.cpu_seconds = time.process_time() - cpu_started
+    return snapshot
+
+
+def _counters(docks):
+    counters = {'waiter_timeouts': 0, 'late_responses': 0, 'checksum_failures': 0, 'parse_errors': 0,
+                'skipped_bytes': 0, 'bytes_in': 0, 'bytes_out': 0}
+    for pair in docks:
+        metrics = pair.remote.metrics
+        counters['waiter_timeouts'] += pair.remote.waiter_timeouts
+        counters['late_responses'] += pair.remote.late_responses
+        for name in ('checksum_failures', 'parse_errors', 'skipped_bytes', 'bytes_in', 'bytes_out'):
+            counters[name] += getattr(metrics, name)
+    return counters
+
+
+def worker_main(pairs: int, seed: int, options: FleetOptions, connection) -> None:
+    """
+    Runs one worker's pairs until anything is sent on `connection`, sending `(final, results, counters)` back on it
+    every interval.
+    """
+    # The parent decides when to stop
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    workload = loadgen.parse_workload(options.workload)
+    catalog = loadgen.build_catalog(options.songs, options.seed)
+    docks = [loadgen.Pair(catalog, loadgen.open_transport(options.transport, options.baud), options.timeout,
+                          options.listing_size) for _ in range(pairs)]
+
+    results = loadgen.Results()
+    finished = threading.Event()
+    cpu_started = time.process_time()
+    workers = loadgen.start_workers(docks, workload, results, finished, options.threads, seed)
+
+    while not connection.poll(options.interval):
+        connection.send((False, _snapshot(results, docks, cpu_started), _counters(docks)))
+
+    finished.set()
+    for worker in workers:
+        worker.join()
+    for pair in docks:
+        pair.close()
+    connection.send((True, _snapshot(results, docks, cpu_started), _counters(docks)))
+    connection.close()
+
+
+class Fleet:
+    """
+    Runs worker processes and restarts any that die.
+    """
+
+    def __init__(self, pairs: int, workers: int = None, options: FleetOptions = None):
+        """
+        :param pairs: The number of emulator/remote pairs, shared out between the workers.
+        :param workers: The number of worker processes. Defaults to one per core.
+        """
+        self.workers = min(pairs, workers or os.cpu_count() or 1)
+        self.pairs = pairs
+        self.options = options or FleetOptions()
+
+        self.restarts = 0
+        self.crashes = []
+
+        self._context = multiprocessing.get_context()
+        # Worker index -> [process, generation, connection]. Each worker has its own pipe, so one which is killed
+        # mid-report can't leave a lock held for the others.
+        self._workers = {}
+        # (index, generation) -> the latest Results and counters from that process
+        self._latest = {}
+
+    def _shard(self, index):
+        return self.pairs // self.workers + (1 if index < self.pairs % self.workers else 0)
+
+    def _start(self, index, generation):
+        connection, child = self._context.Pipe()
+        seed = self.options.seed * 1000 + index * 100 + generation
+        process = self._context.Process(target=worker_main, name='ipodproto-fleet-{}'.format(index),
+                                        args=(self._shard(index), seed, self.options, child), daemon=True)
+        process.start()
+        child.close()
+        self._workers[index] = [process, generation, connection]
+
+    def start(self) -> None:
+        for index in range(self.workers):
+            self._start(index, 0)
+
+    def _receive(self, index):
+        """
+        Reads one report from a worker, and closes its pipe after its final report or if it has died.
+        """
+        worker = self._workers[index]
+        try:
+            final, results, counters = worker[2].recv()
+        except (EOFError, OSError):
+            final = True
+        else:
+            self._latest[index, worker[1]] = (results, counters)
+        if final:
+            worker[2].close()
+            worker[2] = None
+
+    def _collect(self, timeout):
+        """
+        Reads any reports which arrive within `timeout`.
+        """
+        connections = {worker[2]: index for index, worker in self._workers.items() if worker[2] is not None}
+        for connection in wait(list(connections), timeout):
+            self._receive(connections[connection])
+
+    def poll(self, timeout: float = 0.5) -> None:
+        """
+        Collects reports, and restarts any worker which has exited.
+        """
+        self._collect(timeout)
+        for index, (process, generation, _) in list(self._workers.items()):
+            if not process.is_alive():
+                process.join()
+                # Keep anything it reported before it died
+                while self._workers[index][2] is not None and self._workers[index][2].poll():
+                    self._receive(index)
+                if self._workers[index][2] is not None:
+                    self._workers[index][2].close()
+                self.crashes.append((index, generation, process.exitcode))
+                self.restarts += 1
+                self._start(index, generation + 1)
+
+    def stop(self, timeout: float = 30.0) -> None:
+        """
+        Asks every worker to finish, and waits for their final reports.
+        """
+        for process, _, connection in self._workers.values():
+            if connection is None:
+                # Died since the last poll, and its pipe is already closed
+                continue
+            try:
+                connection.send(None)
+            except OSError:
+                # Already gone
+                pass
+
+        deadline = time.monotonic() + timeout
+        while any(worker[2] is not None for worker in self._workers.values()) and time.monotonic() < deadline:
+            self._collect(min(0.5, max(0.0, deadline - time.monotonic())))
+
+        for process, _, connection in self._workers.values():
+            if connection is not None:
+                connection.close()
+            process.join(max(0.0, deadline - time.monotonic()))
+            if process.is_alive():
+                process.terminate()
+                process.join()
+
+    def results(self):
+        """
+        :return: The merged results of every process, and their summed counters.
+        """
+        merged = loadgen.Results()
+        counters = {}
+        for results, worker_counters in self._latest.values():
+            merged.merge(results)
+            for name, value in worker_counters.items():
+                counters[name] = counters.get(name, 0) + value
+        return merged, counters
+
+    def summary(self, elapsed: float) -> dict:
+        results, counters = self.results()
+        options = self.options
+        summary = results.summary(elapsed, transport=options.transport, pairs=self.pairs, threads=options.threads,
+                                  workload=dict(loadgen.parse_workload(options.workload)))
+        summary.update({
+            'workers': self.workers,
+            'restarts': self.restarts,
+            'crashes': [{'worker': index, 'generation': generation, 'exitcode': exitcode}
+                        for index, generation, exitcode in self.crashes],
+            'counters': counters,
+        })
+        return summary
+
+
+def run(pairs: int, workers: int = None, duration: float = 60.0, options: FleetOptions = None,
+        progress=None) -> dict:
+    """
+    Runs a fleet for `duration` seconds, or until interrupted.
+    :param progress: Called with the summary so far after each report interval.
+    :return: The summary from `Fleet.summary`, with the number of workers, restarts and link counters.
+    """
+    fleet = Fleet(pairs, workers, options)
+    started = time.monotonic()
+    deadline = started + duration
+    next_progress = started + fleet.options.interval
+
+    fleet.start()
+    try:
+        while time.monotonic() < deadline:
+            fleet.poll(min(0.5, max(0.0, deadline - time.monotonic())))
+            if progress is not None and time.monotonic() >= next_progress:
+                next_progress += fleet.options.interval
+                progress(fleet.summary(time.monotonic() - started))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        fleet.stop()
+
+    return fleet.summary(time.monotonic() - started)
+
+
+def _print_progress(summary):
+    print("{elapsed:7.0f}s {requests:>10} requests {requests_per_second:8.0f}/s, {restarts} restarts".format(
+        **summary), file=sys.stderr)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m ipodproto.fleet', description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--pairs', type=int, default=os.cpu_count() or 1, help="emulator/remote pairs")
+    parser.add_argument('--workers', type=int, default=None, help="worker processes; one per core by default")
+    parser.add_argument('--duration', type=float, default=60.0, help="seconds")
+    parser.add_argument('--interval', type=float, default=5.0, help="seconds between reports from each worker")
+    parser.add_argument('--transport', choices=('socket', 'pty', 'inprocess'), default='socket')
+    parser.add_argument('--threads', type=int, default=1, help="worker threads per pair")
+    parser.add_argument('--workload', default=loadgen.DEFAULT_WORKLOAD,
+                        help="operation=weight pairs; operations are " + ', '.join(loadgen.OPERATIONS))
+    parser.add_argument('--songs', type=int, default=10000)
+    parser.add_argument('--listing-size', type=int, default=100, help="names per listing")
+    parser.add_argument('--timeout', type=float, default=1.0, help="remote response timeout, in seconds")
+    parser.add_argument('--baud', type=int, default=1000000, help="line rate of in-process links")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--quiet', action='store_true', help="don't print progress")
+    parser.add_argument('--json', action='store_true', help="print the summary as JSON")
+    args = parser.parse_args(argv)
+    try:
+        loadgen.parse_workload(args.workload)
+    except ValueError as e:
+        parser.error(str(e))
+
+    options = FleetOptions(args.transport, args.threads, args.workload, args.songs, args.listing_size, args.timeout,
+                           args.baud, args.interval, args.seed)
+    summary = run(args.pairs, args.workers, args.duration, options, None if args.quiet else _print_progress)
+
+    if args.json:
+        json.dump(summary, sys.stdout, indent=1)
+        print()
+        return
+
+    print("{} workers, {} restarts".format(summary['workers'], summary['restarts']))
+    loadgen.print_summary(summary)
+    counters = summary['counters']
+    if any(counters.get(name) for name in ('waiter_timeouts', 'late_responses', 'checksum_failures',
+                                           'parse_errors')):
+        print("link: " + ', '.join('{} {}'.format(name, value) for name, value in sorted(counters.items())))
+
+
+if __name__ == '__main__':
+    main()
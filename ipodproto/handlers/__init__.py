@@ -1,3 +1,10 @@
-from . import ipod, air
+import importlib
 
-__all__ = ["ipod",  "air"]
+__all__ = ["ipod",  "air", "cursor"]
+
+
+def __getattr__(name):
+    # Handler modules are imported on first use, so an accessory doesn't pay for the emulator or vice versa
+    if name in __all__:
+        return importlib.import_module('.' + name, __name__)
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
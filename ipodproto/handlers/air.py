@@ -1,7 +1,9 @@
 from ..protocol import *
-from time import sleep
+from ..events import PollUpdate, COALESCE
+from ..nowplaying import NowPlaying, NowPlayingState
+from threading import Condition, Event, Lock, RLock
+from collections import OrderedDict, deque
 from typing import Tuple, List, Union
-from six.moves.queue import Queue
 
 # Try to use time.monotonic() if it exists, but otherwise time.time() will have to do
 try:
@@ -38,13 +40,307 @@ class CommandIsResponse(CommandFailed):
     pass
 
 
+class RequestCancelled(IpodException):
+    pass
+
+
+class ItemNamesRequest:
+    """
+    A handle for an outstanding GET_ITEM_NAMES request, whose RES_ITEM_NAME responses are collected as they arrive.
+
+    RES_ITEM_NAME frames carry no request tag or item type, only an offset, so a frame is only accepted if it
+    continues the expected sequence: a frame for `start` which arrived after the request was sent begins the burst
+    (again, if a previous burst already used that offset), and every later frame must have the next offset. Anything
+    else is left over from an earlier request. A stale burst which starts at the same offset and whose first frame
+    was still on its way when this request was sent can't be told apart.
+    """
+
+    def __init__(self, type: int, start: int, count: int):
+        self.type = type
+        self.start = start
+        self.count = count
+        # When the request was sent; set by whoever sends it
+        self.sent = None
+
+        self.cancelled = False
+        self.discarded = 0
+
+        self._names = []
+        self._done = Event()
+        self._lock = Lock()
+
+        if count == 0:
+            self._done.set()
+
+    def accept(self, offset: int, name: str, received: float) -> bool:
+        """
+        Offers a received name to this request.
+        :param received: When the frame arrived.
+        :return: True if the name belongs to this request, False if it's stale and should be discarded.
+        """
+        with self._lock:
+            if self.cancelled or self._done.is_set():
+                return False
+
+            if offset == self.start and self.sent is not None and received >= self.sent:
+                # The burst (re)started, so anything collected so far was stale
+                self.discarded += len(self._names)
+                self._names = [name]
+            elif self._names and offset == self.start + len(self._names):
+                self._names.append(name)
+            else:
+                return False
+
+            if len(self._names) == self.count:
+                self._done.set()
+
+            return True
+
+    def cancel(self) -> None:
+        """
+        Abandons the request. Any names which arrive for it later are discarded, and waiters raise RequestCancelled.
+        """
+        with self._lock:
+            if not self._done.is_set():
+                self.cancelled = True
+                self._done.set()
+
+    def done(self) -> bool:
+        return self._done.is_set()
+
+    def received(self) -> int:
+        return len(self._names)
+
+    def result(self, timeout: float = None) -> List[str]:
+        """
+        Waits for every name to arrive.
+        :param timeout: The longest to wait, in seconds, or None to wait forever.
+        :return: The names, in order.
+        """
+        if not self._done.wait(timeout):
+            raise TimeoutError("Only {} of {} results were received".format(len(self._names), self.count))
+        if self.cancelled:
+            raise RequestCancelled()
+
+        return list(self._names)
+
+
+class ResponseWaiter:
+    """
+    A request waiting for its response.
+    """
+
+    def __init__(self, command_id: int):
+        self.command_id = command_id
+        # When the request was sent, when its response was received, and when the requester gave up waiting, if it did
+        self.sent = None
+        self.received = None
+        self.abandoned = None
+        # When the requester gave up because the response took too long, rather than because it was ambiguous
+        self.timed_out = None
+
+        self._response = None
+        self._event = Event()
+
+    def resolve(self, response: AirCommand, received: float) -> None:
+        self._response = response
+        self.received = received
+        self._event.set()
+
+    def abandon(self, when: float) -> None:
+        """
+        Gives up on the response straight away, making the requester time out.
+        """
+        self.abandoned = when
+        self._event.set()
+
+    def done(self) -> bool:
+        return self._event.is_set()
+
+    def wait(self, timeout: float) -> bool:
+        return self._event.wait(timeout)
+
+    def result(self):
+        """
+        :return: The parameters of the response (or None for a success response), and the time it was received.
+        """
+        res = self._response
+
+        if res.id == AirMode.Commands.NCU_00:
+            raise CommandNotUnderstood()
+        elif res.id == AirMode.Commands.FEEDBACK:
+            if res.parameters.result == RESULT_FAILURE:
+                raise CommandFailed()
+            elif res.parameters.result == RESULT_BAD_LENGTH:
+                raise CommandLengthExceeded()
+            elif res.parameters.result == RESULT_RESPONSE_NOT_COMMAND:
+                raise CommandIsResponse()
+            return None, self.received
+
+        return res.parameters, self.received
+
+
+class SessionInfo:
+    """
+    Everything learned while bringing up an Advanced Remote session, and how long each step took.
+    """
+
+    def __init__(self):
+        self.ipod_type = None
+        self.ipod_name = None
+        self.screen_size = None
+        self.item_counts = {}
+
+        # Step name -> seconds from sending the request until its response arrived
+        self.timings = OrderedDict()
+        # Seconds from the start of the handshake until the session was ready
+        self.total_time = None
+
+    def __repr__(self):
+        return "SessionInfo(ipod_type={!r}, ipod_name={!r}, screen_size={!r}, item_counts={!r}, total_time={!r})" \
+            .format(self.ipod_type, self.ipod_name, self.screen_size, self.item_counts, self.total_time)
+
+
 class AdvancedRemote(IpodProtocolHandler):
-    def __init__(self, *args, timeout=1, **kwargs):
+    # Responses are only handed over to waiters, which is quick; poll updates go through the event bus if there is one
+    inline_packets = True
+
+    def __init__(self, *args, timeout=1, now_playing_publisher=None, **kwargs):
+        """
+        :param timeout: How long to wait for each response, in seconds.
+        :param now_playing_publisher: A `sharedmem.NowPlayingPublisher` to keep up to date with the now playing
+        state, for other processes to read.
+        """
         super(AdvancedRemote, self).__init__(*args, **kwargs)
 
-        self._queue = Queue()
+        if self.events is not None:
+            # Only the latest elapsed time is worth delivering to a slow callback
+            self.subscribe(PollUpdate, lambda event: self.on_poll_update(event.elapsed), maxsize=1, policy=COALESCE,
+                           name=type(self).__name__ + '.on_poll_update')
+
         self._timeout = timeout
 
+        # Command ID -> requests waiting for a response to it, oldest first
+        self._waiters = {}
+        # Command ID -> (response, received time) for responses which arrived before anybody waited for them
+        self._unclaimed = {}
+        self._waiters_lock = Lock()
+        # Notified whenever an abandoned waiter leaves the line
+        self._line_changed = Condition(self._waiters_lock)
+        # Held while registering a waiter and sending its request, so both happen in the same order
+        self._request_lock = RLock()
+
+        # Requests which gave up waiting, and responses which were dropped because they may have been for one of them
+        self.waiter_timeouts = 0
+        self.late_responses = 0
+
+        # RES_ITEM_NAME frames go straight to the current request rather than to a waiter
+        self._names_request = None
+
+        # Stale RES_ITEM_NAME frames which were dropped on arrival
+        self.discarded_frames = 0
+
+        # Kept up to date from poll updates and time status and playlist position responses
+        self.now_playing = NowPlaying(publisher=now_playing_publisher)
+
+        if self.metrics is not None:
+            self.metrics.gauge('pending_requests', self.pending_requests)
+            self.metrics.gauge('waiter_timeouts', lambda: self.waiter_timeouts)
+            self.metrics.gauge('late_responses', lambda: self.late_responses)
+            self.metrics.gauge('discarded_frames', lambda: self.discarded_frames)
+
+    @property
+    def timeout(self) -> float:
+        """
+        How long to wait for each response, in seconds.
+        """
+        return self._timeout
+
+    def pending_requests(self) -> int:
+        """
+        :return: The number of requests waiting for a response, including ones which have timed out but may still
+        be answered.
+        """
+        with self._waiters_lock:
+            return sum(len(waiters) for waiters in self._waiters.values())
+
+    def switch_mode(self, mode_command: int = SwitchMode.Commands.SET_ADVANCED_REMOTE) -> None:
+        """
+        Asks the iPod to switch modes. Nothing is sent in response.
+        :param mode_command: One of the `SwitchMode.Commands` SET_ values.
+        """
+        packet = IpodPacket()
+        packet.command = SwitchModeCommand()
+        packet.command.id = mode_command
+
+        self.send_packet(packet)
+
+    def connect(self, pipeline: bool = True) -> SessionInfo:
+        """
+        Switches the iPod to Advanced Remote mode and runs the handshake.
+        :param pipeline: Whether to send the handshake queries back to back, rather than waiting for each in turn.
+        :return: The session info.
+        """
+        start = monotonic()
+        self.switch_mode(SwitchMode.Commands.SET_ADVANCED_REMOTE)
+        switched = monotonic()
+
+        info = self.handshake(pipeline)
+        info.timings['switch_mode'] = switched - start
+        info.timings.move_to_end('switch_mode', last=False)
+        info.total_time = monotonic() - start
+
+        return info
+
+    def handshake(self, pipeline: bool = True) -> SessionInfo:
+        """
+        Pings the iPod and collects its type, name, screen size and item counts. None of the queries depend on each
+        other, so by default they are all sent at once, and the handshake takes about one round trip rather than one
+        per query.
+        :param pipeline: Whether to send the queries back to back, rather than waiting for each in turn.
+        :return: The session info, with the time each query took.
+        """
+        info = SessionInfo()
+        start = monotonic()
+
+        def store_screen_size(res):
+            info.screen_size = (res.width, res.height)
+
+        def store_count(type):
+            return lambda res: info.item_counts.__setitem__(type, res)
+
+        steps = [
+            ('ping', AirMode.Commands.NCU_02, None, lambda res: None),
+            ('ipod_type', AirMode.Commands.GET_IPOD_TYPE, None, lambda res: setattr(info, 'ipod_type', res)),
+            ('ipod_name', AirMode.Commands.GET_IPOD_NAME, None, lambda res: setattr(info, 'ipod_name', res.text)),
+            ('screen_size', AirMode.Commands.GET_SCREEN_SIZE, None, store_screen_size),
+        ]
+        for name, type in sorted(TYPES.items(), key=lambda t: t[1]):
+            steps.append(('count_' + name.lower(), AirMode.Commands.GET_TYPE_COUNT, type, store_count(type)))
+
+        def send(command_id, parameters):
+            cmd = AirCommand()
+            cmd.id = command_id
+            if parameters is not None:
+                cmd.parameters = parameters
+            return self._send_request(cmd), monotonic()
+
+        if pipeline:
+            sent = [send(command_id, parameters) for _, command_id, parameters, _ in steps]
+        else:
+            sent = [None] * len(steps)
+
+        for (name, command_id, parameters, store), request in zip(steps, sent):
+            if request is None:
+                request = send(command_id, parameters)
+            waiter, sent_at = request
+            res, received_at = self._wait(waiter)
+            info.timings[name] = received_at - sent_at
+            store(res)
+
+        info.total_time = monotonic() - start
+        return info
+
     def ping(self) -> bool:
         cmd = AirCommand()
         cmd.id = AirMode.Commands.NCU_02
@@ -100,6 +396,26 @@ class AdvancedRemote(IpodProtocolHandler):
         return self.send_air_command(cmd, True)
 
     def get_item_names(self, type: int, start, count) -> List[str]:
+        sent = monotonic()
+        # Wait for this request in particular, since another thread may supersede it at any time
+        request = self.get_item_names_async(type, start, count)
+
+        try:
+            names = request.result(self._timeout * 4)
+        except TimeoutError:
+            # Nobody is waiting for the rest of these any more
+            request.cancel()
+            raise
+        if self.metrics is not None:
+            self.metrics.observe(AirMode.Commands.GET_ITEM_NAMES, monotonic() - sent)
+        return names
+
+    def get_item_names_async(self, type: int, start: int, count: int) -> ItemNamesRequest:
+        """
+        Requests a range of item names without waiting for them. The iPod abandons a listing when it gets a new one,
+        so this supersedes (cancels) any request which is still outstanding.
+        :return: A handle which can be waited on or cancelled.
+        """
         cmd = AirCommand()
         cmd.id = AirMode.Commands.GET_ITEM_NAMES
         cmd.parameters = ItemRangeParam()
@@ -107,10 +423,19 @@ class AdvancedRemote(IpodProtocolHandler):
         cmd.parameters.start = start
         cmd.parameters.length = count
 
-        # Don't wait for the command, we require a different method
-        self.send_air_command(cmd, False)
+        with self._request_lock:
+            request = ItemNamesRequest(type, start, count)
+
+            previous, self._names_request = self._names_request, request
+            if previous is not None:
+                previous.cancel()
 
-        return self.get_names_response(count, timeout=self._timeout * 4)
+            # Don't wait for the command, the names are collected by the request. Anything which arrives before it is
+            # sent can't be the start of its burst.
+            request.sent = monotonic()
+            self.send_air_command(cmd, False)
+
+        return request
 
     def get_time_status_info(self) -> Tuple[int, int, int]:
         cmd = AirCommand()
@@ -126,26 +451,44 @@ class AdvancedRemote(IpodProtocolHandler):
 
         return self.send_air_command(cmd, True)
 
+    def get_now_playing(self) -> NowPlayingState:
+        """
+        Gets the playlist position, track length, elapsed time and status, from the local now-playing model where
+        it can be trusted and by asking the iPod otherwise. With polling on, this rarely needs a round trip.
+        """
+        if not self.now_playing.time_confident():
+            self.get_time_status_info()
+        if self.now_playing.position is None:
+            self.get_playlist_position()
+
+        return self.now_playing.snapshot()
+
     def get_song_title(self, index: int) -> str:
         cmd = AirCommand()
         cmd.id = AirMode.Commands.GET_SONG_TITLE
         cmd.parameters = index
 
-        return self.send_air_command(cmd, True).text
+        title = self.send_air_command(cmd, True).text
+        self.now_playing.update_metadata(index, title=title)
+        return title
 
     def get_song_artist(self, index: int) -> str:
         cmd = AirCommand()
         cmd.id = AirMode.Commands.GET_SONG_ARTIST
         cmd.parameters = index
 
-        return self.send_air_command(cmd, True).text
+        artist = self.send_air_command(cmd, True).text
+        self.now_playing.update_metadata(index, artist=artist)
+        return artist
 
     def get_song_album(self, index: int) -> str:
         cmd = AirCommand()
         cmd.id = AirMode.Commands.GET_SONG_ALBUM
         cmd.parameters = index
 
-        return self.send_air_command(cmd, True).text
+        album = self.send_air_command(cmd, True).text
+        self.now_playing.update_metadata(index, album=album)
+        return album
 
     def set_polling_mode(self, mode) -> None:
         cmd = AirCommand()
@@ -163,6 +506,8 @@ class AdvancedRemote(IpodProtocolHandler):
         cmd.parameters = control
 
         self.send_air_command(cmd, False)
+        self.now_playing.invalidate(track_changed=control not in (CONTROL_PLAY_PAUSE, CONTROL_FAST_FORWARD,
+                                                                  CONTROL_REWIND, CONTROL_STOP_FFRW))
 
     def play_pause(self) -> None:
         self.playback_control(CONTROL_PLAY_PAUSE)
@@ -212,6 +557,14 @@ class AdvancedRemote(IpodProtocolHandler):
     def upload_picture(self, picture) -> None:
         raise NotImplementedError()
 
+    def get_screen_size(self) -> Tuple[int, int]:
+        cmd = AirCommand()
+        cmd.id = AirMode.Commands.GET_SCREEN_SIZE
+
+        res = self.send_air_command(cmd, True)
+
+        return res.width, res.height
+
     def get_playlist_size(self) -> int:
         cmd = AirCommand()
         cmd.id = AirMode.Commands.GET_PLAYLIST_SIZE
@@ -224,6 +577,7 @@ class AdvancedRemote(IpodProtocolHandler):
         cmd.parameters = index
 
         self.send_air_command(cmd, False)
+        self.now_playing.invalidate()
 
     def get_ncu_39(self) -> None:
         cmd = AirCommand()
@@ -232,84 +586,221 @@ class AdvancedRemote(IpodProtocolHandler):
         self.send_air_command(cmd, False)
 
     def packet_received(self, packet: IpodPacket) -> None:
+        if packet.mode != MODE_ADVANCED_REMOTE:
+            # Nothing asks for responses in any other mode
+            return
+
         if packet.command.id == AirMode.Commands.RES_TIME_ELAPSED:
-            # Polling isn't quite a response, so don't clog up the queue with it
-            self.on_poll_update(packet.command.parameters.elapsed)
+            # Polling isn't quite a response, so don't clog up the waiters with it
+            self.now_playing.update_elapsed(packet.command.parameters)
+            if self.events is not None:
+                self.events.publish(PollUpdate(self, packet.command.parameters))
+            else:
+                self.on_poll_update(packet.command.parameters)
+        elif packet.command.id == AirMode.Commands.RES_ITEM_NAME:
+            request = self._names_request
+            params = packet.command.parameters
+
+            if request is None or not request.accept(params.offset, params.name.text, monotonic()):
+                self.discarded_frames += 1
         else:
-            self._queue.put_nowait((packet.command, monotonic() + self._timeout))
+            if packet.command.id == AirMode.Commands.RES_TIME_STATUS:
+                params = packet.command.parameters
+                self.now_playing.update_time_status(params.length, params.elapsed, params.status)
+            elif packet.command.id == AirMode.Commands.RES_PLAYLIST_POS:
+                self.now_playing.update_position(packet.command.parameters)
+
+            self._deliver(packet.command, monotonic())
+
+    def _deliver(self, res: AirCommand, received: float) -> None:
+        """
+        Hands a response to the oldest waiter for the command it answers, or keeps it for a later
+        `wait_for_response` if nobody is waiting yet.
+        """
+        if res.id in (AirMode.Commands.NCU_00, AirMode.Commands.FEEDBACK):
+            command_id = res.parameters.command
+        else:
+            # Response IDs are always command ID + 1
+            command_id = res.id - 1
+
+        with self._waiters_lock:
+            waiters = self._waiters.get(command_id)
+            if waiters:
+                self._expire(waiters, received)
+            if waiters:
+                waiter = waiters.popleft()
+                if waiter.abandoned is None:
+                    waiter.resolve(res, received)
+                    return
+
+                # Responses don't say which request they answer, so this is either the late response to a request
+                # which timed out, or the response to the next one if the timed out one's was lost. Rather than guess,
+                # nobody gets it, and the next request in line fails too if it was sent before the timeout, since its
+                # response may be the one coming next. That request didn't time out itself, so the response dropped
+                # for it in turn fails nobody else, and one timeout costs at most one more request.
+                self.late_responses += 1
+                if waiter.timed_out is not None:
+                    following = next((w for w in waiters if w.abandoned is None), None)
+                    # Waiters for commands sent without waiting don't know when they were sent, so count as early
+                    if following is not None and (following.sent is None or following.sent <= waiter.timed_out):
+                        following.abandon(received)
+                        self.waiter_timeouts += 1
+                self._line_changed.notify_all()
+                return
+
+            unclaimed = self._unclaimed.setdefault(command_id, deque())
+            while unclaimed and unclaimed[0][1] + self._timeout < received:
+                unclaimed.popleft()
+            unclaimed.append((res, received))
+
+    def _expire(self, waiters, now: float) -> None:
+        """
+        Takes abandoned waiters out of line once their responses are a whole timeout late, and so taken to be lost.
+        Must be called with the waiters lock held.
+        """
+        expired = [waiter for waiter in waiters
+                   if waiter.abandoned is not None and waiter.abandoned + self._timeout < now]
+        for waiter in expired:
+            waiters.remove(waiter)
+        if expired:
+            self._line_changed.notify_all()
+
+    def _wait_for_line(self, command_id: int, deadline: float) -> bool:
+        """
+        Waits until no request for a command is abandoned but might still be answered, so that the response to the
+        next request can't be mistaken for a late one.
+        :return: False if that didn't happen by the deadline.
+        """
+        with self._line_changed:
+            while True:
+                now = monotonic()
+                waiters = self._waiters.get(command_id)
+                if not waiters:
+                    return True
+                self._expire(waiters, now)
+
+                abandoned = [waiter.abandoned for waiter in waiters if waiter.abandoned is not None]
+                if not abandoned:
+                    return True
+                if now >= deadline:
+                    return False
+                self._line_changed.wait(min(deadline, min(abandoned) + self._timeout) - now)
+
+    def _register(self, command_id: int, claim: bool = True) -> ResponseWaiter:
+        """
+        Registers a waiter for the next response to a command.
+        :param claim: Whether a response which already arrived unclaimed can be taken, for commands which were sent
+        without waiting. Requests register before they are sent, so they never claim.
+        """
+        waiter = ResponseWaiter(command_id)
+        now = monotonic()
+
+        with self._waiters_lock:
+            unclaimed = self._unclaimed.get(command_id) if claim else None
+            while unclaimed:
+                res, received = unclaimed.popleft()
+                if received + self._timeout >= now:
+                    waiter.resolve(res, received)
+                    return waiter
+
+            self._waiters.setdefault(command_id, deque()).append(waiter)
+
+        return waiter
+
+    def _wait(self, waiter: ResponseWaiter):
+        if self.tracer is not None:
+            with self.tracer.span('wait', mode=MODE_ADVANCED_REMOTE, id=waiter.command_id):
+                return self._wait_for(waiter)
+
+        return self._wait_for(waiter)
+
+    def _wait_for(self, waiter: ResponseWaiter):
+        if not waiter.wait(self._timeout):
+            with self._waiters_lock:
+                if not waiter.done():
+                    # Leave it in line, so that a late response isn't given to the next request for the same command
+                    waiter.abandoned = waiter.timed_out = monotonic()
+                    self.waiter_timeouts += 1
+        if waiter.abandoned is not None:
+            raise TimeoutError()
+
+        if self.metrics is not None and waiter.sent is not None:
+            self.metrics.observe(waiter.command_id, waiter.received - waiter.sent)
+
+        return waiter.result()
 
     def send_air_command(self, cmd: AirCommand, wait: bool = False) -> Union[int, StringField, ItemNameResult,
                                                                                  TimeStatusResult, ScreenSizeResult,
                                                                                  CommandResultParam]:
+        if not wait:
+            packet = IpodPacket()
+            packet.mode = MODE_ADVANCED_REMOTE
+            packet.command = cmd
+
+            self.send_packet(packet)
+            return None
+
+        if self.tracer is not None:
+            with self.tracer.span('request', mode=MODE_ADVANCED_REMOTE, id=cmd.id):
+                return self._wait(self._send_request(cmd))[0]
+
+        return self._wait(self._send_request(cmd))[0]
+
+    def _send_request(self, cmd: AirCommand) -> ResponseWaiter:
+        """
+        Sends a command, registering a waiter for its response first. If an earlier request for the same command was
+        abandoned, this waits for its late response or for it to be taken as lost, for up to one timeout, and times
+        out without sending anything if neither happens.
+        """
+        if not self._wait_for_line(cmd.id, monotonic() + self._timeout):
+            with self._waiters_lock:
+                self.waiter_timeouts += 1
+            raise TimeoutError()
+
         packet = IpodPacket()
         packet.mode = MODE_ADVANCED_REMOTE
         packet.command = cmd
 
-        self.send_packet(packet)
+        # Registering and sending together keeps the waiters for each command in the same order as the wire
+        with self._request_lock:
+            waiter = self._register(cmd.id, claim=False)
+            waiter.sent = monotonic()
+            self.send_packet(packet)
 
-        if wait:
-            return self.wait_for_response(command.id)
+        return waiter
 
     def get_names_response(self, count, timeout=None) -> List[str]:
         """
-        Handles the multiple responses for the get_item_names method.
-        :return:
+        Handles the multiple responses for the get_item_names method, by waiting for the most recent request.
+        :param count: The number of names requested.
+        :return: The names, in order.
         """
-        end = monotonic() + timeout or self._timeout
-
-        results = []
-
-        while monotonic() <= end:
-            (res, expiry) = self._queue.get(timeout=(timeout or self._timeout) / 2)
-            if res.id == AirMode.Commands.GET_ITEM_NAMES:
-                results.append((res.parameters, res.parameters.name.text))
-
-                if len(results) == count:
-                    break
-            else:
-                if monotonic() <= expiry:
-                    self._queue.put_nowait((res, expiry))
-        else:
-            # If we didn't break, there was a timeout; make sure we got all items
-            if len(results) != count:
-                raise TimeoutError("Only {} of {} results were received".format(len(results), count))
+        request = self._names_request
+        if request is None or request.count != count:
+            raise RequestCancelled()
 
-        return [name for off, name in sorted(results)]
+        try:
+            return request.result(timeout or self._timeout)
+        except TimeoutError:
+            # Nobody is waiting for the rest of these any more
+            request.cancel()
+            raise
 
     def wait_for_response(self, command_id: int):
         """
         Wait for a response to the given command ID to be received. If the command has a corresponding response, its
         parameters will be returned. If an error response is returned, an appropriate exception will be raised. If a
         success response is returned, None is returned.
+
+        Responses are matched to waiters for the same command in the order the waiters were registered, so only use
+        this after `send_air_command(cmd, False)` if no other thread is sending the same command.
         :param command_id: The ID of the command for which to retrieve a response. NOT the response ID!
         :return: The parameters of the response, or None for a success response.
         """
-        end = monotonic() + self._timeout
-        while monotonic() <= end:
-            (res, expiry) = self._queue.get(timeout=self._timeout / 2)
-            if res.id == command_id + 1:
-                # Response IDs are always command ID + 1
-                return res.parameters
-            elif res.id == AirMode.Commands.NCU_00 and res.parameters.command == command_id:
-                raise CommandNotUnderstood()
-            elif res.id == AirMode.Commands.FEEDBACK and res.parameters.command == command_id:
-                if res.parameters.result == RESULT_SUCCESS:
-                    return None
-                elif res.parameters.result == RESULT_FAILURE:
-                    raise CommandFailed()
-                elif res.parameters.result == RESULT_BAD_LENGTH:
-                    raise CommandLengthExceeded()
-                elif res.parameters.result == RESULT_RESPONSE_NOT_COMMAND:
-                    raise CommandIsResponse()
-            else:
-                empty = self._queue.empty()
+        return self._wait_for_response(command_id)[0]
 
-                if monotonic() <= expiry:
-                    # Only put it back through the queue if it hasn't expired
-                    self._queue.put_nowait((res, expiry))
-
-                if empty:
-                    # If we just emptied the queue, wait a bit instead of pegging it
-                    sleep(min(.05, self._timeout))
-
-        raise TimeoutError()
+    def _wait_for_response(self, command_id: int):
+        """
+        Like `wait_for_response`, but also returns the monotonic time at which the response was received.
+        """
+        return self._wait(self._register(command_id))
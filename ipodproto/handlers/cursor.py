@@ -0,0 +1,213 @@
+import threading
+from collections import OrderedDict
+from math import ceil
+from typing import List
+
+from .air import AdvancedRemote, RequestCancelled, monotonic
+
+
+class BrowseCursor:
+    """
+    A paged view of one item type on an iPod, for browsing UIs. Pages are served from a local window, and a
+    background thread prefetches the pages around the cursor while nothing has been asked for, further ahead the
+    faster the user scrolls and the slower the link is.
+
+    Only one GET_ITEM_NAMES can be outstanding at a time, so a page which is asked for always preempts a prefetch.
+    """
+
+    def __init__(self, remote: AdvancedRemote, type: int, page_size: int = 20, max_pages: int = 32,
+                 max_prefetch: int = 4, smoothing: float = 0.3):
+        """
+        :param remote: The remote to fetch names through.
+        :param type: The item type to browse; one of `AirMode.Types`.
+        :param page_size: The number of names in each page.
+        :param max_pages: The most pages to keep in the local window.
+        :param max_prefetch: The most pages to prefetch in the direction of scrolling.
+        :param smoothing: The weight given to each new sample of the scroll speed and round trip time.
+        """
+        self.remote = remote
+        self.type = type
+        self.page_size = page_size
+        self.max_pages = max_pages
+        self.max_prefetch = max_prefetch
+        self.smoothing = smoothing
+
+        self.count = remote.get_item_count(type)
+
+        # Smoothed scroll speed in pages per second, and time to fetch one page in seconds
+        self.speed = 0.0
+        self.rtt = None
+
+        self.hits = 0
+        self.misses = 0
+        self.prefetched = 0
+
+        self._pages = OrderedDict()
+        # Pages whose prefetch timed out, which are only fetched again when they are asked for
+        self._failed = set()
+        self._current = 0
+        self._direction = 1
+        self._last_access = None
+
+        self._wanted = None
+        self._fetching = None
+        self._running = True
+        self._condition = threading.Condition()
+
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    @property
+    def page_count(self) -> int:
+        return (self.count + self.page_size - 1) // self.page_size
+
+    def page(self, number: int, timeout: float = None) -> List[str]:
+        """
+        Gets a page of names, waiting for it to be fetched if it isn't in the window.
+        :param number: The page number.
+        :param timeout: The longest to wait for the page, in seconds. Defaults to four times the remote's timeout.
+        :return: The names on the page.
+        """
+        if not 0 <= number < self.page_count:
+            raise IndexError("Page out of range: {}".format(number))
+
+        with self._condition:
+            self._moved_to(number)
+
+            names = self._pages.get(number)
+            if names is not None:
+                self.hits += 1
+                self._pages.move_to_end(number)
+                self._condition.notify_all()
+                return names
+
+            self.misses += 1
+            self._wanted = number
+            if self._fetching is not None and self._preempted(self._fetching[0]) and self._fetching[1] is not None:
+                # Whatever is being prefetched can wait
+                self._fetching[1].cancel()
+            self._condition.notify_all()
+
+            if timeout is None:
+                timeout = self.remote.timeout * 4
+            if not self._condition.wait_for(lambda: number in self._pages or not self._running, timeout):
+                raise TimeoutError("Page {} was not received".format(number))
+            if not self._running:
+                raise RequestCancelled()
+
+            return self._pages[number]
+
+    def close(self) -> None:
+        """
+        Stops prefetching. Any outstanding request is cancelled.
+        """
+        with self._condition:
+            self._running = False
+            if self._fetching is not None and self._fetching[1] is not None:
+                self._fetching[1].cancel()
+            self._condition.notify_all()
+
+        self._thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _moved_to(self, number):
+        now = monotonic()
+        if self._last_access is not None and number != self._current:
+            elapsed = max(now - self._last_access, 1e-3)
+            self.speed += self.smoothing * (abs(number - self._current) / elapsed - self.speed)
+            self._direction = 1 if number > self._current else -1
+        self._last_access = now
+        self._current = number
+
+    def prefetch_distance(self) -> int:
+        """
+        :return: How many pages ahead of the cursor to prefetch: enough to cover the pages scrolled through while
+        one page is fetched, and at least one.
+        """
+        if self.rtt is None:
+            return 1
+
+        return max(1, min(self.max_prefetch, int(ceil(self.speed * self.rtt)) + 1))
+
+    def _next_page(self):
+        """
+        :return: The page which should be fetched next, or None if there's nothing to do.
+        """
+        if self._wanted is not None and self._wanted not in self._pages:
+            return self._wanted
+
+        # The next pages in the direction of travel, then the one behind
+        candidates = [self._current + self._direction * i for i in range(1, self.prefetch_distance() + 1)]
+        candidates.append(self._current - self._direction)
+
+        for number in candidates:
+            if 0 <= number < self.page_count and number not in self._pages and number not in self._failed:
+                return number
+
+        return None
+
+    def _preempted(self, number):
+        """
+        :return: Whether a page being fetched should give way, because the cursor is closing or another page was
+        asked for.
+        """
+        return not self._running or (self._wanted is not None and self._wanted != number and
+                                     self._wanted not in self._pages)
+
+    def _evict(self):
+        # Drop the pages furthest from the cursor first
+        while len(self._pages) > self.max_pages:
+            furthest = max(self._pages, key=lambda n: abs(n - self._current))
+            del self._pages[furthest]
+
+    def _run(self):
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: not self._running or self._next_page() is not None)
+                if not self._running:
+                    return
+
+                number = self._next_page()
+                # Taken before the request is sent, so that a page asked for meanwhile knows to preempt it
+                self._fetching = (number, None)
+
+            # Sending blocks on the stream, so it mustn't hold up page() or close()
+            start = number * self.page_size
+            began = monotonic()
+            request = self.remote.get_item_names_async(self.type, start, min(self.page_size, self.count - start))
+
+            with self._condition:
+                self._fetching = (number, request)
+                if self._preempted(number):
+                    request.cancel()
+
+            try:
+                names = request.result(self.remote.timeout * 4)
+            except (RequestCancelled, TimeoutError):
+                names = None
+
+            with self._condition:
+                self._fetching = None
+
+                if names is not None:
+                    sample = monotonic() - began
+                    self.rtt = sample if self.rtt is None else self.rtt + self.smoothing * (sample - self.rtt)
+
+                    if number != self._wanted:
+                        self.prefetched += 1
+                    self._pages[number] = names
+                    self._failed.discard(number)
+                    self._evict()
+                elif not request.cancelled:
+                    # Give up on a page that timed out, rather than hammering the link with it
+                    if number == self._wanted:
+                        self._wanted = None
+                    else:
+                        self._failed.add(number)
+
+                self._condition.notify_all()
@@ -1,8 +1,177 @@
+import random
 import threading
+from collections import deque
+from itertools import islice
 
 import time
 
 from ..protocol import *
+from ..browse import BrowseState
+from ..cache import ResponseCache
+from ..catalog import MAIN_PLAYLIST
+from ..events import ButtonChanged
+from ..playqueue import PlayQueue
+
+
+# Queries whose responses depend only on the emulator's state, and so can be cached until it changes
+CACHEABLE_COMMANDS = frozenset((
+    AirMode.Commands.GET_IPOD_TYPE,
+    AirMode.Commands.GET_IPOD_NAME,
+    AirMode.Commands.GET_TYPE_COUNT,
+    AirMode.Commands.GET_PLAYLIST_POS,
+    AirMode.Commands.GET_SONG_TITLE,
+    AirMode.Commands.GET_SONG_ARTIST,
+    AirMode.Commands.GET_SONG_ALBUM,
+    AirMode.Commands.GET_SHUFFLE_MODE,
+    AirMode.Commands.GET_REPEAT_MODE,
+    AirMode.Commands.GET_SCREEN_SIZE,
+    AirMode.Commands.GET_PLAYLIST_SIZE,
+))
+
+# Commands which change the browse selection, the playlist or the current track
+STATE_CHANGING_COMMANDS = frozenset((
+    AirMode.Commands.SWITCH_MAIN_PLAYLIST,
+    AirMode.Commands.SWITCH_ITEM,
+    AirMode.Commands.EXEC_PLAYLIST_JUMP,
+    AirMode.Commands.PLAYBACK_CONTROL,
+    AirMode.Commands.SET_SHUFFLE_MODE,
+    AirMode.Commands.SET_REPEAT_MODE,
+    AirMode.Commands.PLAYLIST_JUMP,
+))
+
+
+# The method called when each Simple Remote button is pressed
+SIMPLE_REMOTE_ACTIONS = {
+    SimpleRemoteMode.Buttons.PLAY_PAUSE: 'play_pause',
+    SimpleRemoteMode.Buttons.VOLUME_UP: 'volume_up',
+    SimpleRemoteMode.Buttons.VOLUME_DOWN: 'volume_down',
+    SimpleRemoteMode.Buttons.NEXT_SONG: 'skip_forward',
+    SimpleRemoteMode.Buttons.PREV_SONG: 'skip_backward',
+    SimpleRemoteMode.Buttons.NEXT_ALBUM: 'next_album',
+    SimpleRemoteMode.Buttons.PREV_ALBUM: 'prev_album',
+    SimpleRemoteMode.Buttons.STOP: 'stop_playing',
+    SimpleRemoteMode.Buttons.PLAY: 'play',
+    SimpleRemoteMode.Buttons.PAUSE: 'pause',
+    SimpleRemoteMode.Buttons.MUTE: 'mute',
+    SimpleRemoteMode.Buttons.NEXT_PLAYLIST: 'next_playlist',
+    SimpleRemoteMode.Buttons.PREV_PLAYLIST: 'prev_playlist',
+    SimpleRemoteMode.Buttons.SHUFFLE: 'shuffle',
+    SimpleRemoteMode.Buttons.REPEAT: 'repeat',
+    SimpleRemoteMode.Buttons.IPOD_OFF: 'off',
+    SimpleRemoteMode.Buttons.IPOD_ON: 'on',
+    SimpleRemoteMode.Buttons.MENU_BUTTON: 'menu',
+    SimpleRemoteMode.Buttons.OK_SELECT_BUTTON: 'select',
+    SimpleRemoteMode.Buttons.SCROLL_UP: 'scroll_up',
+    SimpleRemoteMode.Buttons.SCROLL_DOWN: 'scroll_down',
+}
+
+
+def _log_burst_error():
+    # logging is slow to import, and only needed once something has gone wrong
+    import logging
+
+    logging.getLogger(__name__).exception("Item name burst failed; the rest of it won't be sent")
+
+
+class BurstSender:
+    """
+    Sends the frames produced by a generator from a background thread. Only one job runs at a time, and it can be
+    replaced or cancelled between any two batches of frames, so a long burst never delays handling of the next
+    command.
+    """
+
+    def __init__(self, send, max_in_flight=1):
+        """
+        :param send: Called with the packed bytes of each batch of frames, and the number of frames.
+        :param max_in_flight: The most frames packed ahead of the stream; also how many frames may still be sent
+        after a job is cancelled.
+        """
+        self._send = send
+        self.max_in_flight = max_in_flight
+
+        self.preempted = 0
+        self.errors = 0
+
+        self._job = None
+        self._running = False
+        self._thread = None
+        self._condition = threading.Condition()
+
+    @property
+    def busy(self):
+        return self._job is not None
+
+    def start(self, frames):
+        """
+        Starts sending a new job, abandoning the current one if there is one.
+        :param frames: An iterator of packed frames.
+        """
+        with self._condition:
+            if self._job is not None:
+                self.preempted += 1
+            self._job = frames
+
+            if self._thread is None:
+                self._running = True
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+
+            self._condition.notify_all()
+
+    def cancel(self):
+        """
+        Abandons the current job, if there is one.
+        """
+        with self._condition:
+            if self._job is not None:
+                self.preempted += 1
+                self._job = None
+                self._condition.notify_all()
+
+    def wait(self, timeout=None):
+        """
+        Waits until there is no job running.
+        :return: True if the sender is idle.
+        """
+        with self._condition:
+            return self._condition.wait_for(lambda: self._job is None, timeout)
+
+    def stop(self):
+        with self._condition:
+            self._job = None
+            self._running = False
+            self._condition.notify_all()
+
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+        self._thread = None
+
+    def _run(self):
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: self._job is not None or not self._running)
+                if not self._running:
+                    return
+                job = self._job
+
+            try:
+                batch = list(islice(job, self.max_in_flight))
+            except Exception:
+                # A broken job shouldn't take the sender down with it, but the accessory is left waiting, so say why
+                self.errors += 1
+                batch = []
+                _log_burst_error()
+
+            with self._condition:
+                if self._job is not job:
+                    # Replaced while we were packing, so the batch is stale
+                    continue
+                if not batch:
+                    self._job = None
+                    self._condition.notify_all()
+                    continue
+
+            self._send(b''.join(batch), len(batch))
 
 
 class IpodEmulator(IpodProtocolHandler):
@@ -10,19 +179,30 @@ class IpodEmulator(IpodProtocolHandler):
     Used for client devices that wish to emulate an iPod in order to interface with an accessory.
     """
 
-    def __init__(self, *args, **kwargs):
+    def __init__(self, *args, catalog=None, response_cache=None, burst_in_flight=1, **kwargs):
+        """
+        :param catalog: An optional `Catalog` to serve item names and counts from. Without one, the `get_*_name` and
+        `get_*_count` methods should be overridden.
+        :param response_cache: A `ResponseCache` for answering repeated queries. One is created by default when a
+        catalog is given. Subclasses which use a cache and keep their own state must call `state_changed()` whenever
+        it changes; setting `ipod_type`, `ipod_name` or `screen_size` calls it already.
+        :param burst_in_flight: How many RES_ITEM_NAME frames may be packed ahead of the stream by the burst sender.
+        """
         super().__init__(*args, **kwargs)
 
+        self.catalog = catalog
+        self.browse = BrowseState(catalog) if catalog is not None else None
+
         self.mode = MODE_SWITCH
 
         # Who knows what this actually does. Apparently it should be reset when changing tracks, though.
         self.flag_ncu_0b = 0x00
 
         # Pick some random ipod type to begin with
-        self.ipod_type = IPOD_TYPE_GEN5_30GB
+        self._ipod_type = IPOD_TYPE_GEN5_30GB
 
         # Default iPod name
-        self.ipod_name = "iPod"
+        self._ipod_name = "iPod"
 
         self.status = STATUS_STOP
 
@@ -34,9 +214,49 @@ class IpodEmulator(IpodProtocolHandler):
         self.shuffle_mode = SHUFFLE_OFF
         self.repeat_mode = REPEAT_OFF
 
-        self.screen_size = (310, 168)
+        # With a catalog, the songs queued to play, starting with the whole library. EXEC_PLAYLIST_JUMP replaces it
+        # with whatever the accessory has browsed to.
+        self.shuffle_seed = None
+        self.queue = PlayQueue.from_playlist(catalog, MAIN_PLAYLIST) if catalog is not None else None
+
+        self._screen_size = (310, 168)
+
+        if response_cache is None and catalog is not None:
+            response_cache = ResponseCache()
+        self.response_cache = response_cache
+
+        # The Simple Remote buttons currently held down
+        self.buttons = 0
+
+        # Bumped whenever anything a cached response depends on changes
+        self.state_version = 0
+        # Responses sent while handling a cacheable command are collected here instead
+        self._captured = None
+
+        # Item name listings are sent in the background, so that a new command can preempt them
+        self.bursts = BurstSender(self.send_bytes, burst_in_flight)
+
+        # The latest catalog passed to `swap_catalog`, and the state prepared for it, until it is put in place before
+        # the next packet
+        self._requested_catalog = None
+        self._next_catalog = deque(maxlen=1)
+        # Bumped whenever a new catalog is put in place
+        self.catalog_version = 0
+
+        if self.metrics is not None:
+            self.metrics.gauge('state_version', lambda: self.state_version)
+            self.metrics.gauge('catalog_version', lambda: self.catalog_version)
+            self.metrics.gauge('bursts_preempted', lambda: self.bursts.preempted)
+            self.metrics.gauge('burst_errors', lambda: self.bursts.errors)
+            if self.response_cache is not None:
+                self.metrics.gauge('cache_entries', lambda: len(self.response_cache))
+                self.metrics.gauge('cache_hits', lambda: self.response_cache.hits)
+                self.metrics.gauge('cache_misses', lambda: self.response_cache.misses)
 
     def packet_received(self, packet: IpodPacket):
+        if self._next_catalog:
+            self._apply_catalog(*self._next_catalog.pop())
+
         if packet.mode == MODE_SWITCH:
             self.handle_mode_switch_command(packet.command)
         elif packet.mode == MODE_VOICE_RECORDER:
@@ -46,18 +266,32 @@ class IpodEmulator(IpodProtocolHandler):
         elif packet.mode == MODE_REQUEST_MODE_STATUS:
             self.handle_request_mode_status_command(packet.command)
         elif packet.mode == MODE_ADVANCED_REMOTE:
-            self.handle_advanced_remote_command(packet.command)
+            if self.metrics is not None or self.tracer is not None:
+                self._handle_measured(packet.command)
+            else:
+                self.handle_advanced_remote_command(packet.command)
+
+    def _handle_measured(self, cmd: AirCommand):
+        clock = self.tracer.clock if self.tracer is not None else time.monotonic
+        started = clock()
+
+        self.handle_advanced_remote_command(cmd)
+
+        if self.metrics is not None:
+            self.metrics.observe(cmd.id, clock() - started)
+        if self.tracer is not None:
+            self.tracer.complete('handler', started, args={'mode': MODE_ADVANCED_REMOTE, 'id': cmd.id})
 
     def handle_mode_switch_command(self, cmd: SwitchModeCommand):
         if cmd.id == SwitchMode.Commands.SET_VOICE_RECORDER:
             self.mode = MODE_VOICE_RECORDER
-        elif cmd == SwitchMode.Commands.SET_IPOD_REMOTE or \
-                cmd == SwitchMode.Commands.SET_IPOD_REMOTE_ALT:
+        elif cmd.id == SwitchMode.Commands.SET_IPOD_REMOTE or \
+                cmd.id == SwitchMode.Commands.SET_IPOD_REMOTE_ALT:
             self.mode = MODE_SIMPLE_REMOTE
-        elif cmd == SwitchMode.Commands.SET_ADVANCED_REMOTE or \
-                cmd == SwitchMode.Commands.SET_ADVANCED_REMOTE_ALT:
+        elif cmd.id == SwitchMode.Commands.SET_ADVANCED_REMOTE or \
+                cmd.id == SwitchMode.Commands.SET_ADVANCED_REMOTE_ALT:
             self.mode = MODE_ADVANCED_REMOTE
-        elif cmd == SwitchMode.Commands.GET_MODE:
+        elif cmd.id == SwitchMode.Commands.GET_MODE:
             self._send_get_mode_response()
 
     def _send_get_mode_response(self):
@@ -83,37 +317,55 @@ class IpodEmulator(IpodProtocolHandler):
         pass
 
     def handle_simple_remote_command(self, cmd: SimpleRemoteCommand):
-        command_map = {
-            SimpleRemoteMode.Commands.BUTTON_RELEASED: self.on_button_released,
-            SimpleRemoteMode.Commands.PLAY: self.play,
-            SimpleRemoteMode.Commands.PAUSE: self.pause,
-            SimpleRemoteMode.Commands.PLAY_PAUSE: self.play_pause,
-            SimpleRemoteMode.Commands.VOLUME_UP: self.volume_up,
-            SimpleRemoteMode.Commands.VOLUME_DOWN: self.volume_down,
-            SimpleRemoteMode.Commands.NEXT_SONG: self.skip_forward,
-            SimpleRemoteMode.Commands.PREV_SONG: self.skip_backward,
-            SimpleRemoteMode.Commands.NEXT_ALBUM: self.next_album,
-            SimpleRemoteMode.Commands.PREV_ALBUM: self.prev_album,
-            SimpleRemoteMode.Commands.STOP: self.stop_playing,
-            SimpleRemoteMode.Commands.MUTE: self.mute,
-            SimpleRemoteMode.Commands.NEXT_PLAYLIST: self.next_playlist,
-            SimpleRemoteMode.Commands.PREV_PLAYLIST: self.prev_playlist,
-            SimpleRemoteMode.Commands.SHUFFLE: self.shuffle,
-            SimpleRemoteMode.Commands.REPEAT: self.repeat,
-            SimpleRemoteMode.Commands.IPOD_OFF: self.off,
-            SimpleRemoteMode.Commands.IPOD_ON: self.on,
-            SimpleRemoteMode.Commands.MENU_BUTTON: self.menu,
-            SimpleRemoteMode.Commands.OK_SELECT_BUTTON: self.select,
-            SimpleRemoteMode.Commands.SCROLL_UP: self.scroll_up,
-            SimpleRemoteMode.Commands.SCROLL_DOWN: self.scroll_down,
-        }
-
-        if cmd not in command_map:
-            raise ValueError("Invalid command for simple remote mode: " + str(cmd))
-
-        command_map[cmd]()
+        self.handle_button_state(button_mask(cmd.id))
+
+    def handle_button_state(self, mask: int):
+        """
+        Compares a Simple Remote button state with the previous one, and handles each button which was pressed or
+        released. Each frame only costs as much as the number of buttons which changed.
+        :param mask: A bitmask of `SimpleRemoteMode.Buttons` held down.
+        """
+        changed = mask ^ self.buttons
+        self.buttons = mask
+        pressed = False
+
+        while changed:
+            button = changed & -changed
+            changed ^= button
+
+            if mask & button:
+                self.on_button_down(button)
+                pressed = True
+            else:
+                self.on_button_up(button)
+
+            if self.events is not None:
+                self.events.publish(ButtonChanged(self, button, bool(mask & button)))
+
+        if not mask:
+            self.on_button_released()
+        if pressed:
+            self.state_changed()
+
+    def on_button_down(self, button: int):
+        """
+        Called for each button which is newly held down, including each button of a chord. Performs the button's
+        action by default.
+        """
+        action = SIMPLE_REMOTE_ACTIONS.get(button)
+        if action is not None:
+            getattr(self, action)()
+
+    def on_button_up(self, button: int):
+        """
+        Called for each button which is no longer held down.
+        """
+        pass
 
     def on_button_released(self):
+        """
+        Called whenever no buttons are held down.
+        """
         pass
 
     def play(self):
@@ -141,10 +393,18 @@ class IpodEmulator(IpodProtocolHandler):
         pass
 
     def skip_forward(self):
-        pass
+        """
+        Moves the queue to the next song, if there is one. Overrides which play the song should call this.
+        """
+        if self.queue is not None:
+            self.queue.skip_forward(self.repeat_mode)
 
     def skip_backward(self):
-        pass
+        """
+        Moves the queue to the previous song, if there is one. Overrides which play the song should call this.
+        """
+        if self.queue is not None:
+            self.queue.skip_backward(self.repeat_mode)
 
     def next_album(self):
         pass
@@ -191,7 +451,177 @@ class IpodEmulator(IpodProtocolHandler):
     def handle_request_mode_status_command(self, cmd: RequestModeStatusCommand):
         self._send_get_mode_response()
 
+    def swap_catalog(self, catalog):
+        """
+        Replaces the catalog, such as after a rescan of the library, without dropping the session. May be called from
+        any thread. The new catalog is put in place just before the next packet is handled, so every command sees one
+        version or the other. Listings which are still being sent carry on with the catalog they started with.
+
+        The browse selection, the playlist and the current song are found by name in the new catalog, and kept if they
+        are still there. That, and building the new play queue, is done on the calling thread, so that handling the
+        next packet only has to put the results in place. If the accessory changes any of them in the meantime, the
+        swap is prepared again in the background.
+
+        The old catalog isn't closed, since a listing may still be reading it; it is released once nothing refers to
+        it any more.
+        :param catalog: The new `Catalog`.
+        """
+        self._requested_catalog = catalog
+        self._prepare_catalog(catalog)
+
+    def _prepare_catalog(self, catalog):
+        # Anything the accessory changes from here on bumps the version, and makes this out of date
+        version = self.state_version
+        old, selection, queue = self.catalog, self.browse.selection if self.browse is not None else {}, self.queue
+
+        browse = BrowseState(catalog)
+        playlist = MAIN_PLAYLIST
+        current = None
+        if old is not None:
+            for type, index in selection.items():
+                found = catalog.find(type, old.name(type, index))
+                if found is not None:
+                    browse.selection[type] = found
+
+            # A queue of anything but a whole playlist goes back to being the whole library
+            if queue.playlist is not None:
+                found = catalog.find(AirMode.Types.PLAYLIST, old.name(AirMode.Types.PLAYLIST, queue.playlist))
+                if found is not None:
+                    playlist = found
+
+            song = queue.current
+            if song is not None:
+                current = self._find_song(catalog, old.name(AirMode.Types.SONG, song),
+                                          old.name(AirMode.Types.ARTIST, old.song_artist(song)),
+                                          old.name(AirMode.Types.ALBUM, old.song_album(song)))
+
+        queue = PlayQueue.from_playlist(catalog, playlist, self.shuffle_mode, self.shuffle_seed)
+        # Keep playing the same song if it's still queued
+        position = queue.find(current) if current is not None else None
+        if position is not None:
+            queue.jump(position)
+
+        if catalog is self._requested_catalog:
+            self._next_catalog.append((catalog, browse, queue, version))
+
+    def _apply_catalog(self, catalog, browse, queue, version):
+        if catalog is not self._requested_catalog:
+            # Superseded by a newer one while it was being prepared again
+            return
+        if version != self.state_version:
+            # The selection or the queue changed since it was prepared, so carry the new ones over instead
+            threading.Thread(target=self._prepare_catalog, args=(catalog,), daemon=True).start()
+            return
+
+        self.catalog = catalog
+        self.browse = browse
+        self.queue = queue
+        if self.response_cache is None:
+            self.response_cache = ResponseCache()
+
+        self.catalog_version += 1
+        self.state_changed()
+
+    @staticmethod
+    def _find_song(catalog, title, artist, album):
+        song = catalog.find(AirMode.Types.SONG, title)
+        if song is None:
+            return None
+
+        # Songs with the same title are next to each other
+        count = catalog.count(AirMode.Types.SONG)
+        while song < count and catalog.name(AirMode.Types.SONG, song).casefold() == title.casefold():
+            if (catalog.name(AirMode.Types.ARTIST, catalog.song_artist(song)) == artist and
+                    catalog.name(AirMode.Types.ALBUM, catalog.song_album(song)) == album):
+                return song
+            song += 1
+
+        return None
+
+    def song_finished(self):
+        """
+        Should be called by subclasses when the current song plays to the end. Moves the queue on according to the
+        repeat mode.
+        :return: False if the queue has finished.
+        """
+        more = self.queue.song_finished(self.repeat_mode) if self.queue is not None else False
+        self.state_changed()
+        return more
+
+    def state_changed(self):
+        """
+        Invalidates every cached response. Called automatically for commands which change the state; subclasses
+        should call it when the state changes for any other reason, such as a track finishing.
+        """
+        self.state_version += 1
+
+    # The identity queries are cached, so changing what they answer must invalidate the cache
+
+    @property
+    def ipod_type(self):
+        return self._ipod_type
+
+    @ipod_type.setter
+    def ipod_type(self, ipod_type):
+        self._ipod_type = ipod_type
+        self.state_changed()
+
+    @property
+    def ipod_name(self):
+        return self._ipod_name
+
+    @ipod_name.setter
+    def ipod_name(self, ipod_name):
+        self._ipod_name = ipod_name
+        self.state_changed()
+
+    @property
+    def screen_size(self):
+        return self._screen_size
+
+    @screen_size.setter
+    def screen_size(self, screen_size):
+        self._screen_size = screen_size
+        self.state_changed()
+
+    def stop(self):
+        super().stop()
+        self.bursts.stop()
+
     def handle_advanced_remote_command(self, cmd: AirCommand):
+        if cmd.id in STATE_CHANGING_COMMANDS:
+            # Anything still being listed is about to be out of date
+            self.bursts.cancel()
+
+        cache = self.response_cache
+
+        if cache is None or cmd.id not in CACHEABLE_COMMANDS:
+            self.dispatch_advanced_remote_command(cmd)
+
+            if cmd.id in STATE_CHANGING_COMMANDS:
+                self.state_changed()
+            return
+
+        # Every cacheable command has an integer parameter or none at all
+        parameters = cmd.parameters
+        key = (cmd.id, parameters if isinstance(parameters, int) else None, self.state_version)
+
+        data = cache.get(key)
+        if data is None:
+            self._captured = []
+            try:
+                self.dispatch_advanced_remote_command(cmd)
+                data = b''.join(self._captured)
+            finally:
+                self._captured = None
+            cache.put(key, data)
+        elif self.metrics is not None and data:
+            # Cached responses are a single AiR frame, whose id follows the mode
+            self.metrics.sent(MODE_ADVANCED_REMOTE, int.from_bytes(data[4:6], 'big'))
+
+        self.send_bytes(data)
+
+    def dispatch_advanced_remote_command(self, cmd: AirCommand):
         if cmd.id == AirMode.Commands.NCU_02:
             # Simple ping command
             self._handle_ping()
@@ -212,7 +642,7 @@ class IpodEmulator(IpodProtocolHandler):
         elif cmd.id == AirMode.Commands.SWITCH_ITEM:
             self.switch_item(cmd.parameters.type, cmd.parameters.number)
         elif cmd.id == AirMode.Commands.GET_TYPE_COUNT:
-            self.handle_get_item_count_command(cmd.parameters.type)
+            self.handle_get_item_count_command(cmd.parameters)
         elif cmd.id == AirMode.Commands.GET_ITEM_NAMES:
             self.handle_get_item_names_command(cmd.parameters.type,
                                                cmd.parameters.start,
@@ -254,19 +684,37 @@ class IpodEmulator(IpodProtocolHandler):
             # TODO: This is some sort of color get-screen-size command
             pass
 
+    def get_playlist_song(self, position):
+        """
+        :param position: A position in the queue, in play order.
+        :return: The catalog index of the song at that position.
+        """
+        return self.queue.song(position)
+
     def jump_to_song(self, number):
-        pass
+        """
+        Moves to a position in the queue, in play order. Positions past the end are ignored.
+        """
+        if self.queue is not None:
+            self.queue.jump(number)
 
     def handle_playlist_jump_command(self, number):
         self.jump_to_song(number)
 
     def get_playlist_size(self):
+        """
+        :return: The number of songs in the queue.
+        """
+        if self.queue is not None:
+            return len(self.queue)
+
         return 0
 
     def handle_get_playlist_size_command(self):
         res = AirCommand()
         res.id = AirMode.Commands.RES_PLAYLIST_SIZE
         res.parameters = self.get_playlist_size()
+        self.send_air_response(res)
 
     def handle_get_screen_size_command(self):
         res = AirCommand()
@@ -289,6 +737,11 @@ class IpodEmulator(IpodProtocolHandler):
         if mode in (SHUFFLE_OFF, SHUFFLE_SONGS, SHUFFLE_ALBUMS):
             self.shuffle_mode = mode
 
+            if self.queue is not None:
+                # Every time shuffle is turned on, the order should be different
+                self.shuffle_seed = random.getrandbits(32)
+                self.queue.shuffle(mode, self.shuffle_seed)
+
     def handle_get_shuffle_mode_command(self):
         res = AirCommand()
         res.id = AirMode.Commands.RES_SHUFFLE_MODE
@@ -313,11 +766,17 @@ class IpodEmulator(IpodProtocolHandler):
 
     def handle_execute_playlist_jump_command(self, position):
         """
-        I'm not exactly sure what this does... is it only for playlists? Or for all types of 'playlists'? It definitely
-        couldn't apply for songs...
-        :param position:
-        :return:
+        Queues the songs the accessory has browsed to, and moves to one of them. Subclasses without a catalog should
+        override this.
+        :param position: The position of the song to start from in the browsed song list, rather than in play order,
+        so that the song picked plays first even when shuffle is on.
         """
+        if self.browse is None:
+            return
+
+        self.queue = PlayQueue.from_browse(self.browse, self.shuffle_mode, self.shuffle_seed)
+        if 0 <= position < len(self.queue):
+            self.queue.jump(self.queue.order.index(position))
 
     def _poll(self):
         packet = IpodPacket()
@@ -331,9 +790,9 @@ class IpodEmulator(IpodProtocolHandler):
             time.sleep(0.5)
 
     def start_polling(self):
-        if not self.polling_thread:
-            self.polling_thread = threading.Thread(target=self._poll)
-        if self.polling_thread:
+        self.polling = True
+        if not self.polling_thread or not self.polling_thread.is_alive():
+            self.polling_thread = threading.Thread(target=self._poll, daemon=True)
             self.polling_thread.start()
 
     def stop_polling(self):
@@ -345,13 +804,29 @@ class IpodEmulator(IpodProtocolHandler):
         else:
             self.stop_polling()
 
+    def get_song_title(self, number):
+        if self.catalog is not None:
+            return self.catalog.name(AirMode.Types.SONG, self.get_playlist_song(number))
+
+        return self.get_song_name(number)
+
     def get_song_album_name(self, number):
+        if self.catalog is not None:
+            return self.catalog.name(AirMode.Types.ALBUM, self.catalog.song_album(self.get_playlist_song(number)))
+
         return "Song {} Album Name".format(number)
 
     def get_song_artist_name(self, number):
+        if self.catalog is not None:
+            return self.catalog.name(AirMode.Types.ARTIST, self.catalog.song_artist(self.get_playlist_song(number)))
+
         return "Song {} Artist Name".format(number)
 
     def handle_get_song_album_command(self, number):
+        if not self._queued(number):
+            self.send_feedback(AirMode.Commands.GET_SONG_ALBUM, RESULT_FAILURE)
+            return
+
         res = AirCommand()
         res.id = AirMode.Commands.RES_SONG_ALBUM
         res.parameters = StringField()
@@ -359,6 +834,10 @@ class IpodEmulator(IpodProtocolHandler):
         self.send_air_response(res)
 
     def handle_get_song_artist_command(self, number):
+        if not self._queued(number):
+            self.send_feedback(AirMode.Commands.GET_SONG_ARTIST, RESULT_FAILURE)
+            return
+
         res = AirCommand()
         res.id = AirMode.Commands.RES_SONG_ARTIST
         res.parameters = StringField()
@@ -367,17 +846,31 @@ class IpodEmulator(IpodProtocolHandler):
 
     def handle_get_song_title_command(self, number):
         # I don't think this is very different from the range ones
+        if not self._queued(number):
+            self.send_feedback(AirMode.Commands.GET_SONG_TITLE, RESULT_FAILURE)
+            return
+
         res = AirCommand()
         res.id = AirMode.Commands.RES_SONG_TITLE
         res.parameters = StringField()
-        res.parameters.text = self.get_song_name(number)
+        res.parameters.text = self.get_song_title(number)
         self.send_air_response(res)
 
+    def _queued(self, position):
+        """
+        :return: Whether there is a song at a position in the queue. Without a catalog, every position is assumed to
+        be.
+        """
+        return self.queue is None or 0 <= position < len(self.queue)
+
     def get_playlist_position(self):
         """
         The current track's position in the playlist
         :return: The index of the current track in the current playlist
         """
+        if self.queue is not None:
+            return self.queue.position
+
         return 0
 
     def handle_get_playlist_position_command(self):
@@ -392,6 +885,9 @@ class IpodEmulator(IpodProtocolHandler):
         Currently playing track length in milliseconds
         :return: The length of the currently playing track in milliseconds
         """
+        if self.queue is not None and self.queue.current is not None:
+            return self.catalog.song_length(self.queue.current)
+
         return 0
 
     def get_elapsed_time(self):
@@ -406,8 +902,9 @@ class IpodEmulator(IpodProtocolHandler):
         res.id = AirMode.Commands.RES_TIME_STATUS
         res.parameters = TimeStatusResult()
         res.parameters.length = self.get_current_track_length()
-        res.parameters.time = self.get_elapsed_time()
+        res.parameters.elapsed = self.get_elapsed_time()
         res.parameters.status = self.status
+        self.send_air_response(res)
 
     def get_playlist_name(self, id):
         return "Playlist {}".format(id)
@@ -428,22 +925,48 @@ class IpodEmulator(IpodProtocolHandler):
         return "Composer {}".format(id)
 
     def get_item_name(self, type, number):
+        if self.browse is not None:
+            return self.browse.name(type, number)
+
         if type == AirMode.Types.PLAYLIST:
-            self.get_playlist_name(number)
+            return self.get_playlist_name(number)
         elif type == AirMode.Types.ARTIST:
-            self.get_artist_name(number)
+            return self.get_artist_name(number)
         elif type == AirMode.Types.ALBUM:
-            self.get_album_name(number)
+            return self.get_album_name(number)
         elif type == AirMode.Types.GENRE:
-            self.get_genre_name(number)
+            return self.get_genre_name(number)
         elif type == AirMode.Types.SONG:
-            self.get_song_name(number)
+            return self.get_song_name(number)
         elif type == AirMode.Types.COMPOSER:
-            self.get_composer_name(number)
+            return self.get_composer_name(number)
 
     def handle_get_item_names_command(self, type, start, length):
-        names = (self.get_item_name(type, id) for id in range(start, start + length))
+        """
+        Starts listing the requested names in the background, replacing any listing which is still in progress.
+        Without a catalog, `get_item_name` is called from the burst sender's thread.
+        """
+        self.bursts.start(self.item_name_frames(type, start, length))
+
+    def item_name_frames(self, type, start, length):
+        """
+        :return: A generator of packed RES_ITEM_NAME frames for the given range, which looks up each name as it is
+        needed. Names come from the catalog and browse view in use when this is called, even if another is swapped
+        in or selected meanwhile.
+        """
+        browse = self.browse
+        if browse is None:
+            return self._item_name_frames(type, start, length, self.get_item_name)
+
+        # The generator runs on the burst sender's thread, so the view is resolved here, where a SWITCH_ITEM can't
+        # replace the selection while it is being built
+        view = browse.view(type)
+        catalog = browse.catalog
+        length = min(length, max(0, len(view) - start))
 
+        return self._item_name_frames(type, start, length, lambda type, number: catalog.name(type, view[number]))
+
+    def _item_name_frames(self, type, start, length, get_item_name):
         # Make a whole packet so we can reuse it
         packet = IpodPacket()
         packet.mode = MODE_ADVANCED_REMOTE
@@ -455,10 +978,12 @@ class IpodEmulator(IpodProtocolHandler):
 
         packet.command = res
 
-        for id, name in enumerate(names):
-            res.parameters.name.text = name
-            res.parameters.offset = start + id
-            self.send_packet(packet)
+        for id in range(start, start + length):
+            res.parameters.name.text = get_item_name(type, id)
+            res.parameters.offset = id
+            if self.metrics is not None:
+                self.metrics.sent(MODE_ADVANCED_REMOTE, res.id)
+            yield packet.pack()
 
     def get_playlist_count(self):
         return 0
@@ -479,6 +1004,9 @@ class IpodEmulator(IpodProtocolHandler):
         return 0
 
     def get_item_count(self, type):
+        if self.browse is not None:
+            return self.browse.count(type)
+
         if type == AirMode.Types.PLAYLIST:
             return self.get_playlist_count()
         elif type == AirMode.Types.ARTIST:
@@ -497,6 +1025,7 @@ class IpodEmulator(IpodProtocolHandler):
         res.id = AirMode.Commands.RES_TYPE_COUNT
 
         res.parameters = self.get_item_count(type)
+        self.send_air_response(res)
 
     def switch_playlist(self, id):
         # We don't actually switch just yet, for some reason?
@@ -518,6 +1047,12 @@ class IpodEmulator(IpodProtocolHandler):
         pass
 
     def switch_item(self, type, number):
+        """
+        Selects an item. With a catalog, a selection of an item which doesn't exist is ignored, as an iPod does.
+        """
+        if self.browse is not None and not self.browse.select(type, number):
+            return
+
         if type == AirMode.Types.PLAYLIST:
             self.switch_playlist(number)
         elif type == AirMode.Types.ARTIST:
@@ -534,12 +1069,14 @@ class IpodEmulator(IpodProtocolHandler):
     def switch_main_playlist(self):
         """
         Should be overridden. Called when the accessory requests to switch to the main playlist, which contains all songs.
+        Resets the browse state when a catalog is in use, so overrides should call this.
         """
-        pass
+        if self.browse is not None:
+            self.browse.reset()
 
     def handle_get_ipod_name_command(self):
         res = AirCommand()
-        res.id = AirMode.Commands.GET_IPOD_NAME
+        res.id = AirMode.Commands.RES_IPOD_NAME
         res.parameters = StringField()
         res.parameters.text = self.ipod_name
 
@@ -559,6 +1096,18 @@ class IpodEmulator(IpodProtocolHandler):
 
         self.send_air_response(res)
 
+    def send_feedback(self, command_id, result):
+        """
+        Answers a command with FEEDBACK, such as RESULT_FAILURE for a command about an item which doesn't exist.
+        """
+        res = AirCommand()
+        res.id = AirMode.Commands.FEEDBACK
+        res.parameters = CommandResultParam()
+        res.parameters.command = command_id
+        res.parameters.result = result
+
+        self.send_air_response(res)
+
     def _handle_ncu_0b_command(self, value):
         res = AirCommand()
         res.id = AirMode.Commands.FEEDBACK
@@ -574,7 +1123,7 @@ class IpodEmulator(IpodProtocolHandler):
         self.send_air_response(res)
 
     def _send_ncu_09_response(self):
-        res = AirCommand
+        res = AirCommand()
         res.id = AirMode.Commands.NCU_0A
         res.parameters = self.flag_ncu_0b
 
@@ -583,6 +1132,7 @@ class IpodEmulator(IpodProtocolHandler):
     def _send_ping_response(self):
         res = AirCommand()
         res.id = AirMode.Commands.NCU_03
+        res.parameters = b'\x00' * 8
 
         self.send_air_response(res)
 
@@ -591,7 +1141,12 @@ class IpodEmulator(IpodProtocolHandler):
         res.mode = MODE_ADVANCED_REMOTE
         res.command = cmd
 
-        self.send_packet(res)
+        if self._captured is not None:
+            if self.metrics is not None:
+                self.metrics.sent(MODE_ADVANCED_REMOTE, cmd.id)
+            self._captured.append(res.pack())
+        else:
+            self.send_packet(res)
 
     def _handle_ping(self):
         self._send_ping_response()
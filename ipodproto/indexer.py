@@ -0,0 +1,272 @@
+"""
+Builds a catalog for `IpodEmulator` from a directory of music files.
+
+    python -m ipodproto.indexer MUSIC_DIR -o library.cat [--workers N] [--name "My iPod"] [--state library.scan]
+
+The tree is walked once, then tags are read by a pool of processes, in chunks so that each worker streams through
+its share of the files. Artists, albums, genres and composers are deduplicated into id tables by the
+`CatalogBuilder`, and `.m3u`/`.m3u8` playlists in the tree become playlists of the songs they list.
+
+With `--state`, the tags read are remembered in a file, and later runs only read the files whose modification time
+or size changed. A running `IpodEmulator` can pick up the new catalog with `swap_catalog`.
+"""
+import argparse
+import json
+import os
+import struct
+import sys
+import time
+
+from .catalog import CatalogBuilder
+from .tags import AUDIO_EXTENSIONS, TagError, Tags, read_tags
+
+PLAYLIST_EXTENSIONS = ('.m3u', '.m3u8')
+
+# The longest name which fits in a RES_ITEM_NAME frame: the length byte covers the mode, the command id, the offset
+# and the terminating NUL as well as the name
+MAX_NAME_BYTES = 255 - 1 - 2 - 4 - 1
+
+
+def fit_name(name):
+    """
+    :return: The name, cut short at a character boundary if it is too long to send.
+    """
+    if name is None:
+        return None
+
+    data = name.encode('utf-8')
+    if len(data) <= MAX_NAME_BYTES:
+        return name
+    return data[:MAX_NAME_BYTES].decode('utf-8', 'ignore')
+
+
+def walk(root):
+    """
+    :return: The audio files and playlists under `root`, each sorted by path.
+    """
+    songs = []
+    playlists = []
+    for directory, subdirectories, files in os.walk(root):
+        subdirectories.sort()
+        for name in sorted(files):
+            if name.startswith('.'):
+                continue
+            extension = os.path.splitext(name)[1].lower()
+            if extension in AUDIO_EXTENSIONS:
+                songs.append(os.path.join(directory, name))
+            elif extension in PLAYLIST_EXTENSIONS:
+                playlists.append(os.path.join(directory, name))
+    return songs, playlists
+
+
+def _read(path):
+    try:
+        return read_tags(path)
+    except (OSError, TagError, ValueError, IndexError, EOFError, struct.error):
+        return None
+
+
+def read_playlist(path):
+    """
+    :return: The normalised paths of the files a playlist lists, in order.
+    """
+    encoding = 'utf-8' if path.lower().endswith('.m3u8') else 'latin-1'
+    directory = os.path.dirname(path)
+    entries = []
+    with open(path, encoding=encoding, errors='replace') as f:
+        for line in f:
+            line = line.strip().lstrip('\ufeff')
+            if not line or line.startswith('#'):
+                continue
+            entries.append(os.path.normpath(os.path.join(directory, line.replace('\\', os.sep))))
+    return entries
+
+
+class IndexStats:
+    def __init__(self):
+        self.files = 0
+        self.songs = 0
+        self.unreadable = 0
+        self.playlists = 0
+        # Files whose tags were read this time, rather than remembered from the last scan
+        self.read = 0
+        self.removed = 0
+        self.elapsed = 0.0
+
+
+class LibraryScanner:
+    """
+    Indexes a music directory again and again, rereading only the files which changed.
+
+    Each file's tags are remembered with its modification time and size, and a file is read again only if either
+    differs on the next scan. The catalog itself is rebuilt from the remembered tags every time, which is cheap next
+    to reading them, so that songs stay sorted and every id table stays dense.
+    """
+
+    STATE_VERSION = 1
+
+    def __init__(self, root, library_name=None, workers=None, chunksize=64):
+        """
+        :param library_name: The name of the main playlist. Defaults to the directory name.
+        :param workers: Processes to read tags with. Defaults to one per core; 1 reads in this process.
+        :param chunksize: Files handed to a worker at a time.
+        """
+        self.root = root
+        self.library_name = library_name or os.path.basename(os.path.abspath(root))
+        self.workers = workers or os.cpu_count() or 1
+        self.chunksize = chunksize
+
+        # Path -> (mtime in ns, size, Tags or None if unreadable)
+        self.entries = {}
+
+    def _read_changed(self, paths, progress):
+        if self.workers == 1 or len(paths) <= self.chunksize:
+            results = map(_read, paths)
+            executor = None
+        else:
+            from concurrent.futures import ProcessPoolExecutor
+
+            executor = ProcessPoolExecutor(self.workers)
+            results = executor.map(_read, paths, chunksize=self.chunksize)
+
+        try:
+            for i, (path, tags) in enumerate(zip(paths, results)):
+                if progress is not None and i % self.chunksize == 0:
+                    progress(i)
+                yield path, tags
+        finally:
+            if executor is not None:
+                executor.shutdown()
+
+    def scan(self, progress=None):
+        """
+        Brings the remembered tags up to date with the directory, and builds a catalog from them.
+        :param progress: Called with the number of changed files read so far, every `chunksize` files.
+        :return: The `CatalogBuilder` and an `IndexStats`.
+        """
+        started = time.monotonic()
+        stats = IndexStats()
+
+        paths, playlists = walk(self.root)
+        stats.files = len(paths)
+
+        entries = {}
+        changed = []
+        for path in paths:
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            path = os.path.normpath(path)
+            previous = self.entries.get(path)
+            if previous is not None and previous[:2] == (st.st_mtime_ns, st.st_size):
+                entries[path] = previous
+            else:
+                entries[path] = (st.st_mtime_ns, st.st_size, None)
+                changed.append(path)
+
+        stats.removed = len(self.entries.keys() - entries.keys())
+        stats.read = len(changed)
+        for path, tags in self._read_changed(changed, progress):
+            mtime, size, _ = entries[path]
+            entries[path] = (mtime, size, tags)
+        self.entries = entries
+
+        builder = CatalogBuilder(self.library_name)
+        handles = {}
+        for path, (_, _, tags) in entries.items():
+            if tags is None:
+                stats.unreadable += 1
+                continue
+
+            handles[path] = builder.add_song(
+                fit_name(tags.title), fit_name(tags.artist), fit_name(tags.album), fit_name(tags.genre),
+                fit_name(tags.composer), min(tags.length, 0xFFFFFFFF))
+            stats.songs += 1
+
+        for path in playlists:
+            try:
+                members = read_playlist(path)
+            except OSError:
+                continue
+            songs = [handles[member] for member in members if member in handles]
+            builder.add_playlist(fit_name(os.path.splitext(os.path.basename(path))[0]), songs)
+            stats.playlists += 1
+
+        stats.elapsed = time.monotonic() - started
+        return builder, stats
+
+    def save(self, path):
+        """
+        Writes the remembered tags to a file, for `load` to pick up in a later process.
+        """
+        state = {
+            'version': self.STATE_VERSION,
+            'root': os.path.abspath(self.root),
+            'entries': {entry: [mtime, size, tags and list(tags)]
+                        for entry, (mtime, size, tags) in self.entries.items()},
+        }
+        temporary = path + '.tmp'
+        with open(temporary, 'w', encoding='utf-8') as f:
+            json.dump(state, f, ensure_ascii=False, separators=(',', ':'))
+        os.replace(temporary, path)
+
+    def load(self, path):
+        """
+        Reads tags remembered by `save`. Nothing is loaded if the file was written by another version or for
+        another directory, so the next scan reads everything.
+        :return: Whether anything was loaded.
+        """
+        with open(path, encoding='utf-8') as f:
+            state = json.load(f)
+        if state.get('version') != self.STATE_VERSION or state.get('root') != os.path.abspath(self.root):
+            return False
+
+        self.entries = {entry: (mtime, size, tags and Tags(*tags))
+                        for entry, (mtime, size, tags) in state['entries'].items()}
+        return True
+
+
+def index(root, library_name=None, workers=None, chunksize=64, progress=None):
+    """
+    Reads every audio file under `root` into a catalog builder.
+    :param library_name: The name of the main playlist. Defaults to the directory name.
+    :param workers: Processes to read tags with. Defaults to one per core; 1 reads in this process.
+    :param chunksize: Files handed to a worker at a time.
+    :param progress: Called with the number of files read so far, every `chunksize` files.
+    :return: The `CatalogBuilder` and an `IndexStats`.
+    """
+    return LibraryScanner(root, library_name, workers, chunksize).scan(progress)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m ipodproto.indexer', description=__doc__.strip().splitlines()[0])
+    parser.add_argument('root', help="the music directory")
+    parser.add_argument('-o', '--output', required=True, help="the catalog file to write")
+    parser.add_argument('--name', help="the library name; defaults to the directory name")
+    parser.add_argument('--workers', type=int, default=None, help="processes to read tags with; one per core by "
+                                                                  "default")
+    parser.add_argument('--chunksize', type=int, default=64, help="files handed to a worker at a time")
+    parser.add_argument('--state', help="remember tags in this file, and only reread files which changed since the "
+                                        "last run with it")
+    args = parser.parse_args(argv)
+
+    def progress(done):
+        print("\r{} files".format(done), end='', file=sys.stderr, flush=True)
+
+    scanner = LibraryScanner(args.root, args.name, args.workers, args.chunksize)
+    if args.state is not None and os.path.exists(args.state):
+        scanner.load(args.state)
+
+    builder, stats = scanner.scan(progress if sys.stderr.isatty() else None)
+    builder.write(args.output)
+    if args.state is not None:
+        scanner.save(args.state)
+
+    print("\r{} songs from {} files ({} read, {} unreadable, {} removed), {} playlists in {:.1f}s".format(
+        stats.songs, stats.files, stats.read, stats.unreadable, stats.removed, stats.playlists, stats.elapsed),
+        file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,401 @@
+"""
+A load generator which drives AdvancedRemotes against IpodEmulators and reports throughput, latency percentiles and
+CPU time per request.
+
+    python -m ipodproto.loadgen [--transport inprocess|pty|socket] [--pairs 4] [--duration 10]
+                                [--workload status=4,metadata=4,listing=1,control=1]
+
+Each pair is one emulated dock: an emulator and a remote connected by their own transport. Every pair is driven by
+`--threads` worker threads, each picking operations from the workload mix at random.
+"""
+import argparse
+import json
+import os
+import random
+import select
+import socket
+import sys
+import threading
+import time
+from collections import OrderedDict
+from contextlib import nullcontext
+
+from .catalog import CatalogBuilder
+from .handlers.air import AdvancedRemote, IpodException
+from .handlers.ipod import IpodEmulator
+from .metrics import LatencyHistogram, Metrics
+from .protocol import AirMode, MODE_ADVANCED_REMOTE
+from .sim import LinkModel, SimulatedLink
+from .tracing import command_name
+
+DEFAULT_WORKLOAD = 'status=4,metadata=4,listing=1,control=1'
+
+
+class FdStream:
+    """
+    A stream over a file descriptor, such as one side of a pty or a socket, with reads that time out so the handler
+    can be stopped.
+    """
+
+    def __init__(self, fd: int):
+        self.fd = fd
+
+    def read(self, size: int = 4096, timeout: float = 0.05) -> bytes:
+        try:
+            readable, _, _ = select.select([self.fd], [], [], timeout)
+            if not readable:
+                return b''
+            return os.read(self.fd, size)
+        except (OSError, ValueError):
+            # Closed underneath us
+            return b''
+
+    def write(self, data: bytes) -> None:
+        view = memoryview(data)
+        while view:
+            written = os.write(self.fd, view)
+            view = view[written:]
+
+
+class Transport:
+    """
+    A connection between one emulator and one remote.
+    """
+
+    def __init__(self, ipod, accessory, close=None, link=None):
+        self.ipod = ipod
+        self.accessory = accessory
+        self.link = link
+        self._close = close
+
+    def close(self) -> None:
+        if self._close is not None:
+            self._close()
+
+
+def open_transport(kind: str, baud: int = 1000000) -> Transport:
+    """
+    :param kind: 'inprocess' for a simulated link, 'pty' for a pseudo-terminal pair, or 'socket' for a Unix socket
+    pair.
+    :param baud: The line rate of an in-process link.
+    """
+    if kind == 'inprocess':
+        link = SimulatedLink(LinkModel(baud))
+        return Transport(link.ipod, link.accessory, link=link)
+
+    if kind == 'pty':
+        import tty
+
+        master, slave = os.openpty()
+        tty.setraw(slave)
+        tty.setraw(master)
+        return Transport(FdStream(master), FdStream(slave), lambda: (os.close(master), os.close(slave)))
+
+    if kind == 'socket':
+        ipod_sock, accessory_sock = socket.socketpair()
+        return Transport(FdStream(ipod_sock.fileno()), FdStream(accessory_sock.fileno()),
+                         lambda: (ipod_sock.close(), accessory_sock.close()))
+
+    raise ValueError("Unknown transport: {}".format(kind))
+
+
+def build_catalog(songs: int = 10000, seed: int = 0):
+    rng = random.Random(seed)
+    builder = CatalogBuilder("Load Generator")
+    for i in range(songs):
+        builder.add_song("Song {:06d}".format(i), "Artist {}".format(rng.randrange(songs // 25 + 1)),
+                         "Album {}".format(rng.randrange(songs // 10 + 1)), "Genre {}".format(rng.randrange(20)),
+                         None, rng.randrange(60000, 400000))
+    return builder.build()
+
+
+def parse_workload(spec: str) -> OrderedDict:
+    """
+    :param spec: Comma separated `operation=weight` pairs.
+    :return: Operation name -> weight.
+    """
+    workload = OrderedDict()
+    for part in spec.split(','):
+        name, _, weight = part.partition('=')
+        name = name.strip()
+        if name not in OPERATIONS:
+            raise ValueError("Unknown operation {!r}; choose from {}".format(name, ', '.join(OPERATIONS)))
+        workload[name] = float(weight or 1)
+    return workload
+
+
+class Pair:
+    """
+    One emulated dock under load.
+    """
+
+    def __init__(self, catalog, transport: Transport, timeout: float, listing_size: int):
+        self.transport = transport
+        self.listing_size = listing_size
+        self.song_count = catalog.count(AirMode.Types.SONG)
+
+        self.emulator = IpodEmulator(transport.ipod, catalog=catalog)
+        self.remote = AdvancedRemote(transport.accessory, timeout=timeout, metrics=Metrics(buckets_per_decade=50))
+
+        # The iPod only lists one range at a time, and abandons it for any command which changes its state, so
+        # listings can't overlap each other or playback control from other workers
+        self.burst_lock = threading.Lock()
+
+        self._threads = [threading.Thread(target=handler.run, daemon=True) for handler in (self.emulator,
+                                                                                           self.remote)]
+        for thread in self._threads:
+            thread.start()
+
+    def close(self) -> None:
+        self.emulator.stop()
+        self.remote.stop()
+        for thread in self._threads:
+            thread.join()
+        self.transport.close()
+
+
+def _status(pair, rng):
+    pair.remote.get_time_status_info()
+    pair.remote.get_playlist_position()
+
+
+def _metadata(pair, rng):
+    index = rng.randrange(pair.song_count)
+    pair.remote.get_song_title(index)
+    pair.remote.get_song_artist(index)
+    pair.remote.get_song_album(index)
+
+
+def _listing(pair, rng):
+    start = rng.randrange(max(1, pair.song_count - pair.listing_size))
+    pair.remote.get_item_names(AirMode.Types.SONG, start, pair.listing_size)
+
+
+def _control(pair, rng):
+    pair.remote.play_pause()
+    # Playback control isn't acknowledged, so wait for the status to confirm it was handled
+    pair.remote.get_time_status_info()
+
+
+OPERATIONS = OrderedDict([
+    ('status', _status),
+    ('metadata', _metadata),
+    ('listing', _listing),
+    ('control', _control),
+])
+
+# Operations which hold the pair's burst lock while they run
+EXCLUSIVE_OPERATIONS = frozenset(('listing', 'control'))
+
+_NO_LOCK = nullcontext()
+
+
+class Results:
+    """
+    Latencies and error counts for each operation, and latencies for each command, merged across workers.
+    """
+
+    def __init__(self):
+        self.latency = {name: LatencyHistogram(min_value=1e-6, buckets_per_decade=50) for name in OPERATIONS}
+        self.errors = {name: 0 for name in OPERATIONS}
+        # Command id -> LatencyHistogram, as measured by the remotes
+        self.commands = {}
+        self.cpu_seconds = 0.0
+        self._lock = threading.Lock()
+
+    def record(self, name, seconds):
+        with self._lock:
+            self.latency[name].record(seconds)
+
+    def error(self, name):
+        with self._lock:
+            self.errors[name] += 1
+
+    def add_commands(self, metrics: Metrics) -> None:
+        """
+        Adds the command latencies recorded by a remote.
+        """
+        with metrics._lock:
+            for command, histogram in metrics.latency.items():
+                if command not in self.commands:
+                    self.commands[command] = LatencyHistogram(**metrics.histogram_args)
+                self.commands[command].merge(histogram)
+
+    def merge(self, other: 'Results') -> None:
+        with other._lock:
+            for name, histogram in other.latency.items():
+                self.latency[name].merge(histogram)
+            for name, count in other.errors.items():
+                self.errors[name] += count
+        for command, histogram in other.commands.items():
+            if command not in self.commands:
+                self.commands[command] = LatencyHistogram(min_value=histogram.min_value,
+                                                          buckets_per_decade=histogram.buckets_per_decade)
+            self.commands[command].merge(histogram)
+        self.cpu_seconds += other.cpu_seconds
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    @property
+    def requests(self) -> int:
+        return sum(h.count for h in self.latency.values())
+
+    def summary(self, elapsed: float, **fields) -> dict:
+        """
+        :param fields: Extra fields describing the run, such as the transport.
+        :return: The request rate, CPU time per request and per command, and latency percentiles for each operation
+        and each command.
+        """
+        requests = self.requests
+        command_count = sum(h.count for h in self.commands.values())
+        summary = dict(fields)
+        summary.update({
+            'elapsed': elapsed,
+            'requests': requests,
+            'requests_per_second': requests / elapsed if elapsed else 0.0,
+            'cpu_seconds': self.cpu_seconds,
+            'cpu_per_request': self.cpu_seconds / requests if requests else None,
+            'cpu_per_command': self.cpu_seconds / command_count if command_count else None,
+            'errors': dict(self.errors),
+            'operations': {name: _summarise(h) for name, h in self.latency.items() if h.count},
+            'commands': {command_name(MODE_ADVANCED_REMOTE, command): _summarise(h)
+                         for command, h in sorted(self.commands.items())},
+        })
+        return summary
+
+
+def _worker(pair, workload, results, stop, seed):
+    rng = random.Random(seed)
+    names = list(workload)
+    weights = list(workload.values())
+
+    while not stop.is_set():
+        name = rng.choices(names, weights)[0]
+        with pair.burst_lock if name in EXCLUSIVE_OPERATIONS else _NO_LOCK:
+            # Time the operation itself, not the wait for another worker's
+            started = time.perf_counter()
+            try:
+                OPERATIONS[name](pair, rng)
+            except (IpodException, TimeoutError):
+                results.error(name)
+                continue
+            elapsed = time.perf_counter() - started
+        results.record(name, elapsed)
+
+
+def start_workers(docks, workload, results, stop, threads=1, seed=0):
+    """
+    Starts `threads` worker threads on each pair, which run the workload until `stop` is set.
+    :return: The threads.
+    """
+    workers = [threading.Thread(target=_worker, args=(pair, workload, results, stop, seed * 1000 + i * threads + t),
+                                daemon=True)
+               for i, pair in enumerate(docks) for t in range(threads)]
+    for worker in workers:
+        worker.start()
+    return workers
+
+
+def _summarise(histogram: LatencyHistogram) -> dict:
+    return {
+        'count': histogram.count,
+        'p50': histogram.percentile(50),
+        'p99': histogram.percentile(99),
+        'p999': histogram.percentile(99.9),
+        'max': histogram.max,
+    }
+
+
+def run(transport: str = 'inprocess', pairs: int = 1, threads: int = 1, duration: float = 5.0,
+        workload: str = DEFAULT_WORKLOAD, songs: int = 10000, listing_size: int = 100, timeout: float = 1.0,
+        baud: int = 1000000, seed: int = 0) -> dict:
+    """
+    Runs a load test. A request is one operation from the workload, which may send several commands.
+    :return: The summary from `Results.summary`.
+    """
+    mix = parse_workload(workload)
+    catalog = build_catalog(songs, seed)
+    docks = [Pair(catalog, open_transport(transport, baud), timeout, listing_size) for _ in range(pairs)]
+    results = Results()
+    stop = threading.Event()
+
+    cpu_started = time.process_time()
+    started = time.monotonic()
+    workers = start_workers(docks, mix, results, stop, threads, seed)
+    stop.wait(duration)
+    stop.set()
+    for worker in workers:
+        worker.join()
+    elapsed = time.monotonic() - started
+    results.cpu_seconds = time.process_time() - cpu_started
+
+    for pair in docks:
+        pair.close()
+        results.add_commands(pair.remote.metrics)
+
+    return results.summary(elapsed, transport=transport, pairs=pairs, threads=threads, workload=dict(mix))
+
+
+def _format_ms(value):
+    return '{:9.3f}'.format(value * 1000) if value is not None else '        -'
+
+
+def print_summary(summary: dict, out=sys.stdout) -> None:
+    print("{transport}, {pairs} pairs x {threads} threads, {elapsed:.1f}s: {requests} requests, "
+          "{requests_per_second:.0f} requests/s".format(**summary), file=out)
+    if summary['cpu_per_request'] is not None:
+        print("CPU {:.2f}s: {:.1f}us per request, {:.1f}us per command".format(
+            summary['cpu_seconds'], summary['cpu_per_request'] * 1e6, summary['cpu_per_command'] * 1e6), file=out)
+    if any(summary['errors'].values()):
+        print("errors: " + ', '.join('{} {}'.format(name, n) for name, n in summary['errors'].items() if n),
+              file=out)
+
+    for title, rows in (('operation', summary['operations']), ('command', summary['commands'])):
+        print("{:<22} {:>8} {:>9} {:>9} {:>9} {:>9}  (ms)".format(title, 'count', 'p50', 'p99', 'p999', 'max'),
+              file=out)
+        for name, row in rows.items():
+            print("{:<22} {:>8} {} {} {} {}".format(name, row['count'], _format_ms(row['p50']),
+                                                   _format_ms(row['p99']), _format_ms(row['p999']),
+                                                   _format_ms(row['max'])), file=out)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m ipodproto.loadgen',
+                                     description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--transport', choices=('inprocess', 'pty', 'socket'), default='inprocess')
+    parser.add_argument('--pairs', type=int, default=1, help="emulator/remote pairs")
+    parser.add_argument('--threads', type=int, default=1, help="worker threads per pair")
+    parser.add_argument('--duration', type=float, default=5.0, help="seconds")
+    parser.add_argument('--workload', default=DEFAULT_WORKLOAD, help="operation=weight pairs; operations are "
+                                                                     + ', '.join(OPERATIONS))
+    parser.add_argument('--songs', type=int, default=10000)
+    parser.add_argument('--listing-size', type=int, default=100, help="names per listing")
+    parser.add_argument('--timeout', type=float, default=1.0, help="remote response timeout, in seconds")
+    parser.add_argument('--baud', type=int, default=1000000, help="line rate of the in-process link")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', action='store_true', help="print the summary as JSON")
+    args = parser.parse_args(argv)
+    try:
+        parse_workload(args.workload)
+    except ValueError as e:
+        parser.error(str(e))
+
+    summary = run(args.transport, args.pairs, args.threads, args.duration, args.workload, args.songs,
+                  args.listing_size, args.timeout, args.baud, args.seed)
+
+    if args.json:
+        json.dump(summary, sys.stdout, indent=1)
+        print()
+    else:
+        print_summary(summary)
+
+
+if __name__ == '__main__':
+    main()
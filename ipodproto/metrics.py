@@ -0,0 +1,211 @@
+"""
+Runtime instrumentation for the protocol handlers: link counters and per-command latency histograms. Handlers only
+collect anything when given a `Metrics` instance, so it costs one attribute check per frame when disabled.
+"""
+import json
+from array import array
+from collections import Counter
+from math import log10
+from threading import Lock
+
+
+class LatencyHistogram:
+    """
+    A histogram of durations with logarithmic buckets, so that memory is fixed and every bucket has the same relative
+    precision.
+    """
+
+    def __init__(self, min_value: float = 1e-5, max_value: float = 100.0, buckets_per_decade: int = 10):
+        """
+        :param min_value: The upper bound of the first bucket, in seconds. Anything smaller is counted in it.
+        :param max_value: The lower bound of the last bucket, in seconds. Anything larger is counted in it.
+        :param buckets_per_decade: The number of buckets for every factor of ten.
+        """
+        self.min_value = min_value
+        self.buckets_per_decade = buckets_per_decade
+        self._log_min = log10(min_value)
+        self._last = int(round((log10(max_value) - self._log_min) * buckets_per_decade)) + 1
+
+        self.buckets = array('Q', bytes(8 * (self._last + 1)))
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def _bucket(self, value):
+        if value <= self.min_value:
+            return 0
+        return min(self._last, int((log10(value) - self._log_min) * self.buckets_per_decade) + 1)
+
+    def upper_bound(self, bucket: int) -> float:
+        """
+        :return: The largest value counted in a bucket.
+        """
+        if bucket >= self._last:
+            return float('inf')
+        return 10 ** (self._log_min + bucket / self.buckets_per_decade)
+
+    def record(self, value: float) -> None:
+        self.buckets[self._bucket(value)] += 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def merge(self, other: 'LatencyHistogram') -> None:
+        """
+        Adds another histogram's counts to this one. Both must have the same buckets.
+        """
+        if len(other.buckets) != len(self.buckets) or other.min_value != self.min_value \
+                or other.buckets_per_decade != self.buckets_per_decade:
+            raise ValueError("Histograms have different buckets")
+
+        for bucket, count in enumerate(other.buckets):
+            self.buckets[bucket] += count
+        self.count += other.count
+        self.total += other.total
+        if other.min is not None and (self.min is None or other.min < self.min):
+            self.min = other.min
+        if other.max is not None and (self.max is None or other.max > self.max):
+            self.max = other.max
+
+    def percentile(self, q: float) -> float:
+        """
+        :param q: The percentile, from 0 to 100.
+        :return: The upper bound of the bucket containing that percentile, capped at the largest value recorded, or
+        None if nothing was recorded.
+        """
+        if not self.count:
+            return None
+
+        rank = q / 100 * self.count
+        seen = 0
+        for bucket, count in enumerate(self.buckets):
+            seen += count
+            if count and seen >= rank:
+                return min(self.upper_bound(bucket), self.max)
+        return self.max
+
+    def snapshot(self) -> dict:
+        return {
+            'count': self.count,
+            'mean': self.total / self.count if self.count else None,
+            'min': self.min,
+            'max': self.max,
+            'p50': self.percentile(50),
+            'p90': self.percentile(90),
+            'p99': self.percentile(99),
+            'buckets': {self.upper_bound(b): c for b, c in enumerate(self.buckets) if c},
+        }
+
+
+class Metrics:
+    """
+    Counters and latency histograms for one handler. Gauges are read from callables when a snapshot is taken, so
+    they cost nothing in between.
+    """
+
+    def __init__(self, **histogram_args):
+        """
+        :param histogram_args: Passed to each `LatencyHistogram`.
+        """
+        self.histogram_args = histogram_args
+
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.frames_in = 0
+        self.frames_out = 0
+        self.checksum_failures = 0
+        self.parse_errors = 0
+        self.skipped_bytes = 0
+
+        # (mode, command id) -> frames
+        self.commands_in = Counter()
+        self.commands_out = Counter()
+        # Command id -> LatencyHistogram
+        self.latency = {}
+
+        self._gauges = {}
+        self._lock = Lock()
+
+    # Counters are updated from the reader, burst and polling threads, and `+=` isn't atomic, so every update takes
+    # the lock
+
+    def read(self, bytes: int, checksum_failures: int = 0, parse_errors: int = 0, skipped_bytes: int = 0) -> None:
+        """
+        Counts data read from the link, and what the parser made of it.
+        """
+        with self._lock:
+            self.bytes_in += bytes
+            self.checksum_failures += checksum_failures
+            self.parse_errors += parse_errors
+            self.skipped_bytes += skipped_bytes
+
+    def wrote(self, bytes: int, frames: int = 1) -> None:
+        """
+        Counts data written to the link.
+        """
+        with self._lock:
+            self.bytes_out += bytes
+            self.frames_out += frames
+
+    def received(self, mode: int, command_id) -> None:
+        with self._lock:
+            self.frames_in += 1
+            self.commands_in[mode, command_id] += 1
+
+    def sent(self, mode: int, command_id) -> None:
+        # Frames are counted as they're written, since some are written already packed
+        with self._lock:
+            self.commands_out[mode, command_id] += 1
+
+    def observe(self, command_id: int, seconds: float) -> None:
+        """
+        Records how long a command took.
+        """
+        with self._lock:
+            histogram = self.latency.get(command_id)
+            if histogram is None:
+                histogram = self.latency[command_id] = LatencyHistogram(**self.histogram_args)
+            histogram.record(seconds)
+
+    def gauge(self, name: str, read) -> None:
+        """
+        Registers a value which is read when a snapshot is taken.
+        :param read: Returns the current value.
+        """
+        self._gauges[name] = read
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            counters = self._counters()
+        counters['gauges'] = {name: read() for name, read in self._gauges.items()}
+        return counters
+
+    def _counters(self):
+        return {
+            'bytes_in': self.bytes_in,
+            'bytes_out': self.bytes_out,
+            'frames_in': self.frames_in,
+            'frames_out': self.frames_out,
+            'checksum_failures': self.checksum_failures,
+            'parse_errors': self.parse_errors,
+            'skipped_bytes': self.skipped_bytes,
+            'commands_in': {'{:02x}:{}'.format(mode, _format_id(i)): n for (mode, i), n in self.commands_in.items()},
+            'commands_out': {'{:02x}:{}'.format(mode, _format_id(i)): n for (mode, i), n in self.commands_out.items()},
+            'latency': {_format_id(i): h.snapshot() for i, h in self.latency.items()},
+        }
+
+    def to_json(self, **kwargs) -> str:
+        """
+        :return: The snapshot as JSON. Takes the same arguments as `json.dumps`.
+        """
+        return json.dumps(self.snapshot(), default=str, **kwargs)
+
+
+def _format_id(command_id):
+    if isinstance(command_id, int):
+        return '{:04x}'.format(command_id)
+    return str(command_id)
@@ -0,0 +1,187 @@
+"""
+A local model of what an iPod is playing, kept up to date from the responses and poll updates which pass by anyway,
+so that progress displays don't need a round trip for every refresh.
+"""
+from collections import namedtuple
+from threading import Lock
+
+from .protocol import STATUS_PLAYING
+
+try:
+    from time import monotonic
+except ImportError:
+    from time import time as monotonic
+
+NowPlayingState = namedtuple('NowPlayingState', ['position', 'length', 'elapsed', 'status'])
+
+
+class NowPlaying:
+    """
+    Dead-reckons the elapsed time of the current track between updates. Every value is either known, because it was
+    reported since the last track change, or None.
+
+    A track change is detected when the elapsed time goes backwards by more than `rewind_tolerance`, since nothing
+    else rewinds a track that far while polling. The track position and length are forgotten when that happens.
+    """
+
+    def __init__(self, max_age: float = 5.0, rewind_tolerance: int = 1500, clock=monotonic, publisher=None):
+        """
+        :param max_age: How long, in seconds, an extrapolated time can be trusted after the last update.
+        :param rewind_tolerance: How far, in milliseconds, the elapsed time may go backwards without it being
+        considered a new track.
+        :param clock: A function returning the current time in seconds.
+        :param publisher: A `sharedmem.NowPlayingPublisher` to write every change to. The clock must then be
+        `time.monotonic`, since readers in other processes extrapolate with it.
+        """
+        self.max_age = max_age
+        self.rewind_tolerance = rewind_tolerance
+        self.clock = clock
+        self.publisher = publisher
+
+        self.position = None
+        self.length = None
+        self.status = None
+        self.track_changes = 0
+
+        # Metadata of the track at `position`, from song queries which happened to ask about it
+        self.title = None
+        self.artist = None
+        self.album = None
+
+        # The elapsed time at the last update, and when that was
+        self._elapsed = None
+        self._updated = None
+
+        self._lock = Lock()
+
+    def _extrapolate(self, now):
+        if self._elapsed is None:
+            return None
+        if self.status != STATUS_PLAYING:
+            return self._elapsed
+
+        elapsed = self._elapsed + int((now - self._updated) * 1000)
+        if self.length:
+            elapsed = min(elapsed, self.length)
+        return elapsed
+
+    def _track_changed(self):
+        self.track_changes += 1
+        self.position = None
+        self.length = None
+        self.title = None
+        self.artist = None
+        self.album = None
+
+    def _publish(self):
+        if self.publisher is not None:
+            self.publisher.publish(self.position, self.length, self._elapsed, self.status, self._updated or 0.0,
+                                   self.track_changes, self.title, self.artist, self.album)
+
+    def _set_elapsed(self, elapsed, now):
+        previous = self._extrapolate(now)
+        if previous is not None and elapsed < previous - self.rewind_tolerance:
+            self._track_changed()
+
+        self._elapsed = elapsed
+        self._updated = now
+
+    def update_elapsed(self, elapsed: int, now: float = None) -> None:
+        """
+        Takes a RES_TIME_ELAPSED poll update. The iPod only polls while playing.
+        :param elapsed: The elapsed time of the current track, in milliseconds.
+        """
+        now = self.clock() if now is None else now
+        with self._lock:
+            self._set_elapsed(elapsed, now)
+            self.status = STATUS_PLAYING
+            self._publish()
+
+    def update_time_status(self, length: int, elapsed: int, status: int, now: float = None) -> None:
+        """
+        Takes a RES_TIME_STATUS response.
+        """
+        now = self.clock() if now is None else now
+        with self._lock:
+            if self.length is not None and length != self.length:
+                self._track_changed()
+            else:
+                self._set_elapsed(elapsed, now)
+
+            self._elapsed = elapsed
+            self._updated = now
+            self.length = length
+            self.status = status
+            self._publish()
+
+    def update_position(self, position: int, now: float = None) -> None:
+        """
+        Takes a RES_PLAYLIST_POS response.
+        """
+        with self._lock:
+            if self.position is not None and position != self.position:
+                self._track_changed()
+            self.position = position
+            self._publish()
+
+    def update_metadata(self, position: int, title: str = None, artist: str = None, album: str = None) -> None:
+        """
+        Takes the answer to a song query, which is kept if it was about the current track.
+        """
+        with self._lock:
+            if position is None or position != self.position:
+                return
+            if title is not None:
+                self.title = title
+            if artist is not None:
+                self.artist = artist
+            if album is not None:
+                self.album = album
+            self._publish()
+
+    def invalidate(self, track_changed: bool = True) -> None:
+        """
+        Forgets the playback status, e.g. after sending a playback control command.
+        :param track_changed: Whether the command may have changed the track, so the position and length should be
+        forgotten too.
+        """
+        with self._lock:
+            if track_changed:
+                self._track_changed()
+            self.status = None
+            self._elapsed = None
+            self._updated = None
+            self._publish()
+
+    def elapsed(self, now: float = None):
+        """
+        :return: The estimated elapsed time of the current track in milliseconds, or None if it isn't known.
+        """
+        now = self.clock() if now is None else now
+        with self._lock:
+            return self._extrapolate(now)
+
+    def time_confident(self, now: float = None) -> bool:
+        """
+        :return: True if the length, elapsed time and status can be answered without asking the iPod.
+        """
+        now = self.clock() if now is None else now
+        with self._lock:
+            if self._elapsed is None or self.length is None or self.status is None:
+                return False
+            if now - self._updated > self.max_age:
+                return False
+
+            # Running off the end of the track means another one has started, we just don't know which yet
+            return self.status != STATUS_PLAYING or self._extrapolate(now) < self.length
+
+    def position_confident(self, now: float = None) -> bool:
+        """
+        :return: True if the playlist position can be answered without asking the iPod.
+        """
+        return self.position is not None and self.time_confident(now)
+
+    def snapshot(self, now: float = None) -> NowPlayingState:
+        now = self.clock() if now is None else now
+        with self._lock:
+            return NowPlayingState(self.position, self.length, self._extrapolate(now), self.status)
@@ -0,0 +1,158 @@
+"""
+The now-playing queue of `IpodEmulator`: the songs which play one after another, and which one is playing.
+
+Songs are stored as catalog indices in an `array('I')`, four bytes each, in the order they were queued. Playlist
+positions on the wire are in play order, which `shuffle.play_order` maps to positions in the queue, so moving
+around the queue and reshuffling it never copies or reorders the songs.
+"""
+from array import array
+
+from .catalog import MAIN_PLAYLIST
+from .protocol import AirMode, REPEAT_ALBUM, REPEAT_SONG, SHUFFLE_OFF
+from .shuffle import play_order
+
+
+def _song_array(songs):
+    tracks = array('I')
+    if isinstance(songs, range):
+        tracks.extend(songs)
+    else:
+        # Catalog sections and browse views are arrays or memoryviews of unsigned ints, which copy in one go
+        try:
+            tracks.frombytes(memoryview(songs).cast('B'))
+        except TypeError:
+            tracks.extend(songs)
+    return tracks
+
+
+class PlayQueue:
+    """
+    A queue of songs and a current position in play order. Moving the position is constant time; only building the
+    queue and shuffling it by album take time proportional to its length.
+    """
+
+    def __init__(self, catalog, songs, playlist=None, shuffle_mode=SHUFFLE_OFF, seed=None):
+        """
+        :param catalog: The catalog the songs belong to.
+        :param songs: The catalog indices of the songs to queue, in order. They are copied.
+        :param playlist: The catalog playlist the songs are, if they are a whole playlist. The main playlist can be
+        album shuffled without grouping the songs first.
+        :param shuffle_mode: One of SHUFFLE_OFF, SHUFFLE_SONGS or SHUFFLE_ALBUMS.
+        :param seed: The shuffle seed.
+        """
+        self.catalog = catalog
+        self.tracks = _song_array(songs)
+        self.playlist = playlist
+        self.order = play_order(shuffle_mode, catalog, self.tracks, playlist=playlist, seed=seed)
+        self.position = 0
+
+    @classmethod
+    def from_playlist(cls, catalog, playlist, shuffle_mode=SHUFFLE_OFF, seed=None):
+        return cls(catalog, catalog.playlist_songs(playlist), playlist, shuffle_mode, seed)
+
+    @classmethod
+    def from_browse(cls, browse, shuffle_mode=SHUFFLE_OFF, seed=None):
+        """
+        Queues the songs the accessory has browsed to, in the order it sees them.
+        :param browse: The `BrowseState` whose song view to queue.
+        """
+        selection = browse.selection
+        if not selection:
+            playlist = MAIN_PLAYLIST
+        elif list(selection) == [AirMode.Types.PLAYLIST]:
+            playlist = selection[AirMode.Types.PLAYLIST]
+        else:
+            playlist = None
+
+        return cls(browse.catalog, browse.view(AirMode.Types.SONG), playlist, shuffle_mode, seed)
+
+    def __len__(self):
+        return len(self.tracks)
+
+    def song(self, position):
+        """
+        :param position: A position in play order.
+        :return: The catalog index of the song at that position.
+        """
+        return self.tracks[self.order[position]]
+
+    @property
+    def current(self):
+        """
+        The catalog index of the song at the current position, or None if the queue is empty.
+        """
+        return self.tracks[self.order[self.position]] if self.tracks else None
+
+    def find(self, song):
+        """
+        :return: The position of a song in play order, or None if it isn't queued.
+        """
+        if self.playlist == MAIN_PLAYLIST:
+            # The main playlist queues every song in catalog order
+            base = song if song < len(self.tracks) else None
+        else:
+            try:
+                base = self.tracks.index(song)
+            except ValueError:
+                base = None
+
+        return None if base is None else self.order.index(base)
+
+    def jump(self, position):
+        """
+        Moves to a position in play order.
+        :return: False, without moving, if the position is past the end.
+        """
+        if not 0 <= position < len(self.tracks):
+            return False
+
+        self.position = position
+        return True
+
+    def skip_forward(self, repeat_mode):
+        """
+        Moves to the next song, going back to the start from the end if the repeat mode is REPEAT_ALBUM, which repeats
+        the whole queue. Skipping always leaves the current song, even with REPEAT_SONG.
+        :return: False if there is no next song, in which case the position is left at the last one.
+        """
+        if self.position + 1 < len(self.tracks):
+            self.position += 1
+        elif repeat_mode == REPEAT_ALBUM and self.tracks:
+            self.position = 0
+        else:
+            return False
+
+        return True
+
+    def skip_backward(self, repeat_mode):
+        """
+        Moves to the previous song, going round to the end from the start if the repeat mode is REPEAT_ALBUM.
+        :return: False if there is no previous song.
+        """
+        if self.position > 0:
+            self.position -= 1
+        elif repeat_mode == REPEAT_ALBUM and self.tracks:
+            self.position = len(self.tracks) - 1
+        else:
+            return False
+
+        return True
+
+    def song_finished(self, repeat_mode):
+        """
+        Moves on once the current song has played to the end: nowhere with REPEAT_SONG, otherwise as `skip_forward`.
+        :return: False if the queue has finished.
+        """
+        if repeat_mode == REPEAT_SONG:
+            return bool(self.tracks)
+
+        return self.skip_forward(repeat_mode)
+
+    def shuffle(self, shuffle_mode, seed=None):
+        """
+        Changes the play order, keeping the current song playing wherever it ends up.
+        """
+        current = self.order[self.position] if self.tracks else None
+        self.order = play_order(shuffle_mode, self.catalog, self.tracks, playlist=self.playlist, seed=seed)
+        if current is not None:
+            self.position = self.order.index(current)
@@ -1,18 +1,76 @@
+from threading import Lock
+
+from suitcase.exceptions import SuitcaseParseError, SuitcaseProgrammingError
 from suitcase.fields import UBInt8, UBInt16, UBInt32, UBInt8Sequence, \
-    Magic, LengthField, DispatchField, DispatchTarget, FieldProperty, Payload, CRCField
+    Magic, LengthField, DispatchField, DispatchTarget, FieldProperty, Payload, CRCField, BaseField, FieldPlaceholder, \
+    SubstructureField
 from suitcase.structure import Structure
-from suitcase.protocol import StreamProtocolHandler
 
 
 def ipod_checksum(data, crc=0):
-    return 0x100 - (sum(data) & 0xFF) - crc
+    return (0x100 - (sum(data) & 0xFF) - crc) & 0xFF
+
+
+class ParameterTarget(DispatchTarget):
+    """
+    A DispatchTarget for command parameters. Unlike a plain DispatchTarget, several ids may share a parameter type
+    without setting the parameters changing the id, and the mapping may contain plain fields (such as `UBInt32`),
+    whose values are then get and set directly, e.g. `cmd.parameters = 5`.
+    """
+
+    def _instantiate(self, target):
+        if isinstance(target, FieldPlaceholder):
+            return target.create_instance(self._parent)
+        elif issubclass(target, BaseField):
+            return target(instantiate=True, parent=self._parent)
+        return target()
+
+    def getval(self):
+        if isinstance(self._value, BaseField):
+            return self._value.getval()
+        return self._value
+
+    def setval(self, value):
+        target = self._lookup_msg_type()
+
+        if isinstance(value, Structure):
+            if type(value) is not target:
+                # Only switch the id when it doesn't already take this type of parameter
+                super().setval(value)
+                return
+        elif target is None or (isinstance(target, type) and issubclass(target, Structure)):
+            raise SuitcaseProgrammingError("Parameters of type {} are not valid for id {!r}".format(
+                type(value).__name__, self.dispatch_field.getval()))
+        else:
+            field = self._instantiate(target)
+            field.setval(value)
+            value = field
+
+        self._value = value
+        value._parent = self._parent
+
+    def pack(self, stream):
+        if isinstance(self._value, BaseField):
+            self._value.pack(stream)
+        elif self._value is not None:
+            self._value._packer.write(stream)
+
+    def unpack(self, data, **kwargs):
+        target = self._lookup_msg_type()
+        if target is None:
+            raise SuitcaseParseError("Input data contains type byte not contained in mapping")
+
+        self._value = self._instantiate(target)
+        if isinstance(self._value, BaseField):
+            return self._value.unpack(data)
+        return self._value.unpack(data, trailing=not self.is_greedy).read()
 
 
 class StringField(Structure):
     data = Payload()
     text = FieldProperty(data,
-                         onget=lambda v: v.decode('ascii'),
-                         onset=lambda v: v.encode('ascii'))
+                         onget=lambda v: v.decode('utf-8', 'replace'),
+                         onset=lambda v: v.encode('utf-8'))
     terminator = Magic(b'\x00')
 
 
@@ -57,7 +115,7 @@ class ItemRangeParam(Structure):
 
 class ItemNameResult(Structure):
     offset = UBInt32()
-    name = StringField()
+    name = SubstructureField(StringField)
 
 STATUS_STOP = 0x00
 STATUS_PLAYING = 0x01
@@ -210,7 +268,7 @@ REPEAT_ALBUM = 0x02
 
 class AirCommand(Structure):
     id = DispatchField(UBInt16())
-    parameters = DispatchTarget(None, dispatch_field=id, dispatch_mapping={
+    parameters = ParameterTarget(None, dispatch_field=id, dispatch_mapping={
         AirMode.Commands.NCU_00: CommandResultParam,
         AirMode.Commands.FEEDBACK: CommandResultParam,
         AirMode.Commands.NCU_02: EmptyParam,
@@ -286,7 +344,7 @@ class VoiceRecorderMode:
         RECORDING_STOPPED = 0x0101
 
 
-class VoiceRecorderCommand:
+class VoiceRecorderCommand(Structure):
     id = UBInt16()
 
 
@@ -318,12 +376,56 @@ class SimpleRemoteMode:
         SCROLL_UP = b'\x00\x00\x00\x00\x01'
         SCROLL_DOWN = b'\x00\x00\x00\x00\x02'
 
-
-class SimpleRemoteCommand:
+    class Buttons:
+        """
+        The button state is a little-endian bitmask following the command byte, so several buttons can be held at
+        once. These are the bits of that mask, and match the `Commands` payloads for single buttons.
+        """
+        PLAY_PAUSE = 1 << 0
+        VOLUME_UP = 1 << 1
+        VOLUME_DOWN = 1 << 2
+        NEXT_SONG = 1 << 3
+        PREV_SONG = 1 << 4
+        NEXT_ALBUM = 1 << 5
+        PREV_ALBUM = 1 << 6
+        STOP = 1 << 7
+
+        PLAY = 1 << 8
+        PAUSE = 1 << 9
+        MUTE = 1 << 10
+        NEXT_PLAYLIST = 1 << 13
+        PREV_PLAYLIST = 1 << 14
+        SHUFFLE = 1 << 15
+
+        REPEAT = 1 << 16
+        IPOD_OFF = 1 << 18
+        IPOD_ON = 1 << 19
+        MENU_BUTTON = 1 << 22
+        OK_SELECT_BUTTON = 1 << 23
+
+        SCROLL_UP = 1 << 24
+        SCROLL_DOWN = 1 << 25
+
+
+def button_mask(payload: bytes) -> int:
+    """
+    Decodes a Simple Remote payload into a bitmask of the buttons held down.
+    """
+    return int.from_bytes(payload[1:], 'little')
+
+
+def button_payload(mask: int) -> bytes:
+    """
+    Encodes a bitmask of buttons as a Simple Remote payload, using as few bytes as possible.
+    """
+    return b'\x00' + mask.to_bytes(max(1, (mask.bit_length() + 7) // 8), 'little')
+
+
+class SimpleRemoteCommand(Structure):
     id = Payload()
 
 
-class RequestModeStatusCommand:
+class RequestModeStatusCommand(Structure):
     id = Magic(b'\x00\x03')
 
 MODE_SWITCH = 0x00
@@ -347,14 +449,154 @@ class IpodPacket(Structure):
     checksum = CRCField(UBInt8(), algo=ipod_checksum, start=2, end=-1)
 
 
+def _command_id(packet: IpodPacket):
+    # Simple Remote commands are a button state, not an id
+    return packet.command.id if packet.mode != MODE_SIMPLE_REMOTE else None
+
+
+class PacketFramer:
+    """
+    Splits a byte stream into IpodPackets. Frames with a bad checksum, or which can't be parsed, are dropped and
+    counted, and framing resumes at the next header.
+    """
+    HEADER = b'\xFF\x55'
+
+    def __init__(self, callback, tracer=None):
+        """
+        :param callback: Called with each packet, in order.
+        :param tracer: An optional `Tracer` to record framing and decoding in.
+        """
+        self.callback = callback
+        self.tracer = tracer
+
+        self.checksum_failures = 0
+        self.parse_errors = 0
+        self.skipped_bytes = 0
+
+        self._buffer = bytearray()
+
+    def feed(self, data: bytes) -> None:
+        tracer = self.tracer
+        if tracer is not None:
+            started = tracer.clock()
+
+        buffer = self._buffer
+        buffer += data
+        packets = []
+        pos = 0
+
+        while True:
+            start = buffer.find(self.HEADER, pos)
+            if start < 0:
+                # A trailing 0xFF may be the start of the next header
+                end = len(buffer) - 1 if buffer.endswith(self.HEADER[:1]) else len(buffer)
+                self.skipped_bytes += max(0, end - pos)
+                pos = max(pos, end)
+                break
+
+            self.skipped_bytes += start - pos
+            pos = start
+            if len(buffer) < start + 3:
+                break
+            end = start + buffer[start + 2] + 4
+            if len(buffer) < end:
+                break
+
+            frame = bytes(buffer[start:end])
+            if sum(frame[2:]) & 0xFF:
+                # The length may be garbage too, so look for a header inside the frame
+                self.checksum_failures += 1
+                self.skipped_bytes += 2
+                pos = start + 2
+                continue
+
+            try:
+                if tracer is not None:
+                    decode_started = tracer.clock()
+                    packets.append(IpodPacket.from_data(frame))
+                    tracer.complete('decode', decode_started, args={'bytes': len(frame)})
+                else:
+                    packets.append(IpodPacket.from_data(frame))
+            except (SuitcaseParseError, SuitcaseProgrammingError, ValueError):
+                self.parse_errors += 1
+            pos = end
+
+        del buffer[:pos]
+
+        if tracer is not None:
+            tracer.complete('frame', started, args={'bytes': len(data), 'frames': len(packets)})
+
+        for packet in packets:
+            self.callback(packet)
+
+    def reset(self) -> None:
+        self._buffer = bytearray()
+
+
 class IpodProtocolHandler:
-    def __init__(self, stream, read_args=None, write_args=None):
+    # Whether `packet_received` is quick enough to run on the reader thread even when there's an event bus
+    inline_packets = False
+
+    def __init__(self, stream, read_args=None, write_args=None, events=None, metrics=None, tracer=None):
+        """
+        :param stream: The stream to read from and write to.
+        :param events: An optional `EventBus`. With one, the reader thread only decodes packets and publishes them,
+        and `packet_received` is called in order from the bus, so slow handling can't hold up reading.
+        :param metrics: An optional `Metrics` to count traffic and latencies in.
+        :param tracer: An optional `Tracer` to record the stages of handling each frame in.
+        """
         self.stream = stream
-        self.handler = StreamProtocolHandler(IpodPacket, self.packet_received)
+        self.handler = PacketFramer(self._packet_decoded, tracer)
+        self.metrics = metrics
+        self.tracer = tracer
         self.running = False
         self.read_args = read_args or {}
         self.write_args = write_args or {}
 
+        # Packets may be sent from several threads, and must not be interleaved
+        self._write_lock = Lock()
+
+        self.events = events
+        self._subscriptions = []
+        if events is not None and not self.inline_packets:
+            # Only needed with an event bus, which keeps the self-test at the bottom runnable as a plain script
+            from .events import PacketReceived
+
+            self.subscribe(PacketReceived, self._packet_event, name=type(self).__name__ + '.packet_received')
+
+    def _packet_event(self, event):
+        if self.tracer is not None:
+            started = self.tracer.clock()
+            self.packet_received(event.packet)
+            self.tracer.complete('dispatch', started, args={'mode': event.packet.mode, 'id': _command_id(event.packet)})
+        else:
+            self.packet_received(event.packet)
+
+    def subscribe(self, types, callback, **kwargs):
+        """
+        Subscribes to this handler's own events on its event bus, which is unsubscribed when the handler stops.
+        Takes the same arguments as `EventBus.subscribe`.
+        """
+        subscription = self.events.subscribe(types, callback, source=self, **kwargs)
+        self._subscriptions.append(subscription)
+        return subscription
+
+    def _packet_decoded(self, packet: IpodPacket):
+        if self.metrics is not None:
+            self.metrics.received(packet.mode, _command_id(packet))
+
+        if self.events is None or self.inline_packets:
+            if self.tracer is not None:
+                started = self.tracer.clock()
+                self.packet_received(packet)
+                self.tracer.complete('dispatch', started, args={'mode': packet.mode, 'id': _command_id(packet)})
+            else:
+                self.packet_received(packet)
+        else:
+            from .events import PacketReceived
+
+            self.events.publish(PacketReceived(self, packet))
+
     def run(self):
         """
         Read from the underlying stream and pass it to the packet handler, until `stop()` is called.
@@ -362,10 +604,28 @@ class IpodProtocolHandler:
         self.running = True
 
         while self.running:
-            data = self.stream.read(**self.read_args)
+            if self.tracer is not None:
+                started = self.tracer.clock()
+                data = self.stream.read(**self.read_args)
+                if len(data):
+                    self.tracer.complete('read', started, args={'bytes': len(data)})
+            else:
+                data = self.stream.read(**self.read_args)
 
             if len(data):
-                self.handler.feed(data)
+                if self.metrics is not None:
+                    self._feed_counted(data)
+                else:
+                    self.handler.feed(data)
+
+    def _feed_counted(self, data: bytes):
+        metrics, handler = self.metrics, self.handler
+        failures, errors, skipped = handler.checksum_failures, handler.parse_errors, handler.skipped_bytes
+
+        handler.feed(data)
+
+        metrics.read(len(data), handler.checksum_failures - failures, handler.parse_errors - errors,
+                     handler.skipped_bytes - skipped)
 
     def stop(self):
         """
@@ -373,12 +633,43 @@ class IpodProtocolHandler:
         """
         self.running = False
 
+        for subscription in self._subscriptions:
+            self.events.unsubscribe(subscription)
+        self._subscriptions = []
+
     def send_packet(self, packet: IpodPacket):
         """
         Packs and sends an IpodPacket over the underlying stream.
         :param packet: The packet to pack and send.
         """
-        self.stream.write(packet.pack(), **self.write_args)
+        if self.metrics is not None:
+            self.metrics.sent(packet.mode, _command_id(packet))
+
+        if self.tracer is not None:
+            started = self.tracer.clock()
+            data = packet.pack()
+            self.tracer.complete('encode', started, args={'mode': packet.mode, 'id': _command_id(packet)})
+            self.send_bytes(data)
+        else:
+            self.send_bytes(packet.pack())
+
+    def send_bytes(self, data: bytes, frames: int = 1):
+        """
+        Sends already-framed packet data over the underlying stream.
+        :param data: One or more packed packets.
+        :param frames: The number of packets in the data.
+        """
+        if self.tracer is not None:
+            started = self.tracer.clock()
+            with self._write_lock:
+                self.stream.write(data, **self.write_args)
+            self.tracer.complete('write', started, args={'bytes': len(data), 'frames': frames})
+        else:
+            with self._write_lock:
+                self.stream.write(data, **self.write_args)
+
+        if self.metrics is not None:
+            self.metrics.wrote(len(data), frames)
 
     def packet_received(self, packet: IpodPacket):
         """
@@ -407,4 +698,12 @@ if __name__ == "__main__":
     packet4.command.id = AirMode.Commands.RES_SONG_ARTIST
     packet4.command.parameters = StringField()
     packet4.command.parameters.text = "An Artist"
-    assert(packet4.pack() == b'\xffU\r\x04\x00%An Artist\x00\x84')
+    assert(packet4.pack() == b'\xffU\r\x04\x00#An Artist\x00\x86')
+
+    count_packet = IpodPacket()
+    count_packet.command = AirCommand()
+    count_packet.command.id = AirMode.Commands.RES_TYPE_COUNT
+    count_packet.command.parameters = 1234
+    count_data = count_packet.pack()
+    assert(IpodPacket.from_data(count_data).command.id == AirMode.Commands.RES_TYPE_COUNT)
+    assert(IpodPacket.from_data(count_data).command.parameters == 1234)
@@ -0,0 +1,196 @@
+"""
+A now-playing record in shared memory, for local processes which want to refresh a display at frame rate without
+asking anybody.
+
+One process writes the record, from the `NowPlaying` model an `AdvancedRemote` keeps anyway. Any number of readers
+map it and take snapshots without syscalls or locks: the record is guarded by a sequence counter which is odd while a
+write is in progress, and a reader copies the record and retries if the counter was odd or changed meanwhile. Only a
+reader which keeps catching the writer mid-write yields the CPU, in case the writer was preempted.
+
+Layout, little-endian, 64 bytes of header and record followed by three strings:
+
+    0   4s  magic b'IPNP'
+    4   H   layout version
+    6   H   reserved
+    8   Q   sequence counter
+    16  i   playlist position, or -1 if unknown
+    20  i   track length in ms, or -1
+    24  i   elapsed time in ms at the last update, or -1
+    28  b   playback status, or -1
+    32  d   time.monotonic() of the last update
+    40  I   track changes seen
+    44      reserved, up to 64
+    64  3 x (B length, 255s UTF-8): title, artist, album of the current track
+"""
+import struct
+from collections import namedtuple
+from multiprocessing import shared_memory
+from time import sleep
+
+from .protocol import STATUS_PLAYING
+
+try:
+    from time import monotonic
+except ImportError:
+    from time import time as monotonic
+
+MAGIC = b'IPNP'
+VERSION = 1
+
+HEADER = struct.Struct('<4sHHQ')
+RECORD = struct.Struct('<iiibxxxdI20x')
+STRING = struct.Struct('<B255s')
+SEQUENCE_OFFSET = 8
+RECORD_OFFSET = HEADER.size
+STRINGS_OFFSET = RECORD_OFFSET + RECORD.size
+SIZE = STRINGS_OFFSET + 3 * STRING.size
+
+SharedNowPlayingState = namedtuple('SharedNowPlayingState', ['position', 'length', 'elapsed', 'status', 'title',
+                                                             'artist', 'album', 'track_changes'])
+
+
+def _optional(value):
+    return -1 if value is None else value
+
+
+def _encode(text):
+    data = (text or '').encode('utf-8')[:255]
+    # Don't leave half a character at the end
+    return data.decode('utf-8', 'ignore').encode('utf-8')
+
+
+class NowPlayingPublisher:
+    """
+    Writes the now-playing record. Only one process, and one thread at a time, may write.
+    """
+
+    def __init__(self, name: str = None, create: bool = True):
+        """
+        :param name: The name of the shared memory block. One is generated if not given; see `name`.
+        :param create: Whether to create the block, rather than attach to one created elsewhere.
+        """
+        self.shm = shared_memory.SharedMemory(name, create=create, size=SIZE if create else 0)
+        self.buf = self.shm.buf
+        if create:
+            HEADER.pack_into(self.buf, 0, MAGIC, VERSION, 0, 0)
+        self._sequence = HEADER.unpack_from(self.buf, 0)[3]
+
+    @property
+    def name(self) -> str:
+        return self.shm.name
+
+    def publish(self, position, length, elapsed, status, updated: float, track_changes: int, title=None,
+                artist=None, album=None) -> None:
+        """
+        :param updated: The `time.monotonic()` at which `elapsed` was true.
+        """
+        buf = self.buf
+        self._sequence += 1
+        struct.pack_into('<Q', buf, SEQUENCE_OFFSET, self._sequence)
+
+        RECORD.pack_into(buf, RECORD_OFFSET, _optional(position), _optional(length), _optional(elapsed),
+                         _optional(status), updated, track_changes)
+        offset = STRINGS_OFFSET
+        for text in (title, artist, album):
+            data = _encode(text)
+            STRING.pack_into(buf, offset, len(data), data)
+            offset += STRING.size
+
+        self._sequence += 1
+        struct.pack_into('<Q', buf, SEQUENCE_OFFSET, self._sequence)
+
+    def close(self) -> None:
+        self.buf = None
+        self.shm.close()
+
+    def unlink(self) -> None:
+        """
+        Removes the block once every process has closed it.
+        """
+        self.shm.unlink()
+
+
+class NowPlayingReader:
+    """
+    Takes consistent snapshots of a now-playing record published by another process. Before Python 3.13, don't open
+    one in the process which created the block: attaching stops this process's resource tracker from tracking it.
+    """
+
+    # Torn reads to retry by spinning, before yielding to let a preempted writer finish
+    SPINS = 100
+
+    def __init__(self, name: str, max_retries: int = 10000):
+        """
+        :param max_retries: How many torn reads to retry before giving up, in case the writer died mid-write.
+        """
+        try:
+            # Don't let this process's resource tracker remove a block it didn't create
+            self.shm = shared_memory.SharedMemory(name, track=False)
+        except TypeError:
+            from multiprocessing import resource_tracker
+            self.shm = shared_memory.SharedMemory(name)
+            resource_tracker.unregister(self.shm._name, 'shared_memory')
+
+        self.buf = self.shm.buf
+        self.max_retries = max_retries
+        self.retries = 0
+
+        magic, version, _, _ = HEADER.unpack_from(self.buf, 0)
+        if magic != MAGIC or version != VERSION:
+            self.close()
+            raise ValueError("{} isn't a now-playing record this version understands".format(name))
+
+    def read_raw(self):
+        """
+        :return: The sequence number, the record fields and the raw strings, or None if nothing has been published.
+        """
+        buf = self.buf
+        for attempt in range(self.max_retries):
+            if attempt >= self.SPINS:
+                sleep(0)
+
+            before = struct.unpack_from('<Q', buf, SEQUENCE_OFFSET)[0]
+            if before & 1:
+                self.retries += 1
+                continue
+
+            record = RECORD.unpack_from(buf, RECORD_OFFSET)
+            strings = bytes(buf[STRINGS_OFFSET:SIZE])
+
+            if struct.unpack_from('<Q', buf, SEQUENCE_OFFSET)[0] == before:
+                if before == 0:
+                    return None
+                return before, record, strings
+            self.retries += 1
+
+        raise RuntimeError("The now-playing record kept changing while being read")
+
+    def read(self, now: float = None):
+        """
+        :param now: The `time.monotonic()` to estimate the elapsed time at. Defaults to now.
+        :return: A `SharedNowPlayingState`, with unknown values as None, or None if nothing has been published.
+        """
+        raw = self.read_raw()
+        if raw is None:
+            return None
+
+        _, (position, length, elapsed, status, updated, track_changes), strings = raw
+        position, length, elapsed, status = (None if value == -1 else value
+                                             for value in (position, length, elapsed, status))
+
+        if elapsed is not None and status == STATUS_PLAYING:
+            now = monotonic() if now is None else now
+            elapsed += int((now - updated) * 1000)
+            if length:
+                elapsed = min(elapsed, length)
+
+        texts = []
+        for offset in range(0, 3 * STRING.size, STRING.size):
+            size, data = STRING.unpack_from(strings, offset)
+            texts.append(data[:size].decode('utf-8') if size else None)
+
+        return SharedNowPlayingState(position, length, elapsed, status, texts[0], texts[1], texts[2], track_changes)
+
+    def close(self) -> None:
+        self.buf = None
+        self.shm.close()
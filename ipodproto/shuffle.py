@@ -0,0 +1,176 @@
+"""
+Shuffled play orders which are computed one position at a time, so shuffling a huge playlist costs nothing up front.
+
+Every order maps a play position to a base index (a position in the unshuffled playlist) with `order[position]`,
+and back again with `order.index(base)`, just like a `range` does for the unshuffled order.
+"""
+import random
+from array import array
+from bisect import bisect_left, bisect_right
+from itertools import accumulate
+
+from .catalog import MAIN_PLAYLIST
+from .protocol import AirMode, SHUFFLE_SONGS, SHUFFLE_ALBUMS
+
+FEISTEL_ROUNDS = 4
+
+
+def _mix(x, key, mask):
+    x = ((x ^ key) * 0x45D9F3B) & 0xFFFFFFFF
+    x ^= x >> 16
+    x = (x * 0x45D9F3B) & 0xFFFFFFFF
+    x ^= x >> 16
+    return x & mask
+
+
+class Permutation:
+    """
+    A seeded pseudo-random bijection of `range(length)`, evaluated lazily in both directions.
+
+    This is a balanced Feistel network over the smallest even number of bits which covers the range, with
+    cycle-walking to stay inside it. The domain is less than four times the length, so each lookup takes a small,
+    constant number of rounds on average.
+    """
+
+    def __init__(self, length, seed=None):
+        self.length = length
+        self.seed = seed
+
+        bits = max(2, (length - 1).bit_length())
+        self._half = (bits + 1) // 2
+        self._mask = (1 << self._half) - 1
+
+        rng = random.Random(seed)
+        self._keys = [rng.getrandbits(32) for _ in range(FEISTEL_ROUNDS)]
+
+    def _encrypt(self, x):
+        left, right = x >> self._half, x & self._mask
+        for key in self._keys:
+            left, right = right, left ^ _mix(right, key, self._mask)
+        return (left << self._half) | right
+
+    def _decrypt(self, x):
+        left, right = x >> self._half, x & self._mask
+        for key in reversed(self._keys):
+            left, right = right ^ _mix(left, key, self._mask), left
+        return (left << self._half) | right
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, position):
+        if not 0 <= position < self.length:
+            raise IndexError("Position out of range: {}".format(position))
+
+        x = self._encrypt(position)
+        while x >= self.length:
+            x = self._encrypt(x)
+        return x
+
+    def index(self, value):
+        if not 0 <= value < self.length:
+            raise ValueError("{} is not in the permutation".format(value))
+
+        x = self._decrypt(value)
+        while x >= self.length:
+            x = self._decrypt(x)
+        return x
+
+    def __iter__(self):
+        return (self[i] for i in range(self.length))
+
+
+class GroupPermutation:
+    """
+    Shuffles groups (albums) of base indices, keeping each group's own order. Only the group order is stored, so
+    memory is proportional to the number of groups rather than the number of items.
+    """
+
+    def __init__(self, groups, group_of, seed=None):
+        """
+        :param groups: A sequence of groups, each a sequence of base indices.
+        :param group_of: A callable returning the `(group, offset)` of a base index within `groups`.
+        :param seed: The shuffle seed.
+        """
+        self.groups = groups
+        self.group_of = group_of
+        self.group_order = Permutation(len(groups), seed)
+
+        # Play position of the first item of each shuffled group
+        self.starts = array('I', [0])
+        self.starts.extend(accumulate(len(groups[g]) for g in self.group_order))
+
+    def __len__(self):
+        return self.starts[-1]
+
+    def __getitem__(self, position):
+        if not 0 <= position < len(self):
+            raise IndexError("Position out of range: {}".format(position))
+
+        slot = bisect_right(self.starts, position) - 1
+        return self.groups[self.group_order[slot]][position - self.starts[slot]]
+
+    def index(self, value):
+        group, offset = self.group_of(value)
+        return self.starts[self.group_order.index(group)] + offset
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+
+def library_album_permutation(catalog, seed=None):
+    """
+    An album shuffle of the main playlist, where base indices are song indices. The catalog's album postings are
+    used as the groups directly.
+    """
+    groups = [catalog.songs_with(AirMode.Types.ALBUM, album) for album in range(catalog.count(AirMode.Types.ALBUM))]
+
+    def group_of(song):
+        album = catalog.song_album(song)
+        return album, bisect_left(groups[album], song)
+
+    return GroupPermutation(groups, group_of, seed)
+
+
+def album_permutation(catalog, songs, seed=None):
+    """
+    An album shuffle of an arbitrary playlist. The playlist has to be grouped by album first, which takes time and
+    memory proportional to its length.
+    :param songs: The song indices of the playlist, in base order.
+    """
+    group_ids = {}
+    groups = []
+    membership = array('I', bytes(4 * len(songs)))
+    offsets = array('I', bytes(4 * len(songs)))
+
+    for base, song in enumerate(songs):
+        album = catalog.song_album(song)
+        group = group_ids.get(album)
+        if group is None:
+            group = group_ids[album] = len(groups)
+            groups.append(array('I'))
+        membership[base] = group
+        offsets[base] = len(groups[group])
+        groups[group].append(base)
+
+    return GroupPermutation(groups, lambda base: (membership[base], offsets[base]), seed)
+
+
+def play_order(shuffle_mode, catalog, songs, playlist=None, seed=None):
+    """
+    Builds the play order for a playlist.
+    :param shuffle_mode: One of SHUFFLE_OFF, SHUFFLE_SONGS or SHUFFLE_ALBUMS.
+    :param catalog: The catalog the songs belong to.
+    :param songs: The song indices of the playlist, in base order.
+    :param playlist: The catalog playlist the songs came from, if any.
+    :param seed: The shuffle seed.
+    :return: A sequence mapping play positions to base indices, with an `index()` method for the inverse.
+    """
+    if shuffle_mode == SHUFFLE_SONGS:
+        return Permutation(len(songs), seed)
+    elif shuffle_mode == SHUFFLE_ALBUMS:
+        if playlist == MAIN_PLAYLIST:
+            return library_album_permutation(catalog, seed)
+        return album_permutation(catalog, songs, seed)
+    else:
+        return range(len(songs))
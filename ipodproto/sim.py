@@ -0,0 +1,273 @@
+"""
+An in-process serial link, for connecting an `AdvancedRemote` to an `IpodEmulator` without hardware. Each direction
+is modelled as a UART line: bytes take `bits_per_byte / baud` seconds each, behind a fixed latency and optional
+jitter, and can be dropped or corrupted at random.
+
+With a `VirtualClock`, nobody waits for the line: a reader with nothing to read jumps the clock forward to the next
+delivery instead. Timings are then independent of the host, and the same seed gives the same drops, corruption and
+timings as long as each direction has a single writer. Handler timeouts are still in real time.
+"""
+import random
+import threading
+from collections import deque
+from math import floor
+
+try:
+    from time import monotonic
+except ImportError:
+    from time import time as monotonic
+
+
+class RealClock:
+    """
+    Link time is wall clock time.
+    """
+    virtual = False
+
+    def now(self) -> float:
+        return monotonic()
+
+
+class VirtualClock:
+    """
+    Link time only moves forward when a reader would otherwise have to wait for the line.
+    """
+    virtual = True
+
+    def __init__(self, start: float = 0.0):
+        self._now = start
+        self._lock = threading.Lock()
+
+    def now(self) -> float:
+        return self._now
+
+    def advance_to(self, when: float) -> None:
+        with self._lock:
+            if when > self._now:
+                self._now = when
+
+
+class LinkModel:
+    """
+    The timing and error characteristics of one direction of a link.
+    """
+
+    def __init__(self, baud: int = 19200, latency: float = 0.0, jitter: float = 0.0, drop_rate: float = 0.0,
+                 corrupt_rate: float = 0.0, bits_per_byte: int = 10):
+        """
+        :param baud: The line rate in bits per second.
+        :param latency: A fixed delay added to every byte, in seconds.
+        :param jitter: The most extra delay added to each write, in seconds, chosen uniformly. Bytes are never
+        reordered by it.
+        :param drop_rate: The probability of each byte being lost.
+        :param corrupt_rate: The probability of each byte having one bit flipped.
+        :param bits_per_byte: Bits on the line per byte, including start and stop bits; 10 for 8N1.
+        """
+        self.baud = baud
+        self.latency = latency
+        self.jitter = jitter
+        self.drop_rate = drop_rate
+        self.corrupt_rate = corrupt_rate
+        self.bits_per_byte = bits_per_byte
+
+    @property
+    def byte_time(self) -> float:
+        return self.bits_per_byte / self.baud
+
+
+class Channel:
+    """
+    One direction of a link. Each write is kept as a chunk whose bytes become readable one byte time apart.
+    """
+
+    def __init__(self, model: LinkModel, clock, seed=None):
+        self.model = model
+        self.clock = clock
+        self.rng = random.Random(seed)
+
+        self.bytes_sent = 0
+        self.bytes_delivered = 0
+        self.dropped = 0
+        self.corrupted = 0
+
+        # [data, delivery time of its first byte, bytes already read]
+        self._chunks = deque()
+        # When the line finishes sending what it has been given, and when the last byte is delivered
+        self._line_free = 0.0
+        self._last_delivery = 0.0
+        self._closed = False
+        self._condition = threading.Condition()
+
+    def _mangle(self, data):
+        model, rng = self.model, self.rng
+        if not model.drop_rate and not model.corrupt_rate:
+            return data
+
+        out = bytearray()
+        for byte in data:
+            if model.drop_rate and rng.random() < model.drop_rate:
+                self.dropped += 1
+                continue
+            if model.corrupt_rate and rng.random() < model.corrupt_rate:
+                byte ^= 1 << rng.randrange(8)
+                self.corrupted += 1
+            out.append(byte)
+        return bytes(out)
+
+    def send(self, data: bytes) -> None:
+        model = self.model
+        byte_time = model.byte_time
+
+        with self._condition:
+            now = self.clock.now()
+            start = max(now, self._line_free)
+            # Lost bytes still take their time on the line
+            self._line_free = start + len(data) * byte_time
+            self.bytes_sent += len(data)
+
+            delivered = self._mangle(bytes(data))
+            if delivered:
+                first = start + byte_time + model.latency
+                if model.jitter:
+                    first += self.rng.uniform(0, model.jitter)
+                first = max(first, self._last_delivery + byte_time)
+                self._last_delivery = first + (len(delivered) - 1) * byte_time
+                self._chunks.append([delivered, first, 0])
+
+            self._condition.notify_all()
+
+    def _readable(self, now, size):
+        """
+        Takes up to `size` bytes which have been delivered by `now`.
+        """
+        out = []
+        byte_time = self.model.byte_time
+
+        while self._chunks and size > 0:
+            chunk = self._chunks[0]
+            data, first, taken = chunk
+            arrived = min(len(data), int(floor((now - first) / byte_time + 1e-9)) + 1) if now >= first else 0
+            count = min(arrived - taken, size)
+            if count <= 0:
+                break
+
+            out.append(data[taken:taken + count])
+            chunk[2] += count
+            size -= count
+            if chunk[2] == len(data):
+                self._chunks.popleft()
+            else:
+                break
+
+        result = b''.join(out)
+        self.bytes_delivered += len(result)
+        return result
+
+    def _next_completion(self):
+        data, first, taken = self._chunks[0]
+        return first + (len(data) - 1) * self.model.byte_time
+
+    def receive(self, size: int = 4096, timeout: float = 0.05) -> bytes:
+        """
+        Reads whatever has been delivered, waiting up to `timeout` seconds of real time for something to arrive.
+        """
+        deadline = monotonic() + timeout
+
+        with self._condition:
+            while True:
+                data = self._readable(self.clock.now(), size)
+                if data:
+                    return data
+
+                if self._chunks:
+                    if self.clock.virtual:
+                        # Skip ahead to when the next write has fully arrived
+                        self.clock.advance_to(self._next_completion())
+                        continue
+                    wait = min(self._chunks[0][1] - self.clock.now(), deadline - monotonic())
+                else:
+                    wait = deadline - monotonic()
+
+                if self._closed or wait <= 0:
+                    return b''
+                self._condition.wait(wait)
+
+    def close(self) -> None:
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+
+
+class LinkEnd:
+    """
+    One end of a link, with the `read`/`write` interface `IpodProtocolHandler` expects.
+    """
+
+    def __init__(self, incoming: Channel, outgoing: Channel):
+        self.incoming = incoming
+        self.outgoing = outgoing
+
+    def read(self, size: int = 4096, timeout: float = 0.05) -> bytes:
+        return self.incoming.receive(size, timeout)
+
+    def write(self, data: bytes) -> None:
+        self.outgoing.send(data)
+
+
+class SimulatedLink:
+    """
+    A duplex link between an accessory and an iPod.
+    """
+
+    def __init__(self, model: LinkModel = None, clock=None, seed=None, accessory_to_ipod: LinkModel = None,
+                 ipod_to_accessory: LinkModel = None):
+        """
+        :param model: The model for both directions. Defaults to a clean 19200 baud line.
+        :param clock: A `RealClock` or `VirtualClock`. Defaults to a real clock.
+        :param seed: Seeds the drops, corruption and jitter.
+        :param accessory_to_ipod: Overrides the model for the accessory's writes.
+        :param ipod_to_accessory: Overrides the model for the iPod's writes.
+        """
+        model = model or LinkModel()
+        self.clock = clock or RealClock()
+
+        self.to_ipod = Channel(accessory_to_ipod or model, self.clock, None if seed is None else seed * 2)
+        self.to_accessory = Channel(ipod_to_accessory or model, self.clock, None if seed is None else seed * 2 + 1)
+
+        # The streams to give the AdvancedRemote and the IpodEmulator
+        self.accessory = LinkEnd(self.to_accessory, self.to_ipod)
+        self.ipod = LinkEnd(self.to_ipod, self.to_accessory)
+
+        self._handlers = []
+
+    def start(self, *handlers) -> None:
+        """
+        Runs handlers on background threads until `close()`.
+        """
+        for handler in handlers:
+            thread = threading.Thread(target=handler.run, daemon=True)
+            thread.start()
+            self._handlers.append((handler, thread))
+
+    def close(self) -> None:
+        """
+        Stops every handler started with `start()`.
+        """
+        for handler, _ in self._handlers:
+            handler.stop()
+        self.to_ipod.close()
+        self.to_accessory.close()
+        for _, thread in self._handlers:
+            thread.join()
+        self._handlers = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def stats(self) -> dict:
+        return {name: {'sent': channel.bytes_sent, 'delivered': channel.bytes_delivered,
+                       'dropped': channel.dropped, 'corrupted': channel.corrupted}
+                for name, channel in (('to_ipod', self.to_ipod), ('to_accessory', self.to_accessory))}
@@ -0,0 +1,393 @@
+"""
+A small pure-Python reader for the tags the emulator serves: title, artist, album, genre, composer and length, from
+ID3v2.2-2.4 (falling back to ID3v1) in MP3 files and from iTunes-style metadata in MP4/M4A files.
+
+Only what is needed is read: ID3 frames which aren't wanted, such as cover art, are skipped with a seek, and in MP4
+files only the `moov` atom is read.
+"""
+import os
+import struct
+from collections import namedtuple
+
+Tags = namedtuple('Tags', ['title', 'artist', 'album', 'genre', 'composer', 'length'])
+
+MP3_EXTENSIONS = ('.mp3',)
+MP4_EXTENSIONS = ('.m4a', '.m4b', '.m4p', '.mp4')
+AUDIO_EXTENSIONS = MP3_EXTENSIONS + MP4_EXTENSIONS
+
+# Anything bigger is almost certainly not a real tag, so don't try to hold it in memory
+MAX_TAG_SIZE = 64 * 1024 * 1024
+
+ID3V1_GENRES = (
+    "Blues", "Classic Rock", "Country", "Dance", "Disco", "Funk", "Grunge", "Hip-Hop", "Jazz", "Metal", "New Age",
+    "Oldies", "Other", "Pop", "R&B", "Rap", "Reggae", "Rock", "Techno", "Industrial", "Alternative", "Ska",
+    "Death Metal", "Pranks", "Soundtrack", "Euro-Techno", "Ambient", "Trip-Hop", "Vocal", "Jazz+Funk", "Fusion",
+    "Trance", "Classical", "Instrumental", "Acid", "House", "Game", "Sound Clip", "Gospel", "Noise", "AlternRock",
+    "Bass", "Soul", "Punk", "Space", "Meditative", "Instrumental Pop", "Instrumental Rock", "Ethnic", "Gothic",
+    "Darkwave", "Techno-Industrial", "Electronic", "Pop-Folk", "Eurodance", "Dream", "Southern Rock", "Comedy",
+    "Cult", "Gangsta", "Top 40", "Christian Rap", "Pop/Funk", "Jungle", "Native American", "Cabaret", "New Wave",
+    "Psychedelic", "Rave", "Showtunes", "Trailer", "Lo-Fi", "Tribal", "Acid Punk", "Acid Jazz", "Polka", "Retro",
+    "Musical", "Rock & Roll", "Hard Rock",
+)
+
+# ID3v2.3/2.4 and ID3v2.2 frame ids -> Tags field
+ID3_FRAMES = {
+    b'TIT2': 'title', b'TT2': 'title',
+    b'TPE1': 'artist', b'TP1': 'artist',
+    b'TPE2': 'album_artist', b'TP2': 'album_artist',
+    b'TALB': 'album', b'TAL': 'album',
+    b'TCON': 'genre', b'TCO': 'genre',
+    b'TCOM': 'composer', b'TCM': 'composer',
+    b'TLEN': 'length', b'TLE': 'length',
+}
+
+MP4_ITEMS = {
+    b'\xa9nam': 'title',
+    b'\xa9ART': 'artist',
+    b'aART': 'album_artist',
+    b'\xa9alb': 'album',
+    b'\xa9gen': 'genre',
+    b'gnre': 'genre',
+    b'\xa9wrt': 'composer',
+}
+
+# kbit/s by bitrate index, for MPEG-1 and MPEG-2/2.5 layer III
+MP3_BITRATES = (
+    (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320),
+    (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+)
+# Hz by sample rate index, for MPEG-1, MPEG-2 and MPEG-2.5
+MP3_SAMPLE_RATES = ((44100, 48000, 32000), (22050, 24000, 16000), (11025, 12000, 8000))
+
+
+class TagError(Exception):
+    pass
+
+
+def _syncsafe(data):
+    return (data[0] << 21) | (data[1] << 14) | (data[2] << 7) | data[3]
+
+
+def _unsynchronise(data):
+    return data.replace(b'\xff\x00', b'\xff')
+
+
+def _genre(text):
+    """
+    Resolves ID3v1 genre numbers, written as "(17)", "(17)Rock" or "17".
+    """
+    if text.startswith('(') and ')' in text:
+        number, _, rest = text[1:].partition(')')
+        if rest:
+            return rest
+        text = number
+    if text.isdigit() and int(text) < len(ID3V1_GENRES):
+        return ID3V1_GENRES[int(text)]
+    return text
+
+
+def _id3_text(data):
+    if not data:
+        return None
+
+    encoding, data = data[0], data[1:]
+    if encoding == 0:
+        text = data.decode('latin-1')
+    elif encoding == 1:
+        text = data.decode('utf-16', 'replace')
+    elif encoding == 2:
+        text = data.decode('utf-16-be', 'replace')
+    elif encoding == 3:
+        text = data.decode('utf-8', 'replace')
+    else:
+        return None
+
+    # Only the first of several values separated by NULs
+    return text.split('\x00', 1)[0].strip() or None
+
+
+def _read_id3v2(f):
+    """
+    :return: A dict of the wanted text frames, and the size of the tag including its header, or ({}, 0) if the file
+    doesn't start with one.
+    """
+    header = f.read(10)
+    if len(header) < 10 or header[:3] != b'ID3':
+        return {}, 0
+
+    major, flags = header[3], header[5]
+    size = _syncsafe(header[6:10])
+    end = 10 + size + (10 if major >= 4 and flags & 0x10 else 0)
+    if major not in (2, 3, 4) or size > MAX_TAG_SIZE:
+        return {}, end
+
+    extended = major >= 3 and flags & 0x40
+    if flags & 0x80 and major < 4:
+        # The whole tag is unsynchronised, so frames can only be found after undoing it
+        data = _unsynchronise(f.read(size))
+        return _id3_frames(_BufferReader(data), major, len(data), 0, extended), end
+
+    return _id3_frames(f, major, size, 10, extended), end
+
+
+class _BufferReader:
+    """
+    Enough of a file to read frames from bytes.
+    """
+
+    def __init__(self, data):
+        self.data = data
+        self.position = 0
+
+    def read(self, size):
+        data = self.data[self.position:self.position + size]
+        self.position += len(data)
+        return data
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        self.position = offset if whence == os.SEEK_SET else self.position + offset
+
+    def tell(self):
+        return self.position
+
+
+def _id3_frames(f, major, size, base, extended):
+    frames = {}
+    header_size = 6 if major == 2 else 10
+    id_size = 3 if major == 2 else 4
+    end = base + size
+
+    if extended:
+        # ID3v2.3 gives the size of the rest of the extended header, ID3v2.4 the size including itself
+        ext_size = f.read(4)
+        if len(ext_size) < 4:
+            return frames
+        skip = int.from_bytes(ext_size, 'big') if major == 3 else _syncsafe(ext_size) - 4
+        f.seek(skip, os.SEEK_CUR)
+
+    while f.tell() + header_size <= end:
+        header = f.read(header_size)
+        frame_id = header[:id_size]
+        if not frame_id.strip(b'\x00') or not frame_id.isalnum():
+            # Padding
+            break
+
+        if major == 2:
+            frame_size = int.from_bytes(header[3:6], 'big')
+            frame_flags = 0
+        else:
+            frame_size = _syncsafe(header[4:8]) if major == 4 else int.from_bytes(header[4:8], 'big')
+            frame_flags = int.from_bytes(header[8:10], 'big')
+
+        if frame_size > end - f.tell():
+            break
+
+        name = ID3_FRAMES.get(frame_id)
+        if name is None or name in frames:
+            f.seek(frame_size, os.SEEK_CUR)
+            continue
+
+        data = f.read(frame_size)
+        if major == 3:
+            if frame_flags & 0x00C0:
+                # Compressed or encrypted
+                continue
+        elif major == 4:
+            if frame_flags & 0x000C:
+                continue
+            if frame_flags & 0x0002:
+                data = _unsynchronise(data)
+            if frame_flags & 0x0001:
+                # Data length indicator
+                data = data[4:]
+
+        text = _id3_text(data)
+        if text is not None:
+            frames[name] = text
+
+    return frames
+
+
+def _read_id3v1(f, file_size):
+    if file_size < 128:
+        return {}
+
+    f.seek(-128, os.SEEK_END)
+    data = f.read(128)
+    if data[:3] != b'TAG':
+        return {}
+
+    def text(start, length):
+        return data[start:start + length].split(b'\x00', 1)[0].decode('latin-1').strip() or None
+
+    frames = {'title': text(3, 30), 'artist': text(33, 30), 'album': text(63, 30)}
+    if data[127] < len(ID3V1_GENRES):
+        frames['genre'] = ID3V1_GENRES[data[127]]
+    return {name: value for name, value in frames.items() if value is not None}
+
+
+def _mp3_length(f, audio_start, audio_end):
+    """
+    Estimates the length in milliseconds from the first MPEG audio frame: exactly from a Xing/Info frame count if
+    there is one, and from the bitrate otherwise.
+    """
+    f.seek(audio_start)
+    data = f.read(4096)
+
+    for i in range(len(data) - 4):
+        if data[i] != 0xFF or data[i + 1] & 0xE0 != 0xE0:
+            continue
+
+        version = (data[i + 1] >> 3) & 0x03
+        layer = (data[i + 1] >> 1) & 0x03
+        bitrate_index = data[i + 2] >> 4
+        rate_index = (data[i + 2] >> 2) & 0x03
+        if version == 1 or layer != 1 or bitrate_index in (0, 15) or rate_index == 3:
+            # Reserved values, or not layer III: keep looking for a real frame header
+            continue
+
+        mpeg1 = version == 3
+        bitrate = MP3_BITRATES[0 if mpeg1 else 1][bitrate_index] * 1000
+        sample_rate = MP3_SAMPLE_RATES[{3: 0, 2: 1, 0: 2}[version]][rate_index]
+        samples_per_frame = 1152 if mpeg1 else 576
+        mono = data[i + 3] >> 6 == 3
+
+        side_info = (17 if mono else 32) if mpeg1 else (9 if mono else 17)
+        xing = i + 4 + side_info
+        if data[xing:xing + 4] in (b'Xing', b'Info') and len(data) >= xing + 12 and data[xing + 7] & 0x01:
+            frames = int.from_bytes(data[xing + 8:xing + 12], 'big')
+            return frames * samples_per_frame * 1000 // sample_rate
+
+        return (audio_end - audio_start - i) * 8 * 1000 // bitrate
+
+    return 0
+
+
+def read_mp3(f, file_size):
+    frames, tag_size = _read_id3v2(f)
+    id3v1 = _read_id3v1(f, file_size)
+    for name, value in id3v1.items():
+        frames.setdefault(name, value)
+
+    length = frames.get('length')
+    if length is not None and length.isdigit():
+        length = int(length)
+    else:
+        length = _mp3_length(f, tag_size, file_size - (128 if id3v1 else 0))
+
+    return frames, length
+
+
+def _atoms(f, start, end):
+    """
+    Yields the type, data offset and data size of each atom between `start` and `end`.
+    """
+    offset = start
+    while offset + 8 <= end:
+        f.seek(offset)
+        header = f.read(8)
+        if len(header) < 8:
+            return
+        size, kind = struct.unpack('>I4s', header)
+        header_size = 8
+        if size == 1:
+            large_size = f.read(8)
+            if len(large_size) < 8:
+                raise TagError("Truncated {!r} atom".format(kind))
+            size = struct.unpack('>Q', large_size)[0]
+            header_size = 16
+        elif size == 0:
+            size = end - offset
+        if size < header_size:
+            return
+
+        yield kind, offset + header_size, size - header_size
+        offset += size
+
+
+def _find_atom(f, start, end, path):
+    for kind, data_offset, data_size in _atoms(f, start, end):
+        if kind == path[0]:
+            if len(path) == 1:
+                return data_offset, data_size
+            if kind == b'meta':
+                # A full atom, with a version and flags before its children
+                data_offset, data_size = data_offset + 4, data_size - 4
+            return _find_atom(f, data_offset, data_offset + data_size, path[1:])
+    return None
+
+
+def read_mp4(f, file_size):
+    moov = _find_atom(f, 0, file_size, (b'moov',))
+    if moov is None:
+        raise TagError("No moov atom")
+
+    # Everything wanted is in moov, which is small, so read it in one go
+    f.seek(moov[0])
+    data = _BufferReader(f.read(min(moov[1], MAX_TAG_SIZE)))
+    size = len(data.data)
+
+    length = 0
+    mvhd = _find_atom(data, 0, size, (b'mvhd',))
+    if mvhd is not None:
+        header = data.data[mvhd[0]:mvhd[0] + min(mvhd[1], 32)]
+        if header[:1] == b'\x01' and len(header) >= 32:
+            timescale, duration = struct.unpack('>IQ', header[20:32])
+        elif header[:1] == b'\x00' and len(header) >= 20:
+            timescale, duration = struct.unpack('>II', header[12:20])
+        else:
+            # Truncated, or a version this doesn't know, so the length stays unknown
+            timescale = duration = 0
+        if timescale:
+            length = duration * 1000 // timescale
+
+    frames = {}
+    ilst = _find_atom(data, 0, size, (b'udta', b'meta', b'ilst'))
+    if ilst is not None:
+        for kind, item_offset, item_size in _atoms(data, ilst[0], ilst[0] + ilst[1]):
+            name = MP4_ITEMS.get(kind)
+            if name is None or name in frames:
+                continue
+
+            value = _find_atom(data, item_offset, item_offset + item_size, (b'data',))
+            if value is None or value[1] < 8:
+                continue
+            raw = data.data[value[0] + 8:value[0] + value[1]]
+            data_type = int.from_bytes(data.data[value[0] + 1:value[0] + 4], 'big')
+
+            if kind == b'gnre':
+                number = int.from_bytes(raw, 'big')
+                if 0 < number <= len(ID3V1_GENRES):
+                    frames[name] = ID3V1_GENRES[number - 1]
+            elif data_type == 1:
+                text = raw.decode('utf-8', 'replace').strip()
+                if text:
+                    frames[name] = text
+
+    return frames, length
+
+
+def read_tags(path: str) -> Tags:
+    """
+    :return: The tags of an MP3 or MP4 file, with None for anything missing. The title defaults to the file name,
+    the artist to the album artist, and the length to 0 if it can't be worked out.
+    :raises TagError: If the file isn't a kind this reads.
+    :raises OSError: If the file can't be read.
+    """
+    extension = os.path.splitext(path)[1].lower()
+    with open(path, 'rb') as f:
+        file_size = os.fstat(f.fileno()).st_size
+        if extension in MP3_EXTENSIONS:
+            frames, length = read_mp3(f, file_size)
+        elif extension in MP4_EXTENSIONS:
+            frames, length = read_mp4(f, file_size)
+        else:
+            raise TagError("Unsupported file type: {}".format(extension))
+
+    genre = frames.get('genre')
+    if genre is not None:
+        genre = _genre(genre)
+
+    return Tags(frames.get('title') or os.path.splitext(os.path.basename(path))[0],
+                frames.get('artist') or frames.get('album_artist'), frames.get('album'), genre,
+                frames.get('composer'), length)
@@ -0,0 +1,124 @@
+"""
+Span tracing of the stages a frame goes through, for finding where the time goes in a single request. Spans are kept
+in a ring buffer and can be exported as Chrome trace JSON, which chrome://tracing and Perfetto both open.
+
+Handlers only trace when given a `Tracer`. The stages recorded are:
+
+- read: a read from the stream which returned data
+- frame: splitting the data read into frames, including decoding them
+- decode: unpacking one frame
+- dispatch: `packet_received` for one packet
+- handler: the emulator's handling of one command
+- encode: packing one packet
+- write: writing to the stream, including waiting for other writers
+- request: an AdvancedRemote request, from sending it to its response being returned
+- wait: waiting for a response
+"""
+import json
+import threading
+from collections import deque
+from contextlib import contextmanager
+from os import getpid
+from time import perf_counter
+
+from .protocol import AirMode, SwitchMode, MODE_ADVANCED_REMOTE, MODE_SWITCH
+
+
+def _names(commands):
+    names = {}
+    for name, value in vars(commands).items():
+        if name.isupper():
+            names.setdefault(value, name)
+    return names
+
+
+_COMMAND_NAMES = {
+    MODE_SWITCH: _names(SwitchMode.Commands),
+    MODE_ADVANCED_REMOTE: _names(AirMode.Commands),
+}
+
+
+def command_name(mode: int, command_id) -> str:
+    """
+    :return: The name of a command, or its mode and id if it doesn't have one.
+    """
+    name = _COMMAND_NAMES.get(mode, {}).get(command_id)
+    if name is None:
+        return '{:02x}:{}'.format(mode, command_id)
+    return name
+
+
+class Tracer:
+    """
+    Records complete spans into a ring buffer, so tracing can be left on and only the most recent spans are kept.
+    """
+
+    def __init__(self, capacity: int = 65536, clock=perf_counter, process_name: str = 'ipodproto'):
+        """
+        :param capacity: The most spans to keep.
+        :param clock: A function returning the current time in seconds. Every handler sharing a tracer must use the
+        same clock, for their spans to line up.
+        :param process_name: The name of the process in exported traces.
+        """
+        self.capacity = capacity
+        self.clock = clock
+        self.process_name = process_name
+
+        # (name, category, start, duration, thread id, args)
+        self.spans = deque(maxlen=capacity)
+        self._thread_names = {}
+
+    def complete(self, name: str, start: float, category: str = 'ipodproto', args: dict = None) -> None:
+        """
+        Records a span which started at `start` and ends now.
+        :param start: The start time, from this tracer's clock.
+        :param args: Extra details to show with the span. A `mode` and command `id` are shown with the command's name.
+        """
+        end = self.clock()
+        thread = threading.current_thread()
+        if thread.ident not in self._thread_names:
+            self._thread_names[thread.ident] = thread.name
+
+        self.spans.append((name, category, start, end - start, thread.ident, args))
+
+    @contextmanager
+    def span(self, name: str, category: str = 'ipodproto', **args):
+        """
+        Records a span around a block of code.
+        """
+        start = self.clock()
+        try:
+            yield
+        finally:
+            self.complete(name, start, category, args or None)
+
+    def clear(self) -> None:
+        self.spans.clear()
+
+    def to_chrome_trace(self) -> dict:
+        """
+        :return: The spans as a Chrome trace event object, ready to be serialised as JSON.
+        """
+        pid = getpid()
+        events = [{'name': 'process_name', 'ph': 'M', 'pid': pid, 'args': {'name': self.process_name}}]
+
+        for tid, name in list(self._thread_names.items()):
+            events.append({'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tid, 'args': {'name': name}})
+
+        for name, category, start, duration, tid, args in list(self.spans):
+            event = {'name': name, 'cat': category, 'ph': 'X', 'pid': pid, 'tid': tid,
+                     'ts': start * 1e6, 'dur': duration * 1e6}
+            if args:
+                if 'mode' in args and 'id' in args:
+                    args = dict(args, command=command_name(args['mode'], args['id']))
+                event['args'] = args
+            events.append(event)
+
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def export(self, path: str) -> None:
+        """
+        Writes the spans to a Chrome trace JSON file.
+        """
+        with open(path, 'w') as f:
+            json.dump(self.to_chrome_trace(), f, default=str)